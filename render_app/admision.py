@@ -0,0 +1,131 @@
+"""
+Control de admisión para los endpoints que generan informes.
+
+Cada petición estima cuánta memoria va a usar (Content-Length, fotos de su
+sesión de subida y las que adjunta en un multipart, que se estiman por el
+Content-Length porque aún no se leyó el cuerpo) y entra sólo si cabe en ADMISION_PRESUPUESTO_MB junto con
+las que ya están en curso. Si no cabe espera en cola hasta ADMISION_ESPERA
+segundos; con la cola llena o la espera agotada se responde 503 con un
+Retry-After calculado según la cola y la duración media de un informe.
+El estado vive en memoria compartida (multiprocessing): lo comparten los
+workers de gunicorn que salen del mismo proceso con --preload.
+"""
+import math
+import multiprocessing
+import os
+import time
+from typing import NamedTuple
+
+# ------------------------
+# Configuración
+# ------------------------
+# Memoria que pueden ocupar a la vez las peticiones admitidas
+ADMISION_PRESUPUESTO_MB = float(os.environ.get("ADMISION_PRESUPUESTO_MB", 384))
+# Peticiones esperando lugar como máximo; con la cola llena se responde 503 enseguida
+ADMISION_COLA_MAX = int(os.environ.get("ADMISION_COLA_MAX", 8))
+# Segundos que una petición espera lugar antes del 503
+ADMISION_ESPERA = float(os.environ.get("ADMISION_ESPERA", 10))
+# Modelo de costo (MB): fijo + fracción del cuerpo + por cada foto de la sesión
+ADMISION_MB_BASE = float(os.environ.get("ADMISION_MB_BASE", 40))
+ADMISION_FACTOR_CUERPO = float(os.environ.get("ADMISION_FACTOR_CUERPO", 0.25))
+ADMISION_MB_POR_IMAGEN = float(os.environ.get("ADMISION_MB_POR_IMAGEN", 1.5))
+# Tamaño supuesto de cada foto adjunta a un multipart (chico: mejor sobrestimar cuántas son)
+ADMISION_MB_POR_FOTO_SUBIDA = float(os.environ.get("ADMISION_MB_POR_FOTO_SUBIDA", 1))
+# Duración supuesta de un informe hasta medir la primera
+ADMISION_DURACION_INICIAL = float(os.environ.get("ADMISION_DURACION_INICIAL", 5))
+RETRY_AFTER_MAX = 120
+
+
+def estimar_mb(content_length=0, imagenes=0, multipart=False):
+    """
+    Costo estimado de una petición en MB. imagenes son las fotos ya subidas que
+    usa; con multipart se suman las que puede traer el cuerpo.
+    """
+    cuerpo = (content_length or 0) / (1024 * 1024)
+    if multipart:
+        imagenes = (imagenes or 0) + math.ceil(cuerpo / ADMISION_MB_POR_FOTO_SUBIDA)
+    return ADMISION_MB_BASE + cuerpo * ADMISION_FACTOR_CUERPO + (imagenes or 0) * ADMISION_MB_POR_IMAGEN
+
+
+class Saturado(Exception):
+    def __init__(self, retry_after, motivo):
+        super().__init__(motivo)
+        self.retry_after = retry_after
+        self.motivo = motivo
+
+
+class Ticket(NamedTuple):
+    costo: float
+    inicio: float
+    espera: float
+
+
+class Admision:
+    """
+    Presupuesto de memoria compartido entre procesos. entrar() devuelve un
+    Ticket (o lanza Saturado) y salir(ticket) lo libera; la duración de cada
+    ticket alimenta el promedio con que se calcula el Retry-After.
+    """
+
+    def __init__(self, presupuesto_mb, cola_max, espera):
+        self.presupuesto_mb = presupuesto_mb
+        self.cola_max = cola_max
+        self.espera = espera
+        self._cond = multiprocessing.Condition()
+        self._en_uso = multiprocessing.RawValue("d", 0.0)
+        self._en_curso = multiprocessing.RawValue("q", 0)
+        self._en_cola = multiprocessing.RawValue("q", 0)
+        self._duracion = multiprocessing.RawValue("d", ADMISION_DURACION_INICIAL)
+
+    def _retry_after(self):
+        # la cola se reparte entre los informes que se atienden a la vez
+        paralelos = max(1, self._en_curso.value)
+        segundos = self._duracion.value * (self._en_cola.value + 1) / paralelos
+        return int(min(RETRY_AFTER_MAX, max(1, math.ceil(segundos))))
+
+    def entrar(self, costo_mb):
+        # una petición más cara que todo el presupuesto entra cuando no hay otra
+        costo = min(costo_mb, self.presupuesto_mb)
+        t0 = time.monotonic()
+        with self._cond:
+
+            def cabe():
+                return self._en_uso.value + costo <= self.presupuesto_mb
+
+            if not cabe():
+                if self._en_cola.value >= self.cola_max:
+                    raise Saturado(self._retry_after(), "cola llena")
+                self._en_cola.value += 1
+                try:
+                    admitida = self._cond.wait_for(cabe, self.espera)
+                finally:
+                    self._en_cola.value -= 1
+                if not admitida:
+                    raise Saturado(self._retry_after(), "espera agotada")
+            self._en_uso.value += costo
+            self._en_curso.value += 1
+        ahora = time.monotonic()
+        return Ticket(costo, ahora, ahora - t0)
+
+    def salir(self, ticket):
+        duracion = time.monotonic() - ticket.inicio
+        with self._cond:
+            self._en_uso.value = max(0.0, self._en_uso.value - ticket.costo)
+            self._en_curso.value -= 1
+            self._duracion.value = 0.8 * self._duracion.value + 0.2 * duracion
+            self._cond.notify_all()
+
+    def estado(self):
+        with self._cond:
+            return {
+                "presupuesto_mb": self.presupuesto_mb,
+                "en_uso_mb": round(self._en_uso.value, 1),
+                "en_curso": self._en_curso.value,
+                "en_cola": self._en_cola.value,
+                "cola_max": self.cola_max,
+                "duracion_media_s": round(self._duracion.value, 3),
+                "retry_after_s": self._retry_after(),
+            }
+
+
+control = Admision(ADMISION_PRESUPUESTO_MB, ADMISION_COLA_MAX, ADMISION_ESPERA)
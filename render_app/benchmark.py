@@ -0,0 +1,363 @@
+"""
+Benchmark de generación de informes con payloads sintéticos (forma de buildPayload).
+
+Ejemplos:
+    python benchmark.py --tanques 10 --equipos 18 --red 14 --actividades 20 --fotos 300
+    python benchmark.py --fotos 50 --repeticiones 3 --salida bench.json
+
+Mide por fase (s), RSS pico (proceso y pool de imágenes) y tamaño del docx,
+generando el informe directamente (modelo JSON y generar_docx_desde_dfs)
+y vía /generar con el test client de Flask. La salida es JSON para comparar entre commits.
+"""
+import argparse
+import io
+import json
+import os
+import platform
+import random
+import resource
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+
+from PIL import Image, ImageDraw
+
+import imagenes
+import resultados
+import servidor
+from modelo import ACCESORIOS_TANQUE, ATRIBUTOS_ACCESORIO, CAMPOS_GENERALES, ESTRUCTURA_EQUIPOS
+
+TIPOS_RED = [
+    "llenado_toma_desplazada",
+    "retorno_toma_desplazada",
+    "alivio_hidrostatico",
+    "regulador_primera_etapa",
+    "alivio",
+    "regulador_2da",
+    "pull_away",
+]
+ESPECIFICOS_TANQUE = [
+    "bases",
+    "manometro_0_60",
+    "manometro_0_300",
+    "chicote",
+    "stickers",
+    "anclajes",
+    "valvula_llenado",
+    "valvula_seguridad",
+    "valvula_drenaje",
+    "multivalvula",
+    "medidor_porcentaje",
+]
+
+# fases de Server-Timing que sólo aparecen si /generar armó el documento
+FASES_DOCX = ["base"] + [tramo for tramo, *_ in servidor.SECCIONES_DOCX]
+
+
+# ------------------------
+# Payload e imágenes sintéticas
+# ------------------------
+def construir_payload(n_tanques, n_equipos, n_red, n_actividades, rnd):
+    general = {c: f"{c} {rnd.randint(1, 999)}" for c in CAMPOS_GENERALES}
+    general["Correo de contacto"] = "contacto@example.com"
+    tanques = [
+        {
+            "serie": f"SER-{i + 1:04d}",
+            "capacidad": str(rnd.choice([500, 1000, 3000, 5000])),
+            "anio": str(rnd.randint(1995, 2024)),
+            "tipo": rnd.choice(["Horizontal", "Vertical"]),
+            "fabricante": rnd.choice(["Fab A", "Fab B", "Fab C"]),
+            "porcentaje": str(rnd.randint(5, 85)),
+        }
+        for i in range(n_tanques)
+    ]
+    accesorios_tanque = {
+        str(i + 1): {
+            acc: {attr: f"{attr[:3]}-{rnd.randint(100, 999)}" for attr in ATRIBUTOS_ACCESORIO}
+            for acc in ACCESORIOS_TANQUE
+        }
+        for i in range(n_tanques)
+    }
+    accesorios_red = [
+        {
+            "Tipo": TIPOS_RED[i % len(TIPOS_RED)],
+            "Marca": f"Marca {i}",
+            "Serie": f"R{i:04d}",
+            "Código": f"C{i:04d}",
+            "Mes/Año de fabricación": f"{rnd.randint(1, 12):02d}/{rnd.randint(2000, 2024)}",
+        }
+        for i in range(n_red)
+    ]
+    if n_red:
+        accesorios_red.append({"Tipo": "zona_medidores", "Marca": "", "Serie": "", "Código": "true", "Mes/Año de fabricación": ""})
+    tipos = list(ESTRUCTURA_EQUIPOS)
+    equipos = []
+    for i in range(n_equipos):
+        tipo = tipos[i % len(tipos)]
+        eq = {c: f"{c} {i}" for c in ESTRUCTURA_EQUIPOS[tipo]}
+        eq["Tipo de equipo"] = tipo
+        equipos.append(eq)
+    contextos = [f"tanque_{i + 1}" for i in range(n_tanques)] + ["red_llenado", "red_consumo"]
+    actividades = [
+        {
+            "id": str(i + 1),
+            "contexto": contextos[i % len(contextos)],
+            "titulo": f"Actividad {i + 1}",
+            "tiempo": f"{rnd.randint(1, 8)}h",
+            "estado": "Completado",
+        }
+        for i in range(n_actividades)
+    ]
+    return {
+        "general": general,
+        "tanques": tanques,
+        "accesoriosTanque": accesorios_tanque,
+        "accesoriosRed": accesorios_red,
+        "equipos": equipos,
+        "observaciones": {sp: f"Observación {sp}. Detalle." for sp in ["7.1", "7.2", "7.3", "7.4", "7.5"]},
+        "actividades": actividades,
+    }
+
+
+def tokens_de_fotos(payload):
+    """
+    Tokens reales en el orden de la tabla de fotos de pagina.html (primer token de cada fila).
+    """
+    tokens = ["sub_8_establecimiento", "9_1"]
+    for i in range(len(payload["tanques"])):
+        tokens.append(f"tanque_{i + 1}_placa")
+        tokens += [f"tanque_{i + 1}_panoramica"] * 4
+        tokens += [f"tanque_{i + 1}_{s}" for s in ESPECIFICOS_TANQUE]
+    tipos_eq = {e["Tipo de equipo"] for e in payload["equipos"]}
+    for tipo in ["estabilizador", "quemador", "vaporizador", "tablero", "bomba", "dispensador_de_gas", "decantador", "detector"]:
+        if tipo in tipos_eq:
+            tokens += [f"{tipo}_placa", f"{tipo}_foto"]
+    tipos_red = {r["Tipo"] for r in payload["accesoriosRed"]}
+    if tipos_red & {"llenado_toma_desplazada", "retorno_toma_desplazada"}:
+        tokens += ["punto_trans_desplazada", "toma_desplazada_caja", "toma_desplazada_recorrido"]
+    tokens += [t for t in TIPOS_RED if t in tipos_red]
+    if "zona_medidores" in tipos_red:
+        tokens.append("zona_medidores")
+    for a in payload["actividades"]:
+        tokens += [f"{a['id']}_before", f"{a['id']}_after"]
+    tokens.append("11")
+    return tokens
+
+
+def foto_sintetica(rnd, ancho, alto, calidad=90):
+    """
+    JPEG con degradado, ruido y figuras al azar (contenido distinto en cada foto,
+    para que ni la caché ni python-docx las deduplique).
+    """
+    base = Image.linear_gradient("L").resize((ancho, alto)).convert("RGB")
+    ruido = Image.effect_noise((ancho, alto), rnd.randint(20, 60)).convert("RGB")
+    im = Image.blend(base, ruido, 0.35)
+    draw = ImageDraw.Draw(im)
+    for _ in range(12):
+        x0, y0 = rnd.randrange(ancho), rnd.randrange(alto)
+        draw.rectangle(
+            [x0, y0, x0 + rnd.randrange(ancho // 3), y0 + rnd.randrange(alto // 3)],
+            fill=(rnd.randrange(256), rnd.randrange(256), rnd.randrange(256)),
+        )
+    buf = io.BytesIO()
+    im.save(buf, "JPEG", quality=calidad)
+    return buf.getvalue()
+
+
+def construir_fotos(payload, n_fotos, ancho, alto, rnd):
+    """
+    Lista [(filename, bytes)] con el nombre ${token}_${idx}.jpg de handleGenerate.
+    """
+    tokens = tokens_de_fotos(payload)
+    por_token = {}
+    fotos = []
+    for i in range(n_fotos):
+        token = tokens[i % len(tokens)]
+        por_token[token] = por_token.get(token, 0) + 1
+        fotos.append((f"{token}_{por_token[token]}.jpg", foto_sintetica(rnd, ancho, alto)))
+    return fotos
+
+
+# ------------------------
+# Medición
+# ------------------------
+def rss_pico_mb():
+    # ru_maxrss: KiB en Linux, bytes en macOS
+    escala = 1024 * 1024 if sys.platform == "darwin" else 1024
+    propio = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / escala
+    hijos = resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss / escala
+    return {"proceso": round(propio, 1), "hijos": round(hijos, 1)}
+
+
+class Fases:
+    def __init__(self):
+        self.tiempos = {}
+
+    def medir(self, nombre):
+        fases = self
+
+        class _Ctx:
+            def __enter__(self):
+                self.t0 = time.perf_counter()
+
+            def __exit__(self, *exc):
+                fases.tiempos[nombre] = round(fases.tiempos.get(nombre, 0) + time.perf_counter() - self.t0, 4)
+
+        return _Ctx()
+
+
+def correr_directo(payload, fotos, ruta_dfs=False):
+    """
+    Fases de /generar sin HTTP: spool a disco, preproceso (pool), modelo, docx.
+    Con ruta_dfs el modelo se arma con build_dfs_from_json y el docx con
+    generar_docx_desde_dfs (entrada histórica con DataFrames).
+    """
+    fases = Fases()
+    tmpdir = tempfile.mkdtemp(prefix="bench_")
+    docx = None
+    try:
+        with fases.medir("total"):
+            with fases.medir("spool"):
+                saved = []
+                for nombre, data in fotos:
+                    path = os.path.join(tmpdir, nombre)
+                    with open(path, "wb") as fh:
+                        fh.write(data)
+                    saved.append({"field": "images", "filename": nombre, "path": path})
+            with fases.medir("validacion"):
+                errores = servidor.validar_payload(payload)
+            if errores:
+                raise ValueError(errores)
+            with fases.medir("encolar_imagenes"):
+                images = servidor.ImageIndex(imagenes.preprocess_images(saved, tmpdir)) if saved else []
+            if ruta_dfs:
+                with fases.medir("modelo"):
+                    dfs = servidor.build_dfs_from_json(payload)
+                with fases.medir("docx"):
+                    docx = servidor.generar_docx_desde_dfs(
+                        *dfs, actividades_list=payload.get("actividades"), images_list=images
+                    )
+            else:
+                with fases.medir("modelo"):
+                    informe = servidor.informe_desde_json(payload)
+                with fases.medir("docx"):
+                    docx = servidor.generar_docx(informe, images_list=images)
+        stats = imagenes.preprocess_stats(images.items()) if saved else None
+        resultado = {"fases": fases.tiempos, "docx_bytes": servidor.tamano_archivo(docx)}
+        if stats:
+            resultado["imagenes"] = {k: v for k, v in stats.items() if k != "por_imagen"}
+            resultado["imagenes"]["bytes_in"] = sum(x["bytes_in"] for x in stats["por_imagen"])
+            resultado["imagenes"]["bytes_out"] = sum(x["bytes_out"] for x in stats["por_imagen"])
+        return resultado
+    finally:
+        shutil.rmtree(tmpdir, ignore_errors=True)
+        if docx is not None:
+            docx.close()
+
+
+def correr_http(payload, fotos):
+    """
+    El mismo informe vía POST /generar (multipart) con el test client de Flask.
+    """
+    client = servidor.app.test_client()
+    data = {"json": json.dumps(payload), "images": [(io.BytesIO(b), nombre) for nombre, b in fotos]}
+    t0 = time.perf_counter()
+    resp = client.post("/generar", data=data, content_type="multipart/form-data")
+    cuerpo = resp.get_data()
+    total = time.perf_counter() - t0
+    fases = {}
+    for parte in (resp.headers.get("Server-Timing") or "").split(","):
+        nombre, _, resto = parte.strip().partition(";")
+        dur = [p[4:] for p in resto.split(";") if p.startswith("dur=")]
+        if nombre and dur:
+            fases[nombre] = round(float(dur[0]) / 1000, 4)
+    fases["total"] = round(total, 4)
+    return {
+        "status": resp.status_code,
+        "fases": fases,
+        "docx_bytes": len(cuerpo),
+    }
+
+
+def git_commit():
+    try:
+        return subprocess.check_output(
+            ["git", "rev-parse", "--short", "HEAD"], cwd=os.path.dirname(os.path.abspath(__file__)), stderr=subprocess.DEVNULL
+        ).decode().strip()
+    except Exception:
+        return None
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--tanques", type=int, default=10)
+    parser.add_argument("--equipos", type=int, default=len(ESTRUCTURA_EQUIPOS) * 2)
+    parser.add_argument("--red", type=int, default=len(TIPOS_RED) * 2)
+    parser.add_argument("--actividades", type=int, default=20)
+    parser.add_argument("--fotos", type=int, default=100)
+    parser.add_argument("--ancho", type=int, default=2000, help="ancho en px de cada foto sintética")
+    parser.add_argument("--alto", type=int, default=1500)
+    parser.add_argument("--repeticiones", type=int, default=1)
+    parser.add_argument("--modo", choices=["directo", "dfs", "http", "todos"], default="todos")
+    parser.add_argument("--con-cache", action="store_true", help="no desactivar las cachés de imágenes y de secciones")
+    parser.add_argument("--semilla", type=int, default=1234)
+    parser.add_argument("--salida", help="archivo JSON (por defecto, stdout)")
+    args = parser.parse_args(argv)
+
+    if not args.con_cache:
+        imagenes.image_cache.max_bytes = 0
+        servidor.SECCIONES_CACHE_MAX_BYTES = 0
+        # sin esto un segundo /generar idéntico sale de la caché de informes sin armar nada
+        resultados.cache.max_bytes = 0
+
+    rnd = random.Random(args.semilla)
+    t0 = time.perf_counter()
+    payload = construir_payload(args.tanques, args.equipos, args.red, args.actividades, rnd)
+    fotos = construir_fotos(payload, args.fotos, args.ancho, args.alto, rnd)
+    generacion = round(time.perf_counter() - t0, 4)
+
+    servidor.calentar()
+    corridas = []
+    for _ in range(args.repeticiones):
+        if args.modo in ("directo", "todos"):
+            corridas.append(dict(correr_directo(payload, fotos), modo="directo"))
+        if args.modo in ("dfs", "todos"):
+            corridas.append(dict(correr_directo(payload, fotos, ruta_dfs=True), modo="dfs"))
+        if args.modo in ("http", "todos"):
+            corrida = correr_http(payload, fotos)
+            faltan = [f for f in FASES_DOCX if f not in corrida["fases"]]
+            if not args.con_cache and corrida["status"] == 200 and faltan:
+                raise SystemExit("la corrida http sin caché no armó el documento (faltan fases: %s)" % ", ".join(faltan))
+            corridas.append(dict(corrida, modo="http"))
+
+    resultado = {
+        "commit": git_commit(),
+        "python": platform.python_version(),
+        "cpus": os.cpu_count(),
+        "img_workers": imagenes.IMG_WORKERS,
+        "parametros": {
+            "tanques": args.tanques,
+            "equipos": args.equipos,
+            "red": args.red,
+            "actividades": args.actividades,
+            "fotos": args.fotos,
+            "foto_px": [args.ancho, args.alto],
+            "fotos_bytes": sum(len(b) for _, b in fotos),
+            "cache": args.con_cache,
+        },
+        "generacion_datos_s": generacion,
+        "corridas": corridas,
+        "rss_pico_mb": rss_pico_mb(),
+    }
+    texto = json.dumps(resultado, indent=2, ensure_ascii=False)
+    if args.salida:
+        with open(args.salida, "w", encoding="utf-8") as fh:
+            fh.write(texto + "\n")
+    else:
+        print(texto)
+
+
+if __name__ == "__main__":
+    main()
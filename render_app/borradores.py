@@ -0,0 +1,115 @@
+import contextlib
+import json
+import os
+import sqlite3
+import tempfile
+import time
+
+# ------------------------
+# Configuración
+# ------------------------
+BORRADORES_DB = os.environ.get("BORRADORES_DB", os.path.join(tempfile.gettempdir(), "informe_borradores.sqlite3"))
+# Un borrador sin cambios en este tiempo se borra (junto con sus fotos)
+BORRADORES_TTL = int(os.environ.get("BORRADORES_TTL", 30 * 24 * 3600))
+
+# claves de primer nivel del payload de /generar que se guardan por sección
+SECCIONES = ("general", "tanques", "accesoriosTanque", "accesoriosRed", "equipos", "observaciones", "actividades", "diseno")
+
+
+@contextlib.contextmanager
+def _connect():
+    conn = sqlite3.connect(BORRADORES_DB, timeout=30, isolation_level=None)
+    try:
+        conn.row_factory = sqlite3.Row
+        conn.execute("PRAGMA journal_mode=WAL")
+        yield conn
+    finally:
+        conn.close()
+
+
+# la tabla se crea una vez por proceso, no en cada operación
+_db_lista = False
+
+
+def init_db():
+    global _db_lista
+    with _connect() as conn:
+        conn.execute(
+            """
+            CREATE TABLE IF NOT EXISTS borradores (
+                id TEXT PRIMARY KEY,
+                payload TEXT NOT NULL,
+                creado REAL NOT NULL,
+                actualizado REAL NOT NULL
+            )
+            """
+        )
+        conn.execute("CREATE INDEX IF NOT EXISTS borradores_actualizado ON borradores (actualizado)")
+    _db_lista = True
+
+
+def _asegurar_db():
+    # sin lock: init_db es idempotente, dos hilos a la vez sólo la repiten
+    if not _db_lista:
+        init_db()
+
+
+def _fila(row):
+    return {
+        "id": row["id"],
+        "payload": json.loads(row["payload"]),
+        "creado": row["creado"],
+        "actualizado": row["actualizado"],
+    }
+
+
+def obtener(borrador_id):
+    _asegurar_db()
+    with _connect() as conn:
+        row = conn.execute("SELECT * FROM borradores WHERE id = ?", (borrador_id,)).fetchone()
+    return _fila(row) if row else None
+
+
+def guardar(borrador_id, cambios):
+    """
+    Crea el borrador si no existe y reemplaza sólo las secciones presentes en
+    cambios (las demás quedan como estaban). Devuelve (borrador, secciones guardadas).
+    """
+    _asegurar_db()
+    cambios = {k: v for k, v in (cambios or {}).items() if k in SECCIONES}
+    now = time.time()
+    with _connect() as conn:
+        conn.execute("BEGIN IMMEDIATE")
+        try:
+            row = conn.execute("SELECT * FROM borradores WHERE id = ?", (borrador_id,)).fetchone()
+            payload = json.loads(row["payload"]) if row else {}
+            payload.update(cambios)
+            conn.execute(
+                "INSERT INTO borradores (id, payload, creado, actualizado) VALUES (?, ?, ?, ?) "
+                "ON CONFLICT(id) DO UPDATE SET payload = excluded.payload, actualizado = excluded.actualizado",
+                (borrador_id, json.dumps(payload), now, now),
+            )
+            row = conn.execute("SELECT * FROM borradores WHERE id = ?", (borrador_id,)).fetchone()
+            conn.execute("COMMIT")
+        except Exception:
+            conn.execute("ROLLBACK")
+            raise
+    return _fila(row), sorted(cambios)
+
+
+def borrar(borrador_id):
+    _asegurar_db()
+    with _connect() as conn:
+        conn.execute("DELETE FROM borradores WHERE id = ?", (borrador_id,))
+
+
+def purge_expired():
+    """
+    Borra los borradores vencidos y devuelve sus ids (para borrar sus fotos).
+    """
+    _asegurar_db()
+    limite = time.time() - BORRADORES_TTL
+    with _connect() as conn:
+        ids = [r["id"] for r in conn.execute("SELECT id FROM borradores WHERE actualizado < ?", (limite,))]
+        conn.execute("DELETE FROM borradores WHERE actualizado < ?", (limite,))
+    return ids
@@ -0,0 +1,13 @@
+import os
+
+bind = f"0.0.0.0:{os.environ.get('PORT', 5000)}"
+# se importa y calienta wsgi.py en el maestro antes de crear los workers
+preload_app = True
+workers = int(os.environ.get("WEB_CONCURRENCY", 2))
+worker_class = "gthread"
+threads = int(os.environ.get("GUNICORN_THREADS", 4))
+# los informes grandes pueden tardar varios minutos
+timeout = int(os.environ.get("GUNICORN_TIMEOUT", 300))
+graceful_timeout = 30
+keepalive = 5
+accesslog = "-"
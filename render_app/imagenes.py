@@ -0,0 +1,595 @@
+import contextlib
+import hashlib
+import logging
+import math
+import multiprocessing
+import os
+import shutil
+import tempfile
+import threading
+import time
+from concurrent.futures import Future, ProcessPoolExecutor
+
+from PIL import Image, ImageOps
+
+# HEIC/HEIF (fotos de iPhone) sólo si pillow-heif está instalado
+try:
+    from pillow_heif import register_heif_opener
+
+    register_heif_opener()
+except Exception:
+    pass
+
+
+# ------------------------
+# Configuración
+# ------------------------
+# Resolución con la que se calcula el tamaño en píxeles de cada recuadro
+IMG_DPI = int(os.environ.get("IMG_DPI", 150))
+# Calidad JPEG de re-codificación (1-95)
+IMG_JPEG_QUALITY = int(os.environ.get("IMG_JPEG_QUALITY", 80))
+
+# Procesos para preparar imágenes (por defecto, los núcleos disponibles)
+try:
+    _CPUS = len(os.sched_getaffinity(0))
+except AttributeError:
+    _CPUS = os.cpu_count() or 1
+IMG_WORKERS = int(os.environ.get("IMG_WORKERS", _CPUS))
+
+# Caché en disco de imágenes ya procesadas (0 desactiva)
+IMG_CACHE_DIR = os.environ.get("IMG_CACHE_DIR", os.path.join(tempfile.gettempdir(), "informe_img_cache"))
+IMG_CACHE_MAX_BYTES = int(os.environ.get("IMG_CACHE_MAX_BYTES", 512 * 1024 * 1024))
+# Cada proceso lleva la cuenta de bytes de la caché y recorre el directorio sólo al pasarse
+# del límite o cada tantos puts / segundos (otros procesos también escriben)
+IMG_CACHE_RECUENTO_PUTS = int(os.environ.get("IMG_CACHE_RECUENTO_PUTS", 200))
+IMG_CACHE_RECUENTO_S = float(os.environ.get("IMG_CACHE_RECUENTO_S", 60))
+# Al pasarse del límite se borra hasta esta fracción, para no recorrer el directorio en cada put
+IMG_CACHE_BAJAR_A = 0.9
+
+# Recuadro por defecto de insert_images_one_per_line
+SLOT_ANCHO_CM = 15
+SLOT_ALTO_CM = 10
+
+# Topes leídos de la cabecera, antes de decodificar: píxeles de cada foto y de
+# todas las fotos de una petición
+IMG_MAX_PIXELS = int(os.environ.get("IMG_MAX_PIXELS", 250_000_000))
+IMG_MAX_PIXELES_PETICION = int(os.environ.get("IMG_MAX_PIXELES_PETICION", 4_000_000_000))
+# Píxeles decodificados a la vez entre todas las peticiones (~3 bytes por píxel en RGB)
+IMG_PIXELES_EN_VUELO = int(os.environ.get("IMG_PIXELES_EN_VUELO", 64_000_000))
+# Segundos que una foto espera lugar en ese presupuesto antes de darse por fallida
+IMG_ESPERA_PRESUPUESTO = float(os.environ.get("IMG_ESPERA_PRESUPUESTO", 120))
+
+# El tope de Pillow queda en IMG_MAX_PIXELS: lo que se abra sin pasar por la
+# revisión de cabecera sigue protegido (con más del doble ni siquiera abre)
+Image.MAX_IMAGE_PIXELS = IMG_MAX_PIXELS
+
+logger = logging.getLogger(__name__)
+
+
+# ------------------------
+# Presupuesto global de píxeles decodificados
+# ------------------------
+class PresupuestoAgotado(RuntimeError):
+    pass
+
+
+class PresupuestoPixeles:
+    """
+    Tope de píxeles decodificados a la vez entre todas las peticiones. El
+    contador vive en memoria compartida: lo heredan los procesos creados
+    desde el que importa este módulo (workers de gunicorn con --preload,
+    trabajos.py) y los pools lo reciben en su initializer.
+    Una foto más grande que el tope entero espera a tenerlo para ella sola.
+    """
+
+    def __init__(self, max_pixeles, espera):
+        self.max_pixeles = max_pixeles
+        self.espera = espera
+        self._cond = multiprocessing.Condition()
+        self._en_uso = multiprocessing.RawValue("q", 0)
+
+    @contextlib.contextmanager
+    def reservar(self, pixeles):
+        pixeles = min(pixeles, self.max_pixeles)
+        with self._cond:
+            if not self._cond.wait_for(lambda: self._en_uso.value + pixeles <= self.max_pixeles, self.espera):
+                raise PresupuestoAgotado(f"Sin lugar para decodificar {pixeles} píxeles en {self.espera:g} s")
+            self._en_uso.value += pixeles
+        try:
+            yield
+        finally:
+            with self._cond:
+                self._en_uso.value -= pixeles
+                self._cond.notify_all()
+
+
+presupuesto = PresupuestoPixeles(IMG_PIXELES_EN_VUELO, IMG_ESPERA_PRESUPUESTO)
+
+
+def heredar_presupuesto(compartido):
+    """
+    initializer de los pools de procesos: usa el presupuesto del proceso padre
+    (necesario si el pool no arranca con fork).
+    """
+    global presupuesto
+    presupuesto = compartido
+
+
+_pool = None
+_pool_lock = threading.Lock()
+
+
+def get_pool():
+    """
+    Pool de procesos compartido por todas las peticiones (se crea al primer uso).
+    """
+    global _pool
+    with _pool_lock:
+        if _pool is None:
+            _pool = ProcessPoolExecutor(
+                max_workers=max(1, IMG_WORKERS), initializer=heredar_presupuesto, initargs=(presupuesto,)
+            )
+        return _pool
+
+
+def _reset_pool_in_child():
+    # un proceso hijo (p. ej. los workers de trabajos.py) no puede reutilizar el pool del padre
+    global _pool, _pool_lock
+    _pool = None
+    _pool_lock = threading.Lock()
+
+
+if hasattr(os, "register_at_fork"):
+    os.register_at_fork(after_in_child=_reset_pool_in_child)
+
+
+# ------------------------
+# Caché de imágenes procesadas
+# ------------------------
+def file_sha256(path):
+    h = hashlib.sha256()
+    with open(path, "rb") as fh:
+        for chunk in iter(lambda: fh.read(1024 * 1024), b""):
+            h.update(chunk)
+    return h.hexdigest()
+
+
+def file_sha1(path):
+    # el digest con que python-docx deduplica las imágenes de un documento
+    h = hashlib.sha1()
+    with open(path, "rb") as fh:
+        for chunk in iter(lambda: fh.read(1024 * 1024), b""):
+            h.update(chunk)
+    return h.hexdigest()
+
+
+class ImageCache:
+    """
+    Caché direccionada por contenido: la clave es el SHA-256 del archivo subido
+    más la geometría del recuadro (y DPI/calidad), así un reenvío de la misma
+    foto no vuelve a decodificarse. Vive en disco para compartirse entre
+    procesos; el LRU usa el mtime de cada archivo (se actualiza en cada acierto)
+    y al superar max_bytes se borran los menos usados. El total de bytes se
+    lleva en memoria: put() sólo recorre el directorio al pasarse del límite o
+    cada IMG_CACHE_RECUENTO_PUTS puts / IMG_CACHE_RECUENTO_S segundos.
+    Los contadores son del proceso que llama a record().
+    ext: extensión de las entradas (resultados.py la usa para los docx).
+    """
+
+    def __init__(self, directory, max_bytes, ext=".jpg"):
+        self.directory = directory
+        self.max_bytes = max_bytes
+        self.ext = ext
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self._lock = threading.Lock()
+        # bytes en disco según este proceso (None: hay que recorrer el directorio)
+        self._total = None
+        self._puts = 0
+        self._recuento = 0.0
+        if hasattr(os, "register_at_fork"):
+            # put() corre en los workers del pool: el hijo no puede heredar el lock tomado
+            os.register_at_fork(after_in_child=self._reset_en_hijo)
+
+    def _reset_en_hijo(self):
+        self._lock = threading.Lock()
+        self._total = None
+
+    @property
+    def enabled(self):
+        return self.max_bytes > 0
+
+    def _path(self, key):
+        return os.path.join(self.directory, key[:2], key + self.ext)
+
+    def get(self, key, dst):
+        """
+        Copia (o enlaza) la entrada key en dst. Devuelve True si había acierto.
+        """
+        if not self.enabled:
+            return False
+        path = self._path(key)
+        try:
+            os.utime(path)
+        except OSError:
+            return False
+        try:
+            os.link(path, dst)
+        except OSError:
+            try:
+                shutil.copyfile(path, dst)
+            except OSError:
+                return False
+        return True
+
+    def open(self, key):
+        """
+        La entrada key abierta para lectura (y marcada como usada), o None.
+        """
+        if not self.enabled:
+            return None
+        try:
+            fh = open(self._path(key), "rb")
+        except OSError:
+            return None
+        try:
+            os.utime(fh.fileno())
+        except OSError:
+            pass
+        return fh
+
+    def put(self, key, src):
+        """
+        Guarda src (ruta o archivo abierto, desde su posición actual) bajo key
+        y aplica el presupuesto. Devuelve cuántas entradas se desalojaron.
+        """
+        if not self.enabled:
+            return 0
+        path = self._path(key)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        fd, tmp = tempfile.mkstemp(dir=os.path.dirname(path), suffix=".part")
+        os.close(fd)
+        try:
+            if hasattr(src, "read"):
+                with open(tmp, "wb") as fh:
+                    shutil.copyfileobj(src, fh, 1024 * 1024)
+            else:
+                shutil.copyfile(src, tmp)
+            try:
+                previo = os.path.getsize(path)
+            except OSError:
+                previo = 0
+            delta = os.path.getsize(tmp) - previo
+            os.replace(tmp, path)
+        except OSError:
+            try:
+                os.remove(tmp)
+            except OSError:
+                pass
+            return 0
+        with self._lock:
+            self._puts += 1
+            al_dia = (
+                self._total is not None
+                and self._puts < IMG_CACHE_RECUENTO_PUTS
+                and time.monotonic() - self._recuento < IMG_CACHE_RECUENTO_S
+            )
+            if al_dia:
+                self._total += delta
+                if self._total <= self.max_bytes:
+                    return 0
+        return self.evict()
+
+    def entries(self):
+        out = []
+        if not os.path.isdir(self.directory):
+            return out
+        for sub in os.scandir(self.directory):
+            if not sub.is_dir():
+                continue
+            for e in os.scandir(sub.path):
+                if e.name.endswith(self.ext):
+                    try:
+                        st = e.stat()
+                    except OSError:
+                        continue
+                    out.append((st.st_mtime, st.st_size, e.path))
+        return out
+
+    def size_bytes(self):
+        return sum(size for _, size, _ in self.entries())
+
+    def evict(self):
+        """
+        Recorre el directorio y, si se pasó de max_bytes, borra las entradas
+        menos usadas hasta IMG_CACHE_BAJAR_A de max_bytes; deja el total al día.
+        Devuelve cuántas borró.
+        """
+        entries = self.entries()
+        total = sum(size for _, size, _ in entries)
+        borradas = 0
+        if total > self.max_bytes:
+            for _, size, path in sorted(entries):
+                if total <= self.max_bytes * IMG_CACHE_BAJAR_A:
+                    break
+                try:
+                    os.remove(path)
+                except OSError:
+                    continue
+                total -= size
+                borradas += 1
+        with self._lock:
+            self._total = total
+            self._puts = 0
+            self._recuento = time.monotonic()
+        return borradas
+
+    def record(self, hit, evicted=0):
+        with self._lock:
+            if hit:
+                self.hits += 1
+            else:
+                self.misses += 1
+            self.evictions += evicted
+
+    def stats(self):
+        with self._lock:
+            return {"hits": self.hits, "misses": self.misses, "evictions": self.evictions}
+
+
+image_cache = ImageCache(IMG_CACHE_DIR, IMG_CACHE_MAX_BYTES)
+
+
+def cache_key(digest, ancho_cm, alto_cm, dpi=None, quality=None):
+    return f"{digest}_{ancho_cm:g}x{alto_cm:g}cm_{dpi or IMG_DPI}dpi_q{quality or IMG_JPEG_QUALITY}"
+
+
+def slot_pixels(ancho_cm=SLOT_ANCHO_CM, alto_cm=SLOT_ALTO_CM, dpi=None):
+    """
+    Tamaño en píxeles (ancho, alto) que necesita un recuadro de ancho_cm x alto_cm.
+    """
+    dpi = dpi or IMG_DPI
+    return (
+        max(1, int(round(ancho_cm / 2.54 * dpi))),
+        max(1, int(round(alto_cm / 2.54 * dpi))),
+    )
+
+
+def dimensiones(path):
+    """
+    (ancho, alto) leyendo sólo la cabecera, o None si Pillow no reconoce el archivo.
+    Con más del doble de IMG_MAX_PIXELS Pillow no la abre: lanza DecompressionBombError.
+    """
+    try:
+        with Image.open(path) as im:
+            return im.size
+    except Image.DecompressionBombError:
+        raise
+    except Exception:
+        return None
+
+
+def demasiados_pixeles(nombre, pixeles=None):
+    """
+    Mensaje de error de una foto que supera IMG_MAX_PIXELS (pixeles None: ni se pudo abrir).
+    """
+    tiene = f"tiene {pixeles / 1e6:.0f} MP" if pixeles else f"tiene más de {2 * IMG_MAX_PIXELS / 1e6:.0f} MP"
+    return f"La foto {nombre} {tiene} (máximo {IMG_MAX_PIXELS / 1e6:.0f} MP)"
+
+
+def revisar_pixeles(images_list):
+    """
+    Topes por cabecera (sin decodificar nada): IMG_MAX_PIXELS por foto e
+    IMG_MAX_PIXELES_PETICION para todas juntas. Devuelve la lista de errores
+    ({'error': ...}); los archivos que no son imágenes no cuentan.
+    """
+    errores = []
+    total = 0
+    for item in images_list:
+        try:
+            size = dimensiones(item["path"])
+        except Image.DecompressionBombError:
+            errores.append({"error": demasiados_pixeles(item["filename"])})
+            continue
+        if size is None:
+            continue
+        pixeles = size[0] * size[1]
+        total += pixeles
+        if pixeles > IMG_MAX_PIXELS:
+            errores.append({"error": demasiados_pixeles(item["filename"], pixeles)})
+    if total > IMG_MAX_PIXELES_PETICION:
+        errores.append(
+            {"error": f"Las fotos suman {total / 1e6:.0f} MP (máximo {IMG_MAX_PIXELES_PETICION / 1e6:.0f} MP por informe)"}
+        )
+    return errores
+
+
+def _orientacion_girada(im):
+    # orientaciones EXIF 5-8: exif_transpose intercambia ancho y alto
+    try:
+        return im.getexif().get(0x0112) in (5, 6, 7, 8)
+    except Exception:
+        return False
+
+
+def prepare_image(src, dst, ancho_cm=SLOT_ANCHO_CM, alto_cm=SLOT_ALTO_CM, dpi=None, quality=None):
+    """
+    Normaliza una foto para insertarla en el docx:
+      - aplica la orientación EXIF,
+      - reduce (nunca amplía) hasta cubrir el recuadro a la resolución indicada,
+        conservando la proporción original (Word la estira al recuadro igual que antes),
+      - descarta metadatos y re-codifica a JPEG con la calidad indicada.
+    Cualquier formato que Pillow pueda abrir (PNG, WebP, GIF, BMP, HEIC...) se convierte.
+    Los JPEG se decodifican ya reducidos (1/2, 1/4 u 1/8) cuando sobra resolución,
+    y toda decodificación reserva antes su lugar en el presupuesto global.
+    Devuelve dst.
+    """
+    quality = quality or IMG_JPEG_QUALITY
+    w_px, h_px = slot_pixels(ancho_cm, alto_cm, dpi)
+    with Image.open(src) as im:
+        if im.width * im.height > IMG_MAX_PIXELS:
+            raise ValueError(f"{src}: {im.width}x{im.height} supera IMG_MAX_PIXELS")
+        ancho, alto = (im.height, im.width) if _orientacion_girada(im) else im.size
+        escala = max(w_px / ancho, h_px / alto)
+        if escala < 1:
+            # sólo tiene efecto en JPEG; deja im.size en lo que se va a decodificar
+            im.draft("RGB", (math.ceil(im.width * escala), math.ceil(im.height * escala)))
+        with presupuesto.reservar(im.width * im.height):
+            im = ImageOps.exif_transpose(im)
+            if im.mode in ("RGBA", "LA") or (im.mode == "P" and "transparency" in im.info):
+                rgba = im.convert("RGBA")
+                fondo = Image.new("RGB", rgba.size, (255, 255, 255))
+                fondo.paste(rgba, mask=rgba.split()[-1])
+                im = fondo
+            elif im.mode != "RGB":
+                im = im.convert("RGB")
+            escala = max(w_px / im.width, h_px / im.height)
+            if escala < 1:
+                nuevo = (max(1, int(round(im.width * escala))), max(1, int(round(im.height * escala))))
+                im = im.resize(nuevo, Image.LANCZOS)
+            im.save(dst, "JPEG", quality=quality, optimize=True)
+    return dst
+
+
+def _prepare_timed(src, dst, ancho_cm, alto_cm):
+    """
+    Tarea del pool: busca en la caché y si no está aplica prepare_image.
+    Devuelve tiempos (epoch, comparables entre procesos) y el resultado de caché.
+    """
+    inicio = time.time()
+    digest = file_sha256(src)
+    key = cache_key(digest, ancho_cm, alto_cm)
+    hit = image_cache.get(key, dst)
+    evicted = 0
+    if not hit:
+        prepare_image(src, dst, ancho_cm=ancho_cm, alto_cm=alto_cm)
+        evicted = image_cache.put(key, dst)
+    return {
+        "path": dst,
+        "sha256": digest,
+        "cache_hit": hit,
+        "evicted": evicted,
+        "inicio": inicio,
+        "fin": time.time(),
+        "bytes_in": os.path.getsize(src),
+        "bytes_out": os.path.getsize(dst),
+    }
+
+
+def _record_cache(future):
+    if not future.cancelled() and future.exception() is None:
+        r = future.result()
+        image_cache.record(r["cache_hit"], r["evicted"])
+
+
+def preprocess_images(images_list, tmpdir, ancho_cm=SLOT_ANCHO_CM, alto_cm=SLOT_ALTO_CM):
+    """
+    Etapa entre save_uploaded_files_tmp y el armado del documento: encola cada
+    imagen guardada en el pool de procesos y devuelve enseguida la lista de
+    dicts con una clave 'future' adicional. El documento se sigue armando
+    mientras tanto; resolve_image espera sólo cuando la imagen se necesita.
+    """
+    outdir = os.path.join(tmpdir, "procesadas")
+    os.makedirs(outdir, exist_ok=True)
+    pool = get_pool()
+    enviado = time.time()
+    out = []
+    for n, item in enumerate(images_list):
+        dst = os.path.join(outdir, f"{n}.jpg")
+        future = pool.submit(_prepare_timed, item["path"], dst, ancho_cm, alto_cm)
+        future.add_done_callback(_record_cache)
+        out.append(dict(item, future=future, enviado=enviado))
+    return out
+
+
+def preprocess_images_local(images_list, tmpdir, ancho_cm=SLOT_ANCHO_CM, alto_cm=SLOT_ALTO_CM):
+    """
+    Igual que preprocess_images pero en el proceso actual y en serie, para
+    código que ya corre dentro de un pool (p. ej. los informes de /generar/lote).
+    Devuelve la misma forma: cada dict con un 'future' ya resuelto.
+    """
+    outdir = os.path.join(tmpdir, "procesadas")
+    os.makedirs(outdir, exist_ok=True)
+    enviado = time.time()
+    out = []
+    for n, item in enumerate(images_list):
+        future = Future()
+        try:
+            future.set_result(_prepare_timed(item["path"], os.path.join(outdir, f"{n}.jpg"), ancho_cm, alto_cm))
+        except Exception as e:
+            future.set_exception(e)
+        _record_cache(future)
+        out.append(dict(item, future=future, enviado=enviado))
+    return out
+
+
+def resolve_image(item):
+    """
+    Ruta a insertar para un dict de imagen: la procesada si el future terminó bien,
+    o el archivo original si no hubo preproceso o éste falló.
+    """
+    future = item.get("future")
+    if future is None:
+        return item["path"]
+    try:
+        return future.result()["path"]
+    except Exception:
+        logger.warning("No se pudo procesar %s; se usa el original", item.get("filename"))
+        return item["path"]
+
+
+def preprocess_stats(images_list):
+    """
+    Resumen de tiempos del preproceso: por imagen (segundos de CPU en su proceso)
+    y total de pared desde que se encoló el lote hasta que terminó la última.
+    """
+    por_imagen = []
+    enviado = None
+    fin = None
+    for item in images_list:
+        future = item.get("future")
+        if future is None or not future.done() or future.cancelled() or future.exception():
+            continue
+        r = future.result()
+        enviado = item["enviado"] if enviado is None else min(enviado, item["enviado"])
+        fin = r["fin"] if fin is None else max(fin, r["fin"])
+        por_imagen.append(
+            {
+                "filename": item.get("filename"),
+                "segundos": round(r["fin"] - r["inicio"], 4),
+                "bytes_in": r["bytes_in"],
+                "bytes_out": r["bytes_out"],
+                "cache_hit": r["cache_hit"],
+            }
+        )
+    return {
+        "imagenes": len(por_imagen),
+        "procesos": IMG_WORKERS,
+        "segundos_cpu": round(sum(x["segundos"] for x in por_imagen), 4),
+        "segundos_pared": round(fin - enviado, 4) if por_imagen else 0.0,
+        "cache_hits": sum(1 for x in por_imagen if x["cache_hit"]),
+        "por_imagen": por_imagen,
+    }
+
+
+def log_preprocess_stats(images_list):
+    stats = preprocess_stats(images_list)
+    for x in stats["por_imagen"]:
+        logger.debug(
+            "imagen %s: %.3fs (%d -> %d bytes)%s",
+            x["filename"],
+            x["segundos"],
+            x["bytes_in"],
+            x["bytes_out"],
+            " [caché]" if x["cache_hit"] else "",
+        )
+    logger.info(
+        "preproceso: %d imágenes (%d desde caché), %d procesos, %.2fs CPU, %.2fs de pared",
+        stats["imagenes"],
+        stats["cache_hits"],
+        stats["procesos"],
+        stats["segundos_cpu"],
+        stats["segundos_pared"],
+    )
+    return stats
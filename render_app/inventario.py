@@ -0,0 +1,168 @@
+"""
+Ingesta de inventarios (CSV/XLSX) para generar informes pre-llenados.
+
+El inventario trae una fila por tanque con los datos de la instalación
+repetidos; las filas de una misma instalación deben venir juntas (como salen
+al ordenar la hoja por número de instalación). Todo es un pipeline de
+generadores: se lee por bloques de INVENTARIO_CHUNK filas, se agrupan
+instalaciones consecutivas y se arma un payload de /generar por instalación,
+así la memoria no depende del largo de la hoja.
+"""
+import os
+import unicodedata
+
+from modelo import CAMPOS_GENERALES
+
+# Filas leídas por bloque
+INVENTARIO_CHUNK = int(os.environ.get("INVENTARIO_CHUNK", 1000))
+
+
+def _clave(texto):
+    # 'N° de serie' -> 'n_de_serie'
+    texto = unicodedata.normalize("NFKD", str(texto or "").strip().lower()).encode("ascii", "ignore").decode("ascii")
+    return "_".join("".join(c if c.isalnum() else " " for c in texto).split())
+
+
+def _alias(*nombres):
+    return {_clave(n) for n in nombres}
+
+
+# campo de 'general' -> encabezados aceptados
+COLUMNAS_GENERAL = {
+    "Nombre o razón social del cliente": _alias("Nombre o razón social del cliente", "Cliente", "Razón social"),
+    "Fecha de inspección": _alias("Fecha de inspección", "Fecha"),
+    "Dirección": _alias("Dirección", "Direccion"),
+    "RUC o DNI": _alias("RUC o DNI", "RUC", "DNI"),
+    "Número de instalación": _alias("Número de instalación", "N° de instalación", "Instalación", "Código de instalación"),
+    "Distrito": _alias("Distrito"),
+    "Departamento": _alias("Departamento"),
+    "Coordenadas": _alias("Coordenadas"),
+    "Nombre del contacto": _alias("Nombre del contacto", "Contacto"),
+    "Número del contacto": _alias("Número del contacto", "Teléfono", "Celular"),
+    "Correo de contacto": _alias("Correo de contacto", "Correo", "Email"),
+}
+
+# campo de tanques[] (buildPayload) -> encabezados aceptados
+COLUMNAS_TANQUE = {
+    "serie": _alias("serie", "N° de serie", "Serie del tanque"),
+    "capacidad": _alias("capacidad", "Capacidad (gal)", "Capacidad"),
+    "anio": _alias("anio", "Año de fabricación", "Año"),
+    "tipo": _alias("tipo", "Tipo de tanque"),
+    "fabricante": _alias("fabricante", "Fabricante de Tanque"),
+    "porcentaje": _alias("porcentaje", "% Actual"),
+}
+
+
+def mapa_columnas(encabezados):
+    """
+    encabezados de la hoja -> {encabezado: ('general'|'tanque', campo)}; las
+    columnas que no se reconocen se ignoran.
+    """
+    destinos = [("general", c, a) for c, a in COLUMNAS_GENERAL.items()]
+    destinos += [("tanque", c, a) for c, a in COLUMNAS_TANQUE.items()]
+    mapa = {}
+    for enc in encabezados:
+        k = _clave(enc)
+        for grupo, campo, alias in destinos:
+            if k in alias:
+                mapa[enc] = (grupo, campo)
+                break
+    return mapa
+
+
+def _texto(v):
+    if v is None or (isinstance(v, float) and v != v):
+        return ""
+    if isinstance(v, float) and v.is_integer():
+        return str(int(v))
+    if hasattr(v, "strftime"):
+        return v.strftime("%d/%m/%Y")
+    return str(v).strip()
+
+
+# ------------------------
+# Lectura por bloques
+# ------------------------
+def filas_csv(path, chunk=None):
+    import pandas as pd
+
+    for bloque in pd.read_csv(path, chunksize=chunk or INVENTARIO_CHUNK, dtype=str, keep_default_na=False, sep=None, engine="python"):
+        yield from bloque.to_dict(orient="records")
+
+
+def filas_xlsx(path, chunk=None):
+    # openpyxl en modo read_only recorre la hoja sin cargarla entera
+    # (pandas.read_excel no lee por bloques)
+    try:
+        from openpyxl import load_workbook
+    except ImportError:
+        raise ValueError("Para leer inventarios .xlsx hace falta instalar openpyxl")
+
+    wb = load_workbook(path, read_only=True, data_only=True)
+    try:
+        filas = wb.active.iter_rows(values_only=True)
+        encabezados = [str(c) if c is not None else "" for c in next(filas, [])]
+        for fila in filas:
+            if fila is None or all(v is None for v in fila):
+                continue
+            yield dict(zip(encabezados, fila))
+    finally:
+        wb.close()
+
+
+def leer_filas(path, nombre=None, chunk=None):
+    ext = os.path.splitext(nombre or path)[1].lower()
+    if ext in (".xlsx", ".xlsm"):
+        return filas_xlsx(path, chunk)
+    if ext in (".csv", ".txt", ""):
+        return filas_csv(path, chunk)
+    raise ValueError(f"Formato de inventario no soportado: {ext} (se acepta CSV o XLSX)")
+
+
+# ------------------------
+# Filas -> payloads de /generar
+# ------------------------
+def _clave_instalacion(general):
+    return general.get("Número de instalación") or (
+        general.get("Nombre o razón social del cliente"),
+        general.get("RUC o DNI"),
+        general.get("Dirección"),
+    )
+
+
+def payloads(filas, base=None):
+    """
+    Agrupa filas consecutivas de la misma instalación y produce un payload de
+    /generar por instalación (general + tanques). base: payload opcional cuyos
+    valores completan lo que la hoja no trae (observaciones, equipos...).
+    """
+    base = base or {}
+    mapa = None
+    actual = None
+    clave_actual = None
+    for fila in filas:
+        if mapa is None:
+            mapa = mapa_columnas(fila.keys())
+        general = dict(base.get("general") or {})
+        tanque = {}
+        for enc, (grupo, campo) in mapa.items():
+            valor = _texto(fila.get(enc))
+            if grupo == "general":
+                if valor:
+                    general[campo] = valor
+            else:
+                tanque[campo] = valor
+        clave = _clave_instalacion(general)
+        if actual is None or clave != clave_actual:
+            if actual is not None:
+                yield actual
+            actual = dict(base, general={c: general.get(c, "") for c in CAMPOS_GENERALES}, tanques=[])
+            clave_actual = clave
+        if any(tanque.values()):
+            actual["tanques"].append(tanque)
+    if actual is not None:
+        yield actual
+
+
+def payloads_desde_archivo(path, nombre=None, base=None, chunk=None):
+    return payloads(leer_filas(path, nombre, chunk), base)
@@ -0,0 +1,173 @@
+import io
+import json
+import logging
+import os
+import re
+import shutil
+import threading
+import time
+import zipfile
+from concurrent.futures import FIRST_COMPLETED, ProcessPoolExecutor, wait
+
+import imagenes
+
+# ------------------------
+# Configuración
+# ------------------------
+try:
+    _CPUS = len(os.sched_getaffinity(0))
+except AttributeError:
+    _CPUS = os.cpu_count() or 1
+# Procesos que generan informes de /generar/lote en paralelo
+LOTE_WORKERS = int(os.environ.get("LOTE_WORKERS", _CPUS))
+# Informes por lote como máximo
+LOTE_MAX_INFORMES = int(os.environ.get("LOTE_MAX_INFORMES", 100))
+# Informes encolados a la vez en el pool; el resto se lee de la entrada a medida que terminan
+LOTE_EN_VUELO = int(os.environ.get("LOTE_EN_VUELO", 2 * LOTE_WORKERS))
+
+# images_3, images[3] -> fotos del informe 3 (índice en la lista 'json')
+CAMPO_IMAGENES_RE = re.compile(r"^images(?:_(\d+)|\[(\d+)\])$")
+
+logger = logging.getLogger(__name__)
+
+_pool = None
+_pool_lock = threading.Lock()
+
+
+def get_pool():
+    """
+    Pool de procesos para lotes (distinto del de imágenes: cada informe del lote
+    prepara sus fotos dentro de su propio proceso, con el mismo presupuesto de
+    píxeles que el resto).
+    """
+    global _pool
+    with _pool_lock:
+        if _pool is None:
+            _pool = ProcessPoolExecutor(
+                max_workers=max(1, LOTE_WORKERS),
+                initializer=imagenes.heredar_presupuesto,
+                initargs=(imagenes.presupuesto,),
+            )
+        return _pool
+
+
+def _reset_pool_in_child():
+    global _pool, _pool_lock
+    _pool = None
+    _pool_lock = threading.Lock()
+
+
+if hasattr(os, "register_at_fork"):
+    os.register_at_fork(after_in_child=_reset_pool_in_child)
+
+
+def indice_de_campo(campo):
+    m = CAMPO_IMAGENES_RE.match(campo or "")
+    if not m:
+        return None
+    return int(m.group(1) or m.group(2))
+
+
+def nombre_entrada(indice, payload, normalizar):
+    """
+    Nombre del docx dentro del zip: número de orden + instalación o cliente.
+    """
+    general = payload.get("general") if isinstance(payload, dict) else None
+    general = general if isinstance(general, dict) else {}
+    base = normalizar(general.get("Número de instalación") or general.get("Nombre o razón social del cliente"))
+    base = re.sub(r"[^a-z0-9_-]+", "", base)[:60]
+    return f"{indice + 1:03d}_{base or 'informe'}.docx"
+
+
+class _SalidaZip(io.RawIOBase):
+    """
+    Destino no posicionable para zipfile: acumula lo escrito hasta vaciar().
+    """
+
+    def __init__(self):
+        super().__init__()
+        self._partes = []
+
+    def writable(self):
+        return True
+
+    def write(self, b):
+        self._partes.append(bytes(b))
+        return len(b)
+
+    def vaciar(self):
+        data = b"".join(self._partes)
+        self._partes.clear()
+        return data
+
+
+def _ejecutar(render, payload, images, images_dir, destino):
+    # tarea del pool: render(payload, images, images_dir, destino) escribe el docx
+    inicio = time.perf_counter()
+    render(payload, images, images_dir, destino)
+    return {"segundos": round(time.perf_counter() - inicio, 3), "bytes": os.path.getsize(destino)}
+
+
+def generar_zip(items, render, tmpdir):
+    """
+    Genera (en trozos de bytes) un zip con un docx por informe, en el orden en
+    que van terminando, y al final 'manifiesto.json' con el estado de cada uno.
+    items: iterable (puede ser un generador) de dicts
+    {indice, nombre, payload, images, images_dir, errores}; se consume a medida
+    que hay lugar en el pool (como máximo LOTE_EN_VUELO informes a la vez).
+    Los que traen errores de validación no se generan y sólo van al manifiesto.
+    render debe ser una función de nivel de módulo (se envía al pool).
+    tmpdir pasa a ser del generador: se borra al terminar o si el cliente corta.
+    """
+    salida = _SalidaZip()
+    manifiesto = []
+    pendientes = {}
+    inicio = time.perf_counter()
+
+    def recoger(zf, hasta):
+        # escribe en el zip los informes terminados hasta dejar <= hasta en vuelo
+        while len(pendientes) > hasta:
+            hechos, _ = wait(pendientes, return_when=FIRST_COMPLETED)
+            for future in hechos:
+                item, destino = pendientes.pop(future)
+                entrada = {"indice": item["indice"]}
+                try:
+                    r = future.result()
+                    # los docx ya vienen comprimidos: se guardan sin recomprimir
+                    zf.write(destino, item["nombre"])
+                    entrada.update(estado="ok", archivo=item["nombre"], **r)
+                except Exception as e:
+                    logger.exception("Lote: falló el informe %s", item["indice"])
+                    entrada.update(estado="error", error=str(e))
+                finally:
+                    if os.path.exists(destino):
+                        os.remove(destino)
+                manifiesto.append(entrada)
+                yield salida.vaciar()
+
+    try:
+        with zipfile.ZipFile(salida, "w", compression=zipfile.ZIP_STORED, allowZip64=True) as zf:
+            pool = get_pool()
+            for item in items:
+                if item["errores"]:
+                    manifiesto.append({"indice": item["indice"], "estado": "invalido", "errores": item["errores"]})
+                    continue
+                destino = os.path.join(tmpdir, f"informe_{item['indice']}.docx")
+                future = pool.submit(_ejecutar, render, item["payload"], item["images"], item["images_dir"], destino)
+                pendientes[future] = (item, destino)
+                yield from recoger(zf, max(1, LOTE_EN_VUELO) - 1)
+            yield from recoger(zf, 0)
+
+            manifiesto.sort(key=lambda x: x["indice"])
+            resumen = {
+                "total": len(manifiesto),
+                "ok": sum(1 for x in manifiesto if x["estado"] == "ok"),
+                "segundos": round(time.perf_counter() - inicio, 3),
+                "informes": manifiesto,
+            }
+            zf.writestr("manifiesto.json", json.dumps(resumen, ensure_ascii=False, indent=2))
+        yield salida.vaciar()
+    finally:
+        for future in pendientes:
+            future.cancel()
+        shutil.rmtree(tmpdir, ignore_errors=True)
@@ -0,0 +1,248 @@
+import bisect
+import contextlib
+import contextvars
+import threading
+import time
+import unicodedata
+
+# ------------------------
+# Métricas en formato Prometheus (sin dependencias)
+# ------------------------
+# Cada proceso lleva sus propios contadores: con gunicorn, /metrics muestra los
+# del worker que atiende la petición (Prometheus los agrega por instancia).
+_registro = []
+
+
+def _etiquetas(nombres, valores):
+    if not nombres:
+        return ""
+    pares = []
+    for n, v in zip(nombres, valores):
+        v = str(v).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+        pares.append(f'{n}="{v}"')
+    return "{" + ",".join(pares) + "}"
+
+
+class _Metrica:
+    tipo = None
+
+    def __init__(self, nombre, ayuda, etiquetas=()):
+        self.nombre = nombre
+        self.ayuda = ayuda
+        self.etiquetas = tuple(etiquetas)
+        self._valores = {}
+        self._lock = threading.Lock()
+        _registro.append(self)
+
+    def _clave(self, labels):
+        return tuple(str(labels.get(n, "")) for n in self.etiquetas)
+
+    def exponer(self):
+        lineas = [f"# HELP {self.nombre} {self.ayuda}", f"# TYPE {self.nombre} {self.tipo}"]
+        with self._lock:
+            for clave, valor in sorted(self._valores.items()):
+                lineas += self._lineas(clave, valor)
+        return lineas
+
+    def _lineas(self, clave, valor):
+        return [f"{self.nombre}{_etiquetas(self.etiquetas, clave)} {valor:g}"]
+
+
+class Contador(_Metrica):
+    tipo = "counter"
+
+    def inc(self, n=1, **labels):
+        clave = self._clave(labels)
+        with self._lock:
+            self._valores[clave] = self._valores.get(clave, 0) + n
+
+
+class Indicador(_Metrica):
+    tipo = "gauge"
+
+    def inc(self, n=1, **labels):
+        clave = self._clave(labels)
+        with self._lock:
+            self._valores[clave] = self._valores.get(clave, 0) + n
+
+    def dec(self, n=1, **labels):
+        self.inc(-n, **labels)
+
+    def fijar(self, valor, **labels):
+        clave = self._clave(labels)
+        with self._lock:
+            self._valores[clave] = valor
+
+
+class Histograma(_Metrica):
+    tipo = "histogram"
+
+    def __init__(self, nombre, ayuda, etiquetas=(), buckets=(0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30)):
+        super().__init__(nombre, ayuda, etiquetas)
+        self.buckets = tuple(sorted(buckets))
+
+    def observe(self, valor, **labels):
+        clave = self._clave(labels)
+        with self._lock:
+            estado = self._valores.get(clave)
+            if estado is None:
+                # conteo por bucket (no acumulado) + suma + total
+                estado = self._valores[clave] = [[0] * (len(self.buckets) + 1), 0.0, 0]
+            estado[0][bisect.bisect_left(self.buckets, valor)] += 1
+            estado[1] += valor
+            estado[2] += 1
+
+    def _lineas(self, clave, estado):
+        conteos, suma, total = estado
+        lineas = []
+        acumulado = 0
+        for limite, n in zip(self.buckets + (float("inf"),), conteos):
+            acumulado += n
+            le = "+Inf" if limite == float("inf") else f"{limite:g}"
+            etiquetas = _etiquetas(self.etiquetas + ("le",), clave + (le,))
+            lineas.append(f"{self.nombre}_bucket{etiquetas} {acumulado}")
+        etiquetas = _etiquetas(self.etiquetas, clave)
+        lineas.append(f"{self.nombre}_sum{etiquetas} {suma:g}")
+        lineas.append(f"{self.nombre}_count{etiquetas} {total}")
+        return lineas
+
+
+def exponer():
+    """
+    Texto para /metrics (formato de exposición de Prometheus 0.0.4).
+    """
+    lineas = []
+    for m in _registro:
+        lineas += m.exponer()
+    return "\n".join(lineas) + "\n"
+
+
+_BYTES = tuple(2 ** n for n in range(14, 28, 1))
+
+PETICIONES = Contador("informe_peticiones_total", "Peticiones atendidas", ("endpoint", "codigo"))
+PETICION_SEGUNDOS = Histograma("informe_peticion_segundos", "Duración de cada petición", ("endpoint",))
+EN_CURSO = Indicador("informe_peticiones_en_curso", "Peticiones en curso", ("endpoint",))
+TRAMO_SEGUNDOS = Histograma(
+    "informe_tramo_segundos", "Duración de cada fase de /generar y de cada sección del documento", ("tramo",)
+)
+IMAGENES = Contador("informe_imagenes_total", "Imágenes insertadas en informes", ("cache",))
+IMAGENES_BYTES = Contador("informe_imagenes_bytes_total", "Bytes de imágenes antes y después del preproceso", ("etapa",))
+IMAGENES_POR_INFORME = Histograma(
+    "informe_imagenes_por_informe", "Imágenes por informe", buckets=(0, 5, 10, 25, 50, 100, 200, 400, 800)
+)
+DOCX_BYTES = Histograma("informe_docx_bytes", "Tamaño del docx generado", buckets=_BYTES)
+ADMISION = Contador("informe_admision_total", "Peticiones por resultado del control de admisión", ("resultado",))
+ADMISION_ESPERA = Histograma("informe_admision_espera_segundos", "Espera en la cola de admisión")
+# estos tres son globales (memoria compartida entre workers); se leen al exponer
+ADMISION_EN_USO_MB = Indicador("informe_admision_en_uso_mb", "Memoria estimada de las peticiones admitidas")
+ADMISION_EN_CURSO = Indicador("informe_admision_en_curso", "Peticiones admitidas en curso")
+ADMISION_EN_COLA = Indicador("informe_admision_en_cola", "Peticiones esperando admisión")
+SECCIONES_CACHE = Contador("informe_secciones_cache_total", "Secciones del documento por resultado en la caché", ("resultado",))
+PERFILES = Contador("informe_perfiles_total", "Perfiles de peticiones guardados por disparador", ("disparo",))
+RESULTADOS = Contador("informe_resultados_total", "Informes síncronos por resultado en la caché de informes", ("resultado",))
+
+
+# ------------------------
+# Tramos (spans) por petición -> Server-Timing
+# ------------------------
+_trazas = contextvars.ContextVar("trazas", default=None)
+
+
+class Trazas:
+    """
+    Tramos medidos durante una petición, en orden de cierre.
+    """
+
+    def __init__(self):
+        self.tramos = []
+
+    def agregar(self, nombre, segundos, desc=None):
+        self.tramos.append((nombre, segundos, desc))
+
+    def server_timing(self):
+        partes = []
+        for nombre, segundos, desc in self.tramos:
+            parte = f"{nombre};dur={segundos * 1000:.1f}"
+            if desc:
+                # las cabeceras HTTP van en ASCII
+                desc = unicodedata.normalize("NFKD", desc).encode("ascii", "ignore").decode("ascii")
+                parte += ';desc="' + desc.replace('"', "'") + '"'
+            partes.append(parte)
+        return ", ".join(partes)
+
+
+def iniciar_trazas():
+    """
+    Activa un Trazas para el contexto actual; devuelve (trazas, token para terminar_trazas).
+    """
+    trazas = Trazas()
+    return trazas, _trazas.set(trazas)
+
+
+def terminar_trazas(token):
+    _trazas.reset(token)
+
+
+def registrar(nombre, segundos, desc=None):
+    TRAMO_SEGUNDOS.observe(segundos, tramo=nombre)
+    trazas = _trazas.get()
+    if trazas is not None:
+        trazas.agregar(nombre, segundos, desc)
+
+
+@contextlib.contextmanager
+def tramo(nombre, desc=None):
+    """
+    with tramo("validacion"): ...  -> histograma y Server-Timing (si hay petición activa).
+    Sólo se registra si el bloque termina sin excepción.
+    """
+    t0 = time.perf_counter()
+    yield
+    registrar(nombre, time.perf_counter() - t0, desc)
+
+
+class Secciones:
+    """
+    Tramos consecutivos sin anidar bloques: cada siguiente() cierra el tramo
+    anterior y abre uno nuevo; cerrar() cierra el último.
+    """
+
+    def __init__(self):
+        self._actual = None
+
+    def siguiente(self, nombre, desc=None):
+        ahora = time.perf_counter()
+        if self._actual is not None:
+            n, d, t0 = self._actual
+            registrar(n, ahora - t0, d)
+        self._actual = (nombre, desc, ahora)
+
+    def cerrar(self):
+        if self._actual is not None:
+            n, d, t0 = self._actual
+            registrar(n, time.perf_counter() - t0, d)
+            self._actual = None
+
+
+def registrar_admision(estado):
+    """
+    estado: resultado de admision.Admision.estado().
+    """
+    ADMISION_EN_USO_MB.fijar(estado["en_uso_mb"])
+    ADMISION_EN_CURSO.fijar(estado["en_curso"])
+    ADMISION_EN_COLA.fijar(estado["en_cola"])
+
+
+def registrar_imagenes(stats):
+    """
+    stats: resultado de imagenes.preprocess_stats.
+    """
+    por_imagen = stats.get("por_imagen", [])
+    hits = stats.get("cache_hits", 0)
+    if hits:
+        IMAGENES.inc(hits, cache="hit")
+    if len(por_imagen) - hits:
+        IMAGENES.inc(len(por_imagen) - hits, cache="miss")
+    IMAGENES_BYTES.inc(sum(x["bytes_in"] for x in por_imagen), etapa="entrada")
+    IMAGENES_BYTES.inc(sum(x["bytes_out"] for x in por_imagen), etapa="salida")
+    IMAGENES_POR_INFORME.observe(len(por_imagen))
@@ -0,0 +1,241 @@
+import numbers
+from typing import NamedTuple
+
+# ------------------------
+# Catálogos compartidos (documento y validación)
+# ------------------------
+CAMPOS_GENERALES = [
+    "Nombre o razón social del cliente",
+    "Fecha de inspección",
+    "Dirección",
+    "RUC o DNI",
+    "Número de instalación",
+    "Distrito",
+    "Departamento",
+    "Coordenadas",
+    "Nombre del contacto",
+    "Número del contacto",
+    "Correo de contacto",
+]
+
+ACCESORIOS_TANQUE = [
+    "Válvula de llenado",
+    "Medidor de porcentaje",
+    "Válvula de seguridad",
+    "Válvula de drenaje",
+    "Multiválvula",
+    "Válvula exceso de flujo (Retorno)",
+    "Válvula exceso de flujo (Bypass)",
+    "Val 3",
+]
+
+ATRIBUTOS_ACCESORIO = ["Marca", "Código", "Serie", "Mes/Año de fabricación"]
+
+# columna de la tabla 3 -> campo de Tanque
+COLUMNAS_TANQUE = {
+    "Capacidad (gal)": "capacidad",
+    "N° de serie": "serie",
+    "Año de fabricación": "anio",
+    "Tipo de tanque": "tipo",
+    "Fabricante de Tanque": "fabricante",
+    "% Actual": "porcentaje",
+}
+
+ESTRUCTURA_EQUIPOS = {
+    "vaporizador": ["Equipo", "Marca", "Tipo", "Serie", "Año de fabricación", "Capacidad"],
+    "quemador": ["Equipo", "Marca", "Modelo", "Tipo", "Serie", "Año de fabricación", "Capacidad (kW)"],
+    "decantador": ["Equipo", "Fabricante", "Modelo", "Tipo", "Serie", "Año de fabricación", "Capacidad (gal)"],
+    "dispensador_de_gas": ["Equipo", "Marca", "Modelo", "Serie"],
+    "bomba": ["Equipo", "Marca", "Modelo", "Serie"],
+    "tablero": ["Equipo", "TAG"],
+    "estabilizador": ["Equipo", "Marca", "Modelo", "Serie"],
+    "detector": ["Equipo", "Marca", "Modelo", "Serie"],
+    "extintor": ["Equipo", "Marca", "Serie", "Año de fabricación", "Próxima PH", "Fecha de próxima recarga"],
+}
+
+SUBPUNTOS_OBS = ["7.1", "7.2", "7.3", "7.4", "7.5"]
+
+# Diseño de la evidencia fotográfica (secciones 8 a 11): 'normal' pone cada foto
+# en su recuadro de 15x10 cm; 'compacto' las agrupa en grillas de 2 columnas
+DISENOS = ("normal", "compacto")
+
+
+# ------------------------
+# Modelo del informe (sin pandas)
+# ------------------------
+class Tanque(NamedTuple):
+    serie: object = ""
+    capacidad: object = ""
+    anio: object = ""
+    tipo: object = ""
+    fabricante: object = ""
+    porcentaje: object = ""
+
+    def columna(self, nombre):
+        campo = COLUMNAS_TANQUE.get(nombre)
+        return getattr(self, campo) if campo else None
+
+
+class AccesorioRed(NamedTuple):
+    tipo: str
+    marca: object = ""
+    serie: object = ""
+    codigo: object = ""
+    fabricacion: object = ""
+
+
+class Equipo(NamedTuple):
+    tipo: str
+    campos: dict
+
+    def get(self, columna, default=None):
+        return self.campos.get(columna, default)
+
+
+class Informe(NamedTuple):
+    general: dict
+    tanques: list
+    # (tanque, atributo, accesorio) -> valor; tanques_accesorios en orden de la tabla 4
+    accesorios: dict
+    tanques_accesorios: list
+    red: list
+    equipos: list
+    observaciones: dict
+    actividades: list
+    diseno: str = "normal"
+
+    def red_por_tipo(self, tipo):
+        return [r for r in self.red if r.tipo == tipo]
+
+    def equipos_por_tipo(self, tipo):
+        return [e for e in self.equipos if e.tipo == tipo]
+
+
+def _clave_tanque(tank_key):
+    try:
+        return int(tank_key)
+    except Exception:
+        return tank_key
+
+
+def _orden_tanques(claves):
+    # enteros primero (orden numérico) y luego el resto como texto
+    return sorted(set(claves), key=lambda k: (0, k, "") if isinstance(k, numbers.Integral) else (1, 0, str(k)))
+
+
+def _tipo(v):
+    return str(v).lower() if v is not None else ""
+
+
+def informe_desde_json(payload):
+    """
+    Construye el Informe directamente desde el payload JSON de /generar.
+    """
+    general = payload.get("general", {}) or {}
+    tanques = payload.get("tanques", []) or []
+    accesorios_tanque = payload.get("accesoriosTanque", {}) or {}
+    accesorios_red = payload.get("accesoriosRed", []) or []
+    equipos = payload.get("equipos", []) or []
+    observaciones = payload.get("observaciones", {}) or {}
+
+    accesorios = {}
+    for tank_key, accs in accesorios_tanque.items():
+        tk = _clave_tanque(tank_key)
+        for attr in ATRIBUTOS_ACCESORIO:
+            for acc_name in ACCESORIOS_TANQUE:
+                acc_entry = accs.get(acc_name, {}) if isinstance(accs, dict) else {}
+                valor = acc_entry.get(attr, "") if isinstance(acc_entry, dict) else ""
+                accesorios.setdefault((tk, attr, acc_name), valor)
+
+    return Informe(
+        general={c: general.get(c, "") for c in CAMPOS_GENERALES},
+        tanques=[
+            Tanque(
+                serie=t.get("serie") or t.get("N° de serie") or "",
+                capacidad=t.get("capacidad") or "",
+                anio=t.get("anio") or t.get("Año de fabricación") or "",
+                tipo=t.get("tipo") or "",
+                fabricante=t.get("fabricante") or "",
+                porcentaje=t.get("porcentaje") or "",
+            )
+            for t in tanques
+        ],
+        accesorios=accesorios,
+        tanques_accesorios=_orden_tanques(_clave_tanque(k) for k in accesorios_tanque),
+        red=[
+            AccesorioRed(
+                tipo=_tipo(r.get("Tipo", "")),
+                marca=r.get("Marca", ""),
+                serie=r.get("Serie", ""),
+                codigo=r.get("Código", ""),
+                fabricacion=r.get("Mes/Año de fabricación", ""),
+            )
+            for r in accesorios_red
+        ],
+        equipos=[Equipo(tipo=_tipo(e.get("Tipo de equipo")), campos=dict(e)) for e in equipos],
+        observaciones={sp: observaciones.get(sp, "") for sp in SUBPUNTOS_OBS},
+        actividades=payload.get("actividades", []) or [],
+        diseno=str(payload.get("diseno") or "normal").strip().lower(),
+    )
+
+
+def _records(df):
+    # filas del DataFrame como dicts, con NaN -> None
+    if df is None or df.empty:
+        return []
+    return [
+        {k: (None if isinstance(v, float) and v != v else v) for k, v in row.items()}
+        for row in df.to_dict(orient="records")
+    ]
+
+
+def informe_desde_dfs(df_info, df_tanques, df_accesorios, df_red, df_equipos, df_obs, actividades_list=None):
+    """
+    Adaptador: construye el Informe desde los DataFrames de build_dfs_from_json
+    (entrada histórica de generar_docx_desde_dfs).
+    """
+    info = _records(df_info)
+    general = info[0] if info else {}
+
+    tanques = []
+    for t in _records(df_tanques):
+        campos = {campo: t.get(col) for col, campo in COLUMNAS_TANQUE.items()}
+        if campos["serie"] is None:
+            campos["serie"] = t.get("serie")
+        tanques.append(Tanque(**campos))
+
+    accesorios = {}
+    claves = []
+    for row in _records(df_accesorios):
+        tk = row.get("Tanque")
+        claves.append(tk)
+        for acc_name in ACCESORIOS_TANQUE:
+            accesorios.setdefault((tk, row.get("Atributo"), acc_name), row.get(acc_name))
+
+    red = [
+        AccesorioRed(
+            tipo=_tipo(r.get("Tipo")),
+            marca=r.get("Marca"),
+            serie=r.get("Serie"),
+            codigo=r.get("Código"),
+            fabricacion=r.get("Mes/Año de fabricación"),
+        )
+        for r in _records(df_red)
+    ]
+
+    equipos = [Equipo(tipo=_tipo(e.get("Tipo de equipo")), campos=e) for e in _records(df_equipos)]
+
+    observaciones = {}
+    for row in _records(df_obs):
+        observaciones.setdefault(row.get("Subpunto"), row.get("Observación"))
+
+    return Informe(
+        general=general,
+        tanques=tanques,
+        accesorios=accesorios,
+        tanques_accesorios=_orden_tanques(claves),
+        red=red,
+        equipos=equipos,
+        observaciones=observaciones,
+        actividades=actividades_list or [],
+    )
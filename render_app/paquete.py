@@ -0,0 +1,135 @@
+"""
+Escritura del paquete docx sin tener las fotos en memoria.
+
+python-docx guarda el blob de cada imagen en su ImagePart desde add_picture
+hasta doc.save, y al guardar vuelve a comprimir con deflate JPEGs que ya
+vienen comprimidos. Aquí las imágenes insertadas desde una ruta quedan como
+ImagenEnDisco (sólo la ruta, la cabecera y el SHA-1) y guardar() escribe el
+zip directamente en el destino: las partes XML con deflate y cada imagen
+copiada por bloques desde su archivo, sin recomprimir (ZIP_STORED).
+Todas las entradas llevan la misma fecha fija, así el mismo documento da
+siempre los mismos bytes.
+"""
+import itertools
+import os
+import shutil
+import zipfile
+
+from docx.image.image import Image
+from docx.opc.packuri import PACKAGE_URI, PackURI
+from docx.opc.pkgwriter import _ContentTypesItem
+from docx.package import ImageParts
+from docx.parts.image import ImagePart
+
+from imagenes import file_sha1
+
+CONTENT_TYPES_MEMBER = "[Content_Types].xml"
+# fecha de cada entrada del zip (la mínima del formato): no depende de cuándo se guarda
+FECHA_ZIP = (1980, 1, 1, 0, 0, 0)
+
+
+class ImagenEnDisco(ImagePart):
+    """
+    ImagePart que recuerda la ruta del archivo en lugar de su contenido;
+    blob lo lee recién si alguien lo pide (p. ej. doc.save de python-docx).
+    El archivo debe existir hasta que el documento se guarde.
+    """
+
+    def __init__(self, partname, path, digest, image):
+        super().__init__(partname, image.content_type, None, image)
+        self.path = path
+        self._digest = digest
+
+    @property
+    def blob(self):
+        with open(self.path, "rb") as fh:
+            return fh.read()
+
+    @property
+    def sha1(self):
+        return self._digest
+
+
+class ImagenesEnDisco(ImageParts):
+    """
+    Colección de imágenes del paquete que agrega ImagenEnDisco para las rutas
+    (con un stream se comporta como la de python-docx). Deduplica por SHA-1
+    con un diccionario en vez de recalcular el hash de cada imagen existente.
+    """
+
+    def __init__(self, existentes=()):
+        super().__init__()
+        self._por_digest = {}
+        for part in existentes:
+            self.append(part)
+
+    def append(self, item):
+        super().append(item)
+        self._por_digest.setdefault(item.sha1, item)
+
+    def get_or_add_image_part(self, image_descriptor):
+        if not isinstance(image_descriptor, str):
+            return super().get_or_add_image_part(image_descriptor)
+        digest = file_sha1(image_descriptor)
+        part = self._por_digest.get(digest)
+        if part is not None:
+            return part
+        # sólo la cabecera: el contenido se copia del archivo al guardar
+        with open(image_descriptor, "rb") as fh:
+            image = Image._from_stream(fh, None, os.path.basename(image_descriptor))
+        part = ImagenEnDisco(self._next_image_partname(image.ext), image_descriptor, digest, image)
+        self.append(part)
+        return part
+
+    def _next_image_partname(self, ext):
+        # mismo criterio que python-docx (el primer número libre), con un set
+        usados = {part.partname.idx for part in self}
+        n = next(n for n in itertools.count(1) if n not in usados)
+        return PackURI("/word/media/image%d.%s" % (n, ext))
+
+
+def imagenes_en_disco(doc):
+    """
+    Hace que las imágenes que se agreguen a doc desde una ruta queden en disco.
+    """
+    package = doc.part.package
+    # image_parts es un lazyproperty: su valor vive en el __dict__ del paquete
+    package.__dict__["image_parts"] = ImagenesEnDisco(package.image_parts)
+    return doc
+
+
+def _es_media(part):
+    return isinstance(part, ImagePart) or part.content_type.startswith(("image/", "audio/", "video/"))
+
+
+def _entrada(nombre, compress_type=zipfile.ZIP_DEFLATED):
+    info = zipfile.ZipInfo(nombre, date_time=FECHA_ZIP)
+    info.compress_type = compress_type
+    info.external_attr = 0o600 << 16
+    return info
+
+
+def guardar(doc, destino):
+    """
+    Escribe el paquete de doc en destino (ruta o archivo; no hace falta que
+    sea posicionable): XML con deflate, imágenes sin recomprimir y las
+    ImagenEnDisco copiadas por bloques desde su archivo.
+    """
+    package = doc.part.package
+    parts = list(package.iter_parts())
+    with zipfile.ZipFile(destino, "w", compression=zipfile.ZIP_DEFLATED) as zf:
+        zf.writestr(_entrada(CONTENT_TYPES_MEMBER), _ContentTypesItem.from_parts(parts).blob)
+        zf.writestr(_entrada(PACKAGE_URI.rels_uri.membername), package.rels.xml)
+        for part in parts:
+            nombre = part.partname.membername
+            if isinstance(part, ImagenEnDisco):
+                info = _entrada(nombre, zipfile.ZIP_STORED)
+                info.file_size = os.path.getsize(part.path)
+                with open(part.path, "rb") as src, zf.open(info, "w") as dst:
+                    shutil.copyfileobj(src, dst, 1024 * 1024)
+            elif _es_media(part):
+                zf.writestr(_entrada(nombre, zipfile.ZIP_STORED), part.blob)
+            else:
+                zf.writestr(_entrada(nombre), part.blob)
+            if len(part.rels):
+                zf.writestr(_entrada(part.partname.rels_uri.membername), part.rels.xml)
@@ -0,0 +1,348 @@
+"""
+Perfiles de peticiones lentas, a pedido.
+
+Dos disparadores (ambos apagados por omisión):
+  - la cabecera X-Perfil-Token con el valor de PERFILES_TOKEN: la petición
+    corre bajo cProfile, el muestreador de pila y tracemalloc, y su perfil se
+    guarda siempre;
+  - PERFILES_UMBRAL_S: toda petición corre bajo el muestreador (un solo hilo
+    que mira la pila de las peticiones cada PERFILES_MUESTREO_MS, casi sin
+    costo) y el perfil se guarda sólo si tarda más que el umbral.
+Cada perfil es una carpeta PERFILES_DIR/<id> con meta.json, arbol.txt (árbol
+de llamadas muestreado), pilas.folded (para flamegraph), memoria.txt y, con
+cProfile, funciones.txt y perfil.pstats. Se conservan los PERFILES_MAX más
+recientes. El preproceso de fotos corre en otros procesos y no aparece en el
+árbol; su tiempo está en los tramos de Server-Timing que guarda meta.json.
+"""
+import cProfile
+import contextlib
+import hmac
+import io
+import json
+import os
+import pstats
+import re
+import shutil
+import sys
+import tempfile
+import threading
+import time
+import tracemalloc
+import uuid
+from collections import Counter
+
+# ------------------------
+# Configuración
+# ------------------------
+PERFILES_DIR = os.environ.get("PERFILES_DIR", os.path.join(tempfile.gettempdir(), "informe_perfiles"))
+# Valor de X-Perfil-Token que pide un perfil completo y da acceso a /perfiles (vacío: desactivado)
+PERFILES_TOKEN = os.environ.get("PERFILES_TOKEN", "")
+# Se guarda el perfil muestreado de toda petición que tarde más que esto (0: desactivado)
+PERFILES_UMBRAL_S = float(os.environ.get("PERFILES_UMBRAL_S", 0))
+PERFILES_MUESTREO_MS = float(os.environ.get("PERFILES_MUESTREO_MS", 10))
+# Perfiles guardados como máximo; se borran los más viejos
+PERFILES_MAX = int(os.environ.get("PERFILES_MAX", 50))
+# Marcos de pila por asignación que guarda tracemalloc y cuántas se listan
+PERFILES_MARCOS = int(os.environ.get("PERFILES_MARCOS", 10))
+PERFILES_TOP_MEMORIA = int(os.environ.get("PERFILES_TOP_MEMORIA", 25))
+
+CABECERA = "X-Perfil-Token"
+ID_RE = re.compile(r"^[A-Za-z0-9_-]{1,64}$")
+REQUEST_ID_MAX = 200
+ARCHIVO_RE = re.compile(r"^[a-z]+\.(json|txt|folded|pstats)$")
+# nodos del árbol por debajo de esta fracción de las muestras no se listan
+_ARBOL_MINIMO = 0.005
+
+
+def autorizado(token):
+    return bool(PERFILES_TOKEN) and hmac.compare_digest((token or "").encode(), PERFILES_TOKEN.encode())
+
+
+def disparo(token):
+    """
+    'cabecera', 'umbral' o None: cómo se perfila una petición con ese X-Perfil-Token.
+    """
+    if token and autorizado(token):
+        return "cabecera"
+    if PERFILES_UMBRAL_S > 0:
+        return "umbral"
+    return None
+
+
+def nuevo_id():
+    # siempre del servidor: el X-Request-Id del cliente sólo va a meta.json
+    return uuid.uuid4().hex
+
+
+# ------------------------
+# Muestreo de pila
+# ------------------------
+def _pila(frame):
+    pila = []
+    while frame is not None:
+        code = frame.f_code
+        pila.append(f"{code.co_name} ({os.path.basename(code.co_filename)}:{code.co_firstlineno})")
+        frame = frame.f_back
+    return tuple(reversed(pila))
+
+
+class Muestreador:
+    """
+    Un hilo que cada intervalo toma la pila de cada hilo registrado
+    (sys._current_frames) y cuenta cuántas veces aparece cada pila.
+    El hilo termina solo cuando no queda ninguno registrado.
+    """
+
+    def __init__(self, intervalo):
+        self.intervalo = intervalo
+        self._pilas = {}
+        self._lock = threading.Lock()
+        self._hilo = None
+
+    def iniciar(self, ident):
+        with self._lock:
+            self._pilas[ident] = Counter()
+            if self._hilo is None:
+                self._hilo = threading.Thread(target=self._correr, name="perfiles-muestreo", daemon=True)
+                self._hilo.start()
+
+    def terminar(self, ident):
+        with self._lock:
+            return self._pilas.pop(ident, Counter())
+
+    def _correr(self):
+        while True:
+            time.sleep(self.intervalo)
+            with self._lock:
+                if not self._pilas:
+                    self._hilo = None
+                    return
+                frames = sys._current_frames()
+                for ident, cuenta in self._pilas.items():
+                    frame = frames.get(ident)
+                    if frame is not None:
+                        cuenta[_pila(frame)] += 1
+                del frames
+
+
+muestreador = Muestreador(PERFILES_MUESTREO_MS / 1000)
+
+
+def _reset_en_hijo():
+    global muestreador, _memoria_lock, _memoria_usuarios, _memoria_propia
+    muestreador = Muestreador(PERFILES_MUESTREO_MS / 1000)
+    _memoria_lock = threading.Lock()
+    _memoria_usuarios = 0
+    _memoria_propia = False
+
+
+def arbol(pilas, intervalo):
+    """
+    Texto con el árbol de llamadas: % de muestras, tiempo estimado y función.
+    """
+    total = sum(pilas.values())
+    if not total:
+        return "Sin muestras (la petición duró menos que el intervalo de muestreo).\n"
+    raiz = {}
+    for pila, n in pilas.items():
+        nodo = raiz
+        for marco in pila:
+            hijo = nodo.setdefault(marco, [0, {}])
+            hijo[0] += n
+            nodo = hijo[1]
+    lineas = [f"{total} muestras cada {intervalo * 1000:g} ms\n"]
+
+    def recorrer(nodo, nivel):
+        for nombre, (n, hijos) in sorted(nodo.items(), key=lambda kv: -kv[1][0]):
+            if n / total < _ARBOL_MINIMO:
+                continue
+            lineas.append(f"{100 * n / total:6.1f}% {n * intervalo * 1000:9.0f} ms  {'  ' * nivel}{nombre}")
+            recorrer(hijos, nivel + 1)
+
+    recorrer(raiz, 0)
+    return "\n".join(lineas) + "\n"
+
+
+def folded(pilas):
+    return "".join(f"{';'.join(pila)} {n}\n" for pila, n in pilas.most_common())
+
+
+# ------------------------
+# tracemalloc (global al proceso: se enciende mientras haya un perfil que lo use)
+# ------------------------
+_memoria_lock = threading.Lock()
+_memoria_usuarios = 0
+_memoria_propia = False
+
+if hasattr(os, "register_at_fork"):
+    os.register_at_fork(after_in_child=_reset_en_hijo)
+
+
+def _memoria_iniciar():
+    global _memoria_usuarios, _memoria_propia
+    with _memoria_lock:
+        if _memoria_usuarios == 0 and not tracemalloc.is_tracing():
+            tracemalloc.start(PERFILES_MARCOS)
+            _memoria_propia = True
+        _memoria_usuarios += 1
+        tracemalloc.reset_peak()
+    return tracemalloc.take_snapshot()
+
+
+def _memoria_terminar(inicio):
+    global _memoria_usuarios, _memoria_propia
+    fin = tracemalloc.take_snapshot()
+    _, pico = tracemalloc.get_traced_memory()
+    with _memoria_lock:
+        _memoria_usuarios -= 1
+        if _memoria_usuarios == 0 and _memoria_propia:
+            tracemalloc.stop()
+            _memoria_propia = False
+    # sin las asignaciones del propio perfilador ni de los imports
+    filtros = [
+        tracemalloc.Filter(False, tracemalloc.__file__),
+        tracemalloc.Filter(False, __file__),
+        tracemalloc.Filter(False, "<frozen importlib._bootstrap*>"),
+    ]
+    inicio, fin = inicio.filter_traces(filtros), fin.filter_traces(filtros)
+    lineas = [f"Pico de memoria rastreada durante la petición: {pico / 1e6:.1f} MB (todo el proceso)", ""]
+    lineas.append(f"Top {PERFILES_TOP_MEMORIA} asignaciones retenidas al terminar (respecto del inicio):")
+    for stat in fin.compare_to(inicio, "lineno")[:PERFILES_TOP_MEMORIA]:
+        lineas.append(f"  {stat}")
+    lineas += ["", "Pilas de las 5 mayores:"]
+    for stat in fin.compare_to(inicio, "traceback")[:5]:
+        lineas.append(f"  {stat.size_diff / 1e6:+.2f} MB en {stat.count_diff:+d} bloques")
+        lineas += [f"    {linea}" for linea in stat.traceback.format()]
+    return "\n".join(lineas) + "\n", pico
+
+
+# ------------------------
+# Un perfil por petición
+# ------------------------
+class Perfil:
+    """
+    with Perfil(id, disparo) as perfil: ...  -> perfil.debe_guardarse(); perfil.guardar(meta).
+    request_id: el X-Request-Id del cliente, sólo para buscar el perfil (/perfiles?request_id=).
+    """
+
+    def __init__(self, perfil_id, disparo, request_id=None):
+        self.id = perfil_id
+        self.disparo = disparo
+        self.request_id = request_id
+        self.completo = disparo == "cabecera"
+        self.duracion = None
+        self.pico = None
+        self.archivos = {}
+        self._ident = threading.get_ident()
+
+    def __enter__(self):
+        self._memoria = _memoria_iniciar() if self.completo else None
+        self._cprofile = cProfile.Profile() if self.completo else None
+        muestreador.iniciar(self._ident)
+        self._t0 = time.perf_counter()
+        if self._cprofile is not None:
+            self._cprofile.enable()
+        return self
+
+    def __exit__(self, *exc):
+        if self._cprofile is not None:
+            self._cprofile.disable()
+        self.duracion = time.perf_counter() - self._t0
+        pilas = muestreador.terminar(self._ident)
+        if self._memoria is not None:
+            self.archivos["memoria.txt"], self.pico = _memoria_terminar(self._memoria)
+        self.archivos["arbol.txt"] = arbol(pilas, muestreador.intervalo)
+        self.archivos["pilas.folded"] = folded(pilas)
+        if self._cprofile is not None:
+            texto = io.StringIO()
+            stats = pstats.Stats(self._cprofile, stream=texto)
+            stats.sort_stats("cumulative").print_stats(80)
+            stats.print_callees(30)
+            self.archivos["funciones.txt"] = texto.getvalue()
+            self.archivos["perfil.pstats"] = stats
+        return False
+
+    def debe_guardarse(self):
+        return self.completo or (PERFILES_UMBRAL_S > 0 and self.duracion >= PERFILES_UMBRAL_S)
+
+    def guardar(self, meta):
+        """
+        Escribe la carpeta del perfil (de una vez, con rename) y aplica PERFILES_MAX.
+        Nunca reemplaza un perfil ya guardado.
+        """
+        os.makedirs(PERFILES_DIR, exist_ok=True)
+        tmp = tempfile.mkdtemp(dir=PERFILES_DIR, prefix=".tmp_")
+        meta = dict(meta, id=self.id, disparo=self.disparo, duracion_s=round(self.duracion, 4), fecha=time.time())
+        if self.request_id:
+            meta["request_id"] = self.request_id[:REQUEST_ID_MAX]
+        if self.pico is not None:
+            meta["pico_memoria_mb"] = round(self.pico / 1e6, 1)
+        try:
+            with open(os.path.join(tmp, "meta.json"), "w", encoding="utf-8") as fh:
+                json.dump(meta, fh, ensure_ascii=False, indent=1)
+            for nombre, contenido in self.archivos.items():
+                path = os.path.join(tmp, nombre)
+                if isinstance(contenido, pstats.Stats):
+                    contenido.dump_stats(path)
+                else:
+                    with open(path, "w", encoding="utf-8") as fh:
+                        fh.write(contenido)
+            # rename de carpetas falla si el destino ya existe con contenido
+            os.rename(tmp, os.path.join(PERFILES_DIR, self.id))
+        except BaseException:
+            shutil.rmtree(tmp, ignore_errors=True)
+            raise
+        podar()
+        return meta
+
+
+def podar():
+    """
+    Deja sólo los PERFILES_MAX perfiles más recientes.
+    """
+    guardados = sorted(_carpetas(), key=lambda e: e.stat().st_mtime, reverse=True)
+    for e in guardados[PERFILES_MAX:]:
+        shutil.rmtree(e.path, ignore_errors=True)
+
+
+def _carpetas():
+    if not os.path.isdir(PERFILES_DIR):
+        return []
+    out = []
+    for e in os.scandir(PERFILES_DIR):
+        with contextlib.suppress(OSError):
+            if e.is_dir() and ID_RE.match(e.name):
+                out.append(e)
+    return out
+
+
+def leer_meta(perfil_id):
+    if not ID_RE.match(perfil_id or ""):
+        return None
+    carpeta = os.path.join(PERFILES_DIR, perfil_id)
+    try:
+        with open(os.path.join(carpeta, "meta.json"), encoding="utf-8") as fh:
+            meta = json.load(fh)
+        return dict(meta, archivos=sorted(os.listdir(carpeta)))
+    except (OSError, ValueError):
+        return None
+
+
+def listar(request_id=None):
+    """
+    meta.json de cada perfil guardado, el más reciente primero (sólo los de
+    ese X-Request-Id si se da).
+    """
+    metas = [leer_meta(e.name) for e in _carpetas()]
+    metas = [m for m in metas if m and (request_id is None or m.get("request_id") == request_id)]
+    return sorted(metas, key=lambda m: m.get("fecha", 0), reverse=True)
+
+
+def archivo(perfil_id, nombre):
+    """
+    Ruta de un archivo del perfil, o None.
+    """
+    if not ID_RE.match(perfil_id or "") or not ARCHIVO_RE.match(nombre or ""):
+        return None
+    path = os.path.join(PERFILES_DIR, perfil_id, nombre)
+    return path if os.path.isfile(path) else None
@@ -0,0 +1,203 @@
+"""
+Caché de informes ya generados e idempotencia de /generar.
+
+Cada envío se resume en un digest: el JSON del informe en forma canónica, el
+nombre y SHA-256 de cada foto y la versión del código que arma el documento.
+Como el docx no depende de la hora (paquete.FECHA_ZIP y las propiedades del
+documento salen del informe), el mismo digest da los mismos bytes: el docx se
+guarda en disco bajo su digest (LRU acotado como la caché de imágenes) y el
+digest sirve de ETag.
+
+Un duplicado que llega mientras el primero se está generando espera a que
+termine (flock sobre un archivo de bloqueo, entre procesos) y se lleva el
+resultado de la caché. La cabecera Idempotency-Key recuerda a qué digest
+corresponde cada clave, para responder un reintento sin volver a leer las fotos:
+el reintento recibe el informe original aunque traiga otro contenido (sólo si
+ese informe ya salió de la caché se compara y se rechaza con 422).
+"""
+import contextlib
+import fcntl
+import glob
+import hashlib
+import json
+import os
+import tempfile
+import threading
+import time
+
+from imagenes import ImageCache, file_sha256
+
+# ------------------------
+# Configuración
+# ------------------------
+RESULTADOS_DIR = os.environ.get("RESULTADOS_DIR", os.path.join(tempfile.gettempdir(), "informe_resultados"))
+# Tamaño máximo de la caché de informes (0 la desactiva)
+RESULTADOS_MAX_BYTES = int(os.environ.get("RESULTADOS_MAX_BYTES", 256 * 1024 * 1024))
+# Segundos que un duplicado espera a que termine el informe en curso antes de generarlo él
+RESULTADOS_ESPERA = float(os.environ.get("RESULTADOS_ESPERA", 180))
+# Vigencia de cada Idempotency-Key
+RESULTADOS_TTL_CLAVES = int(os.environ.get("RESULTADOS_TTL_CLAVES", 24 * 3600))
+# Archivos de bloqueo: el digest se reparte en 4096 (los archivos no crecen con los informes)
+_BLOQUEOS = 3
+
+CLAVE_MAX = 255
+
+cache = ImageCache(RESULTADOS_DIR, RESULTADOS_MAX_BYTES, ext=".docx")
+
+
+class ClaveReutilizada(ValueError):
+    pass
+
+
+def _version_codigo():
+    # los módulos que arman el documento: si cambian, cambian todos los digests
+    h = hashlib.sha256()
+    base = os.path.dirname(os.path.abspath(__file__))
+    for path in sorted(glob.glob(os.path.join(base, "*.py"))):
+        with open(path, "rb") as fh:
+            h.update(os.path.basename(path).encode() + b"\0" + fh.read())
+    return h.hexdigest()
+
+
+VERSION = _version_codigo()
+
+
+def digest(payload, images=()):
+    """
+    Digest canónico de un envío: payload (sin 'sesion') + (campo, nombre,
+    SHA-256) de cada foto + versión del código.
+    """
+    h = hashlib.sha256(VERSION.encode())
+    datos = {k: v for k, v in payload.items() if k != "sesion"}
+    h.update(json.dumps(datos, sort_keys=True, ensure_ascii=False, separators=(",", ":"), default=str).encode())
+    for item in images:
+        sha = item.get("sha256") or file_sha256(item["path"])
+        h.update(("\0%s\0%s\0%s" % (item.get("field", ""), item["filename"], sha)).encode())
+    return h.hexdigest()
+
+
+def etag(dig):
+    return dig[:32]
+
+
+# ------------------------
+# Un solo proceso genera cada digest
+# ------------------------
+# descriptores de bloqueo abiertos: un hijo creado con fork (p. ej. el pool de
+# imágenes) los hereda y, si no los cierra, mantiene el flock después de salir()
+_abiertos = set()
+_abiertos_lock = threading.Lock()
+
+
+def _cerrar_bloqueos_en_hijo():
+    global _abiertos_lock
+    _abiertos_lock = threading.Lock()
+    for fd in list(_abiertos):
+        try:
+            os.close(fd)
+        except OSError:
+            pass
+    _abiertos.clear()
+
+
+if hasattr(os, "register_at_fork"):
+    os.register_at_fork(after_in_child=_cerrar_bloqueos_en_hijo)
+
+
+@contextlib.contextmanager
+def exclusivo(dig, espera=None):
+    """
+    Bloqueo del digest entre procesos e hilos. Si otro lo tiene se espera hasta
+    espera segundos (después se sigue igual: el resultado es el mismo).
+    Devuelve si hubo que esperar.
+    """
+    espera = RESULTADOS_ESPERA if espera is None else espera
+    carpeta = os.path.join(RESULTADOS_DIR, "bloqueos")
+    os.makedirs(carpeta, exist_ok=True)
+    with _abiertos_lock:
+        fd = os.open(os.path.join(carpeta, dig[:_BLOQUEOS] + ".lock"), os.O_CREAT | os.O_RDWR | os.O_CLOEXEC, 0o600)
+        _abiertos.add(fd)
+    limite = time.monotonic() + espera
+    esperado = False
+    try:
+        while True:
+            try:
+                fcntl.flock(fd, fcntl.LOCK_EX | fcntl.LOCK_NB)
+                break
+            except BlockingIOError:
+                esperado = True
+                if time.monotonic() >= limite:
+                    break
+                time.sleep(0.05)
+        yield esperado
+    finally:
+        # cerrar el descriptor suelta el flock
+        with _abiertos_lock:
+            _abiertos.discard(fd)
+            os.close(fd)
+
+
+# ------------------------
+# Idempotency-Key -> digest
+# ------------------------
+_ultima_purga = 0.0
+
+
+def _clave_path(clave):
+    return os.path.join(RESULTADOS_DIR, "claves", hashlib.sha256(clave.encode("utf-8")).hexdigest())
+
+
+def clave_valida(clave):
+    return 0 < len(clave) <= CLAVE_MAX and clave.isprintable()
+
+
+def digest_de_clave(clave):
+    """
+    Digest registrado para la clave, o None si no existe o venció.
+    """
+    path = _clave_path(clave)
+    try:
+        if os.stat(path).st_mtime < time.time() - RESULTADOS_TTL_CLAVES:
+            return None
+        with open(path) as fh:
+            return fh.read().strip() or None
+    except OSError:
+        return None
+
+
+def recordar_clave(clave, dig):
+    """
+    Asocia la clave al digest; lanza ClaveReutilizada si ya estaba asociada a otro.
+    """
+    previo = digest_de_clave(clave)
+    if previo is not None and previo != dig:
+        raise ClaveReutilizada("La Idempotency-Key ya se usó con otro contenido")
+    if previo == dig:
+        return
+    purgar_claves()
+    path = _clave_path(clave)
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    fd, tmp = tempfile.mkstemp(dir=os.path.dirname(path), suffix=".part")
+    with os.fdopen(fd, "w") as fh:
+        fh.write(dig)
+    os.replace(tmp, path)
+
+
+def purgar_claves():
+    """
+    Borra las claves vencidas (a lo sumo una vez por minuto y proceso).
+    """
+    global _ultima_purga
+    ahora = time.time()
+    if ahora - _ultima_purga < 60:
+        return
+    _ultima_purga = ahora
+    carpeta = os.path.join(RESULTADOS_DIR, "claves")
+    if not os.path.isdir(carpeta):
+        return
+    for e in os.scandir(carpeta):
+        try:
+            if e.stat().st_mtime < ahora - RESULTADOS_TTL_CLAVES:
+                os.remove(e.path)
+        except OSError:
+            continue
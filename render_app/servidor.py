@@ -1,24 +1,77 @@
 
 import os
+import io
+import copy
+import contextlib
 import tempfile
 import shutil
 import json
 import re
+import logging
+import threading
+import time
+import itertools
+import hashlib
+import functools
+from collections import OrderedDict
 from datetime import datetime
-from flask import Flask, request, send_file, jsonify, render_template
+from typing import NamedTuple
+from flask import Flask, Response, request, send_file, jsonify, render_template, url_for, g
 from flask_cors import CORS
-import pandas as pd
+from werkzeug.sansio.multipart import MultipartDecoder, NeedData, Epilogue, Field, File, Data
 import unicodedata
+from lxml import etree
 from docx import Document
-from docx.shared import Pt, RGBColor, Inches
+from docx.table import Table
+from docx.shared import Pt, RGBColor, Inches, Emu
+from docx.enum.style import WD_STYLE_TYPE
 from docx.enum.text import WD_PARAGRAPH_ALIGNMENT
 from docx.enum.table import WD_TABLE_ALIGNMENT, WD_ALIGN_VERTICAL
-from docx.oxml import OxmlElement
-from docx.oxml.ns import qn
+from docx.oxml import OxmlElement, parse_xml
+from docx.oxml.ns import qn, nsdecls
+from docx.oxml.shape import CT_Inline
+from xml.sax.saxutils import escape as xml_escape
+from imagenes import (
+    preprocess_images,
+    preprocess_images_local,
+    resolve_image,
+    log_preprocess_stats,
+    file_sha1,
+    revisar_pixeles,
+    slot_pixels,
+    IMG_JPEG_QUALITY,
+)
+import trabajos
+import lotes
+import inventario
+import subidas
+import borradores
+import paquete
+import metricas
+import admision
+import resultados
+import perfiles
+from modelo import (
+    CAMPOS_GENERALES,
+    ACCESORIOS_TANQUE,
+    ATRIBUTOS_ACCESORIO,
+    ESTRUCTURA_EQUIPOS,
+    DISENOS,
+    informe_desde_json,
+    informe_desde_dfs,
+)
+
+logging.basicConfig(level=os.environ.get("LOG_LEVEL", "INFO"))
 
 app = Flask(__name__, template_folder="templates")
 CORS(app)
 
+# El docx se arma en memoria hasta este tamaño; por encima se vuelca a un temporal en disco
+DOCX_SPOOL_MAX_BYTES = int(os.environ.get("DOCX_SPOOL_MAX_BYTES", 32 * 1024 * 1024))
+# Tamaño de cada trozo al enviar el docx
+DOCX_CHUNK_BYTES = 64 * 1024
+DOCX_MIMETYPE = "application/vnd.openxmlformats-officedocument.wordprocessingml.document"
+
 
 # ------------------------
 # Utilitarios
@@ -53,7 +106,7 @@ def set_cell_style(cell, text, font_size=10, bold=False, align_center=True):
     cell.vertical_alignment = WD_ALIGN_VERTICAL.CENTER
 
 
-def add_subtitle(doc, text, indent=False):
+def _build_subtitle(doc, text, indent=False):
     p = doc.add_paragraph()
     run = p.add_run(text)
     run.bold = True
@@ -67,7 +120,7 @@ def add_subtitle(doc, text, indent=False):
         p.paragraph_format.left_indent = Inches(0.3)
 
 
-def add_note(doc, note="*NO CUENTA CON DICHO ELEMENTO"):
+def _build_note(doc, note="*NO CUENTA CON DICHO ELEMENTO"):
     p = doc.add_paragraph()
     run = p.add_run(note)
     run.italic = True
@@ -101,9 +154,9 @@ def create_table(doc, rows, cols, font_size=10, indent=False):
     return table
 
 
-def insertar_recuadro_foto(doc, ancho_cm=15, alto_cm=10):
+def _build_recuadro_foto(doc, ancho_cm=15, alto_cm=10):
     """
-    Inserta un recuadro placeholder (si no hay imagen).
+    Construye un recuadro placeholder (si no hay imagen).
     """
     table = doc.add_table(rows=1, cols=1)
     table.alignment = WD_TABLE_ALIGNMENT.CENTER
@@ -158,6 +211,296 @@ def insertar_recuadro_foto(doc, ancho_cm=15, alto_cm=10):
     tcPr.append(borders)
 
 
+# ------------------------
+# Fragmentos precompilados: el XML estático se construye una sola vez con
+# python-docx y luego sólo se clona (deepcopy) dentro de cada documento.
+# ------------------------
+_fragmentos = {}
+_base_docx = None
+
+
+def _body_children(doc):
+    return [el for el in doc.element.body if el.tag != qn("w:sectPr")]
+
+
+def append_body(doc, el):
+    """
+    Agrega el al final del cuerpo de doc, antes de w:sectPr.
+    """
+    body = doc.element.body
+    sectPr = body.find(qn("w:sectPr"))
+    if sectPr is not None:
+        sectPr.addprevious(el)
+    else:
+        body.append(el)
+    return el
+
+
+def fragmento(clave, construir):
+    """
+    Devuelve copias de los elementos que construir(doc) agrega a un documento
+    vacío; la construcción se hace sólo la primera vez para cada clave.
+    """
+    elementos = _fragmentos.get(clave)
+    if elementos is None:
+        borrador = Document()
+        antes = len(_body_children(borrador))
+        construir(borrador)
+        elementos = _body_children(borrador)[antes:]
+        for el in elementos:
+            el.getparent().remove(el)
+        _fragmentos[clave] = elementos
+    return [copy.deepcopy(el) for el in elementos]
+
+
+def append_fragmento(doc, clave, construir):
+    """
+    Clona el fragmento clave al final del cuerpo de doc (antes de w:sectPr).
+    Devuelve los elementos insertados.
+    """
+    elementos = fragmento(clave, construir)
+    for el in elementos:
+        append_body(doc, el)
+    return elementos
+
+
+def _set_text(elementos, text):
+    t = elementos[0].find(".//" + qn("w:t"))
+    t.text = text
+    if text != text.strip():
+        t.set("{http://www.w3.org/XML/1998/namespace}space", "preserve")
+
+
+def add_subtitle(doc, text, indent=False):
+    if not text or "\n" in text or "\t" in text:
+        return _build_subtitle(doc, text, indent=indent)
+    _set_text(append_fragmento(doc, ("subtitulo", indent), lambda d: _build_subtitle(d, "-", indent=indent)), text)
+
+
+def add_note(doc, note="*NO CUENTA CON DICHO ELEMENTO"):
+    if not note or "\n" in note or "\t" in note:
+        return _build_note(doc, note)
+    _set_text(append_fragmento(doc, ("nota",), lambda d: _build_note(d, "-")), note)
+
+
+def insertar_recuadro_foto(doc, ancho_cm=15, alto_cm=10):
+    """
+    Inserta un recuadro placeholder (si no hay imagen).
+    """
+    append_fragmento(doc, ("recuadro_foto", ancho_cm, alto_cm), lambda d: _build_recuadro_foto(d, ancho_cm, alto_cm))
+
+
+def _build_titulo(doc):
+    titulo = doc.add_paragraph()
+    run = titulo.add_run(
+        "INFORME DE MANTENIMIENTO PREVENTIVO Y CUMPLIMIENTO NORMATIVO"
+    )
+    run.bold = True
+    run.underline = True
+    run.font.size = Pt(14)
+    run.font.name = "Calibri"
+    titulo.alignment = WD_PARAGRAPH_ALIGNMENT.CENTER
+
+
+def _build_tabla_tipo_instalacion(doc):
+    tabla2 = create_table(doc, 3, 8)
+    tabla2.cell(0, 0).merge(tabla2.cell(0, 1)).text = "DOMESTICO"
+    tabla2.cell(0, 2).merge(tabla2.cell(0, 5)).text = "INDUSTRIAL"
+    tabla2.cell(0, 6).merge(tabla2.cell(0, 7)).text = "CANALIZADO"
+    for cell in tabla2.rows[0].cells:
+        set_cell_style(cell, cell.text, bold=True)
+    subtipos = [
+        "Doméstico",
+        "Comercio",
+        "Industrial",
+        "Agroindustrial",
+        "Minera",
+        "Avícola",
+        "Residencial",
+        "Comercial",
+    ]
+    for i, subtipo in enumerate(subtipos):
+        set_cell_style(tabla2.cell(1, i), subtipo)
+    for i in range(8):
+        set_cell_style(tabla2.cell(2, i), " ")
+
+
+def documento_base():
+    """
+    Documento nuevo con estilos y título ya incluidos (el paquete base se
+    serializa una vez y cada petición sólo lo vuelve a abrir desde memoria).
+    Las imágenes que se le agreguen quedan en disco hasta paquete.guardar.
+    """
+    global _base_docx
+    if _base_docx is None:
+        doc = Document()
+        _build_titulo(doc)
+        for font_size in (10, 7):
+            for bold in (False, True):
+                for align_center in (True, False):
+                    estilo_celda(doc, font_size, bold, align_center)
+        buf = io.BytesIO()
+        doc.save(buf)
+        _base_docx = buf.getvalue()
+    return paquete.imagenes_en_disco(Document(io.BytesIO(_base_docx)))
+
+
+# fecha de creación cuando el informe no trae una fecha de inspección legible
+FECHA_DOCUMENTO_FIJA = datetime(2000, 1, 1)
+
+
+def fecha_informe(informe):
+    texto = str(informe.general.get("Fecha de inspección") or "").strip()
+    for formato in ("%Y-%m-%d", "%d/%m/%Y", "%Y-%m-%d %H:%M:%S", "%d-%m-%Y"):
+        try:
+            return datetime.strptime(texto, formato)
+        except ValueError:
+            continue
+    return None
+
+
+def propiedades_documento(doc, informe):
+    """
+    Propiedades del paquete (docProps/core.xml) que dependen sólo del informe:
+    sin la hora de generación, el mismo informe da el mismo docx byte a byte.
+    """
+    props = doc.core_properties
+    fecha = fecha_informe(informe) or FECHA_DOCUMENTO_FIJA
+    props.title = "Informe de Mantenimiento"
+    props.subject = str(informe.general.get("Nombre o razón social del cliente") or "")
+    props.author = props.last_modified_by = "Informe de Mantenimiento"
+    props.created = props.modified = fecha
+    props.revision = 1
+
+
+def compilar_fragmentos():
+    """
+    Precompila el documento base y los fragmentos estáticos más usados.
+    """
+    documento_base()
+    fragmento(("subtitulo", False), lambda d: _build_subtitle(d, "-", indent=False))
+    fragmento(("subtitulo", True), lambda d: _build_subtitle(d, "-", indent=True))
+    fragmento(("nota",), lambda d: _build_note(d, "-"))
+    fragmento(("recuadro_foto", 15, 10), lambda d: _build_recuadro_foto(d, 15, 10))
+    fragmento(("marco_imagen", 15, 10), lambda d: _build_marco_imagen(d, 15, 10))
+    fragmento(("tabla_tipo_instalacion",), _build_tabla_tipo_instalacion)
+
+
+# ------------------------
+# Tablas en bloque: el XML de w:tbl se arma en una sola pasada y el formato de
+# cada celda sale de un estilo de párrafo (no de propiedades por run).
+# ------------------------
+_XML_INVALIDO = re.compile("[\x00-\x08\x0b\x0c\x0e-\x1f\ud800-\udfff\ufffe\uffff]")
+_TBL_LOOK = '<w:tblLook w:firstColumn="1" w:firstRow="1" w:lastColumn="0" w:lastRow="0" w:noHBand="0" w:noVBand="1" w:val="04A0"/>'
+
+
+def estilo_celda(doc, font_size=10, bold=False, align_center=True):
+    """
+    Id del estilo de párrafo equivalente a set_cell_style(font_size, bold, align_center);
+    se crea en el documento la primera vez que se pide.
+    """
+    cache = doc.__dict__.setdefault("_estilos_celda", {})
+    clave = (font_size, bold, align_center)
+    if clave not in cache:
+        nombre = f"Celda {font_size}pt" + (" Negrita" if bold else "") + ("" if align_center else " Izquierda")
+        try:
+            style = doc.styles[nombre]
+        except KeyError:
+            style = doc.styles.add_style(nombre, WD_STYLE_TYPE.PARAGRAPH)
+            style.base_style = doc.styles["Normal"]
+            style.font.name = "Calibri"
+            style.font.size = Pt(font_size)
+            style.font.bold = bold
+            style.paragraph_format.alignment = (
+                WD_PARAGRAPH_ALIGNMENT.CENTER if align_center else WD_PARAGRAPH_ALIGNMENT.LEFT
+            )
+        cache[clave] = style.style_id
+    return cache[clave]
+
+
+def _run_xml(text):
+    text = _XML_INVALIDO.sub("", str(text))
+    if text == "":
+        return ""
+    partes = []
+    for i, linea in enumerate(text.split("\n")):
+        if i:
+            partes.append("<w:br/>")
+        for j, trozo in enumerate(linea.split("\t")):
+            if j:
+                partes.append("<w:tab/>")
+            if trozo:
+                partes.append(f'<w:t xml:space="preserve">{xml_escape(trozo)}</w:t>')
+    return "<w:r>" + "".join(partes) + "</w:r>"
+
+
+def build_table(doc, grid, font_size=10, header_rows=1, left_cols=(), merges=(), indent=False):
+    """
+    Agrega una tabla 'Table Grid' centrada con el mismo aspecto que
+    create_table + set_cell_style, pero generando el XML de una vez.
+      grid: lista de filas con los valores (se convierten con str()).
+      header_rows: cantidad de filas iniciales en negrita.
+      left_cols: columnas alineadas a la izquierda (el resto, centradas).
+      merges: rangos (fila, col, fila_fin, col_fin) inclusivos; el valor del
+              rango es el de la celda superior izquierda.
+    """
+    nrows = len(grid)
+    ncols = max((len(r) for r in grid), default=0)
+    col_w = Emu(doc._block_width // max(ncols, 1)).twips
+    left_cols = set(left_cols)
+
+    # celda -> (gridSpan, vMerge) para el origen de cada rango; None = celda absorbida
+    spans = {}
+    for r0, c0, r1, c1 in merges:
+        for r in range(r0, r1 + 1):
+            for c in range(c0, c1 + 1):
+                spans[(r, c)] = None
+            vmerge = None if r1 == r0 else ("restart" if r == r0 else "continue")
+            spans[(r, c0)] = (c1 - c0 + 1, vmerge)
+
+    estilos = {}
+    filas = []
+    for r in range(nrows):
+        row = grid[r]
+        bold = r < header_rows
+        celdas = []
+        for c in range(ncols):
+            span = spans.get((r, c), (1, None))
+            if span is None:
+                continue
+            gridspan, vmerge = span
+            tcpr = f'<w:tcW w:type="dxa" w:w="{col_w * gridspan}"/>'
+            if gridspan > 1:
+                tcpr += f'<w:gridSpan w:val="{gridspan}"/>'
+            if vmerge == "continue":
+                celdas.append(f"<w:tc><w:tcPr>{tcpr}<w:vMerge/></w:tcPr><w:p/></w:tc>")
+                continue
+            if vmerge == "restart":
+                tcpr += '<w:vMerge w:val="restart"/>'
+            clave = (bold, c not in left_cols)
+            if clave not in estilos:
+                estilos[clave] = estilo_celda(doc, font_size, bold=clave[0], align_center=clave[1])
+            valor = row[c] if c < len(row) else ""
+            celdas.append(
+                f'<w:tc><w:tcPr>{tcpr}<w:vAlign w:val="center"/></w:tcPr>'
+                f'<w:p><w:pPr><w:pStyle w:val="{estilos[clave]}"/></w:pPr>{_run_xml(valor)}</w:p></w:tc>'
+            )
+        filas.append("<w:tr>" + "".join(celdas) + "</w:tr>")
+
+    tbl_ind = '<w:tblInd w:w="300" w:type="dxa"/>' if indent else ""
+    xml = (
+        f"<w:tbl {nsdecls('w')}>"
+        f'<w:tblPr><w:tblStyle w:val="{doc.styles["Table Grid"].style_id}"/><w:tblW w:type="auto" w:w="0"/>'
+        f'<w:jc w:val="center"/>{tbl_ind}{_TBL_LOOK}</w:tblPr>'
+        "<w:tblGrid>" + f'<w:gridCol w:w="{col_w}"/>' * ncols + "</w:tblGrid>"
+        + "".join(filas)
+        + "</w:tbl>"
+    )
+    tbl = parse_xml(xml)
+    append_body(doc, tbl)
+    return Table(tbl, doc._body)
+
+
 # ------------------------
 # Manejo de imágenes (guardado temporal y búsqueda flexible)
 # ------------------------
@@ -179,41 +522,174 @@ def save_uploaded_files_tmp(request_files):
     return saved, tmpdir
 
 
-def find_images_for_token(images_list, token):
+# handleGenerate (pagina.html) nombra cada archivo como ${token}_${idx}.${ext}
+IMAGE_NAME_RE = re.compile(r"^(?P<token>.+)_(?P<idx>\d+)\.(?P<ext>[A-Za-z0-9]+)$")
+
+
+def parse_image_filename(filename):
+    """
+    Separa '<token>_<idx>.<ext>' en (token, idx). Si el nombre no sigue el
+    patrón del frontend, el token es el nombre sin extensión e idx = 0.
+    """
+    name = os.path.basename(filename or "")
+    m = IMAGE_NAME_RE.match(name)
+    if m:
+        return m.group("token").lower(), int(m.group("idx"))
+    return os.path.splitext(name)[0].lower(), 0
+
+
+class ImageIndex:
+    """
+    Índice por token exacto de las imágenes subidas en una petición.
+    Se construye una sola vez a partir de save_uploaded_files_tmp; cada consulta
+    es O(1) por token y las imágenes entregadas quedan marcadas como usadas,
+    de modo que ninguna foto se inserta dos veces en el documento.
+    Si las imágenes vienen con un 'future' de preprocess_images, take espera
+    a que cada una esté lista recién cuando se pide.
+    Dentro de grabar() cada take queda registrado con el digest de las fotos
+    entregadas; reproducir() repite esas consultas (para la caché de secciones).
+    """
+
+    def __init__(self, images_list=None):
+        self._by_token = {}
+        self._used = set()
+        self._digests = {}
+        self._consultas = None
+        for item in images_list or []:
+            self.add(item)
+
+    def add(self, item):
+        token, idx = parse_image_filename(item["filename"])
+        entries = self._by_token.setdefault(token, [])
+        entries.append((idx, len(entries), item))
+        entries.sort(key=lambda e: e[:2])
+
+    def _elegir(self, tokens, limit, usados):
+        # items de los tokens que no están en usados (se agregan a usados)
+        found = []
+        for t in tokens or []:
+            if not t:
+                continue
+            for _, _, item in self._by_token.get(str(t).lower(), []):
+                if limit is not None and len(found) >= limit:
+                    break
+                if item["path"] not in usados:
+                    found.append(item)
+                    usados.add(item["path"])
+        return found
+
+    def take(self, tokens, limit=None):
+        """
+        Devuelve (y marca como usadas) las rutas aún no usadas de los tokens
+        dados, en el orden de los tokens y del índice de cada archivo.
+        """
+        found = [resolve_image(item) for item in self._elegir(tokens, limit, self._used)]
+        if self._consultas is not None:
+            self._consultas.append((tuple(tokens or ()), limit, tuple(self.digest(p) for p in found)))
+        return found
+
+    def digest(self, path):
+        """
+        SHA-1 del archivo a insertar (el mismo con que python-docx identifica la imagen).
+        """
+        if path not in self._digests:
+            self._digests[path] = file_sha1(path)
+        return self._digests[path]
+
+    @contextlib.contextmanager
+    def grabar(self):
+        """
+        with index.grabar() as consultas: ...  -> lista de (tokens, limit, digests) de cada take.
+        """
+        self._consultas = consultas = []
+        try:
+            yield consultas
+        finally:
+            self._consultas = None
+
+    def reproducir(self, consultas):
+        """
+        Repite consultas grabadas: si hoy entregan fotos con los mismos digests
+        las marca como usadas y devuelve {digest: ruta}; si no, None (sin marcar nada).
+        """
+        usados = set(self._used)
+        rutas = {}
+        for tokens, limit, digests in consultas:
+            found = [resolve_image(item) for item in self._elegir(tokens, limit, usados)]
+            if tuple(self.digest(p) for p in found) != digests:
+                return None
+            rutas.update(zip(digests, found))
+        self._used = usados
+        return rutas
+
+    def items(self):
+        return [item for entries in self._by_token.values() for _, _, item in entries]
+
+    def __len__(self):
+        return sum(len(v) for v in self._by_token.values())
+
+
+def find_images_for_token(images, token):
     """
-    Busca imágenes cuya filename contenga token (case-insensitive).
+    Devuelve las imágenes cuyo token (según el nombre de archivo) es exactamente token.
     Si token es None o vacío devuelve [].
     """
-    if not token:
-        return []
-    token_l = token.lower()
-    out = []
-    for item in images_list:
-        if token_l in item["filename"].lower():
-            out.append(item["path"])
-    return out
+    return find_images_for_any_token(images, [token])
 
 
-def find_images_for_any_token(images_list, tokens):
+def find_images_for_any_token(images, tokens, limit=None):
     """
     Dado un listado de tokens (strings), devuelve lista de rutas de imágenes
-    cuyo filename contenga cualquiera de los tokens (orden preservado y unicidad).
+    cuyo token coincide exactamente con alguno de ellos (orden preservado y unicidad).
+    images puede ser un ImageIndex o la lista de dicts de save_uploaded_files_tmp.
     """
     if not tokens:
         return []
-    found = []
-    seen = set()
-    for t in tokens:
-        if not t:
-            continue
-        t_l = str(t).lower()
-        for item in images_list:
-            if t_l in item["filename"].lower():
-                p = item["path"]
-                if p not in seen:
-                    found.append(p)
-                    seen.add(p)
-    return found
+    if not isinstance(images, ImageIndex):
+        images = ImageIndex(images)
+    return images.take(tokens, limit=limit)
+
+
+def _build_marco_imagen(doc, ancho_cm=15, alto_cm=10):
+    """
+    Construye el marco (tabla 1x1 con alto exacto, fondo y borde) donde va cada foto.
+    """
+    ancho_in = ancho_cm / 2.54
+    table = doc.add_table(rows=1, cols=1)
+    table.alignment = WD_TABLE_ALIGNMENT.CENTER
+    table.autofit = False
+
+    try:
+        table.cell(0, 0).width = Inches(ancho_in)
+    except Exception:
+        pass
+
+    tr = table.rows[0]._tr
+    trPr = tr.get_or_add_trPr()
+    trHeight = OxmlElement("w:trHeight")
+    trHeight.set(qn("w:val"), str(int(alto_cm * 567)))
+    trHeight.set(qn("w:hRule"), "exact")
+    trPr.append(trHeight)
+
+    cell = table.cell(0, 0)
+    paragraph = cell.paragraphs[0]
+    paragraph.alignment = WD_PARAGRAPH_ALIGNMENT.CENTER
+    cell.vertical_alignment = WD_ALIGN_VERTICAL.CENTER
+
+    tc = cell._tc
+    tcPr = tc.get_or_add_tcPr()
+    shd = OxmlElement("w:shd")
+    shd.set(qn("w:fill"), "FFFFFF")
+    tcPr.append(shd)
+    borders = OxmlElement("w:tcBorders")
+    for side in ["top", "left", "bottom", "right"]:
+        border = OxmlElement(f"w:{side}")
+        border.set(qn("w:val"), "single")
+        border.set(qn("w:sz"), "12")
+        border.set(qn("w:space"), "0")
+        border.set(qn("w:color"), "000000")
+        borders.append(border)
+    tcPr.append(borders)
 
 
 def insert_images_one_per_line(doc, image_paths, ancho_cm=15, alto_cm=10):
@@ -227,23 +703,10 @@ def insert_images_one_per_line(doc, image_paths, ancho_cm=15, alto_cm=10):
     alto_in = alto_cm / 2.54
     for p in image_paths:
         try:
-            table = doc.add_table(rows=1, cols=1)
-            table.alignment = WD_TABLE_ALIGNMENT.CENTER
-            table.autofit = False
-
-            try:
-                table.cell(0, 0).width = Inches(ancho_in)
-            except Exception:
-                pass
-
-            tr = table.rows[0]._tr
-            trPr = tr.get_or_add_trPr()
-            trHeight = OxmlElement("w:trHeight")
-            trHeight.set(qn("w:val"), str(int(alto_cm * 567)))
-            trHeight.set(qn("w:hRule"), "exact")
-            trPr.append(trHeight)
-
-            cell = table.cell(0, 0)
+            tbl = append_fragmento(
+                doc, ("marco_imagen", ancho_cm, alto_cm), lambda d: _build_marco_imagen(d, ancho_cm, alto_cm)
+            )[0]
+            cell = Table(tbl, doc._body).cell(0, 0)
             paragraph = cell.paragraphs[0]
             run = paragraph.add_run()
             try:
@@ -253,99 +716,314 @@ def insert_images_one_per_line(doc, image_paths, ancho_cm=15, alto_cm=10):
                     doc.add_picture(p, width=Inches(ancho_in), height=Inches(alto_in))
                 except Exception:
                     cell.text = "ESPACIO PARA IMAGEN (ERROR AL INSERTAR)"
-            paragraph.alignment = WD_PARAGRAPH_ALIGNMENT.CENTER
-            cell.vertical_alignment = WD_ALIGN_VERTICAL.CENTER
-
-            tc = cell._tc
-            tcPr = tc.get_or_add_tcPr()
-            shd = OxmlElement("w:shd")
-            shd.set(qn("w:fill"), "FFFFFF")
-            tcPr.append(shd)
-            borders = OxmlElement("w:tcBorders")
-            for side in ["top", "left", "bottom", "right"]:
-                border = OxmlElement(f"w:{side}")
-                border.set(qn("w:val"), "single")
-                border.set(qn("w:sz"), "12")
-                border.set(qn("w:space"), "0")
-                border.set(qn("w:color"), "000000")
-                borders.append(border)
-            tcPr.append(borders)
+                    paragraph.alignment = WD_PARAGRAPH_ALIGNMENT.CENTER
         except Exception:
             insertar_recuadro_foto(doc, ancho_cm=ancho_cm, alto_cm=alto_cm)
 
 
 # ------------------------
-# Función central: genera docx desde DataFrames + actividades + lista de imágenes temporales
+# Grilla de fotos (diseño 'compacto'): en lugar de una tabla de 15x10 cm por
+# foto, una sola tabla de GRILLA_COLUMNAS columnas con la foto reducida (sin
+# deformarla) y su leyenda en cada celda.
 # ------------------------
-def generar_docx_desde_dfs(
-    df_info, df_tanques, df_accesorios, df_red, df_equipos, df_obs, actividades_list=None, images_list=None
-):
+GRILLA_COLUMNAS = 2
+# alto de la foto respecto del ancho de la celda (el recuadro normal es 15x10)
+GRILLA_PROPORCION = 10 / 15
+GRILLA_MARGEN_CM = 0.4
+
+
+class CeldaFoto(NamedTuple):
+    leyenda: str
+    path: object = None  # None: recuadro vacío (o la nota, si hay)
+    nota: object = None
+
+
+class FilaTitulo(NamedTuple):
+    texto: str
+
+
+def _dibujo_ajustado(doc, path, ancho_cm, alto_cm):
     """
-    actividades_list: lista de dicts {id, contexto, titulo, tiempo, estado}
-    images_list: lista de dicts {'field','filename','path'}
+    wp:inline de la foto dentro de ancho_cm x alto_cm, conservando su proporción.
     """
-    actividades_list = actividades_list or []
-    images_list = images_list or []
-    doc = Document()
+    rid, image = doc.part.get_or_add_image(path)
+    ancho, alto = Inches(ancho_cm / 2.54), Inches(alto_cm / 2.54)
+    if image.px_width * alto >= image.px_height * ancho:
+        cx, cy = image.scaled_dimensions(ancho, None)
+    else:
+        cx, cy = image.scaled_dimensions(None, alto)
+    return CT_Inline.new_pic_inline(doc.part.next_id, rid, image.filename, cx, cy)
 
-    # --- Título
-    titulo = doc.add_paragraph()
-    run = titulo.add_run(
-        "INFORME DE MANTENIMIENTO PREVENTIVO Y CUMPLIMIENTO NORMATIVO"
+
+def build_grilla_fotos(doc, celdas, columnas=GRILLA_COLUMNAS):
+    """
+    Agrega una tabla con las celdas de a `columnas` por fila, armada de una vez
+    como build_table. celdas: CeldaFoto (foto, recuadro vacío o nota) o
+    FilaTitulo (fila completa con el texto; corta la fila en curso).
+    """
+    col_w = Emu(doc._block_width // columnas)
+    ancho_cm = col_w.cm - GRILLA_MARGEN_CM
+    alto_cm = ancho_cm * GRILLA_PROPORCION
+    alto_fila = int((alto_cm + 1) * 567)
+    estilo_foto = estilo_celda(doc, 10, bold=True)
+    estilo_leyenda = estilo_celda(doc, 7, bold=True)
+    estilo_titulo = estilo_celda(doc, 10, bold=False, align_center=False)
+    tc_w = f'<w:tcW w:type="dxa" w:w="{col_w.twips}"/>'
+
+    filas = []
+    fotos = []  # (número de w:tc en la tabla, ruta)
+    n_tc = 0
+    fila = []
+
+    def cerrar_fila():
+        nonlocal n_tc
+        if not fila:
+            return
+        con_foto = any(c.nota is None for c in fila)
+        celdas_xml = []
+        for c in fila + [None] * (columnas - len(fila)):
+            if c is None:
+                celdas_xml.append(f"<w:tc><w:tcPr>{tc_w}</w:tcPr><w:p/></w:tc>")
+            else:
+                if c.path is not None:
+                    fotos.append((n_tc, c.path))
+                    contenido = ""
+                elif c.nota is not None:
+                    contenido = (
+                        '<w:r><w:rPr><w:i/><w:color w:val="FF0000"/></w:rPr>'
+                        f'<w:t xml:space="preserve">{xml_escape(str(c.nota))}</w:t></w:r>'
+                    )
+                else:
+                    contenido = _run_xml("ESPACIO PARA IMAGEN")
+                celdas_xml.append(
+                    f'<w:tc><w:tcPr>{tc_w}<w:vAlign w:val="center"/></w:tcPr>'
+                    f'<w:p><w:pPr><w:pStyle w:val="{estilo_foto}"/></w:pPr>{contenido}</w:p>'
+                    f'<w:p><w:pPr><w:pStyle w:val="{estilo_leyenda}"/></w:pPr>{_run_xml(c.leyenda)}</w:p></w:tc>'
+                )
+            n_tc += 1
+        alto = f'<w:trHeight w:val="{alto_fila}" w:hRule="atLeast"/>' if con_foto else ""
+        filas.append(f"<w:tr><w:trPr><w:cantSplit/>{alto}</w:trPr>" + "".join(celdas_xml) + "</w:tr>")
+        fila.clear()
+
+    for celda in celdas:
+        if isinstance(celda, FilaTitulo):
+            cerrar_fila()
+            filas.append(
+                "<w:tr><w:trPr><w:cantSplit/></w:trPr>"
+                f'<w:tc><w:tcPr><w:tcW w:type="dxa" w:w="{col_w.twips * columnas}"/>'
+                f'<w:gridSpan w:val="{columnas}"/></w:tcPr>'
+                f'<w:p><w:pPr><w:pStyle w:val="{estilo_titulo}"/><w:keepNext/></w:pPr>{_run_xml(celda.texto)}</w:p>'
+                "</w:tc></w:tr>"
+            )
+            n_tc += 1
+            continue
+        fila.append(celda)
+        if len(fila) == columnas:
+            cerrar_fila()
+    cerrar_fila()
+    if not filas:
+        return None
+
+    xml = (
+        f"<w:tbl {nsdecls('w')}>"
+        f'<w:tblPr><w:tblStyle w:val="{doc.styles["Table Grid"].style_id}"/><w:tblW w:type="auto" w:w="0"/>'
+        f'<w:jc w:val="center"/><w:tblLayout w:type="fixed"/>{_TBL_LOOK}</w:tblPr>'
+        "<w:tblGrid>" + f'<w:gridCol w:w="{col_w.twips}"/>' * columnas + "</w:tblGrid>"
+        + "".join(filas)
+        + "</w:tbl>"
     )
-    run.bold = True
-    run.underline = True
-    run.font.size = Pt(14)
-    run.font.name = "Calibri"
-    titulo.alignment = WD_PARAGRAPH_ALIGNMENT.CENTER
+    tbl = append_body(doc, parse_xml(xml))
+    tcs = list(tbl.iter(qn("w:tc")))
+    for i, path in fotos:
+        p = tcs[i].find(qn("w:p"))
+        run = p.add_r()
+        try:
+            inline = _dibujo_ajustado(doc, path, ancho_cm, alto_cm)
+        except Exception:
+            run.text = "ESPACIO PARA IMAGEN (ERROR AL INSERTAR)"
+        else:
+            run.add_drawing(inline)
+    return Table(tbl, doc._body)
+
+
+def celdas_fotos(leyenda, paths, minimo=1):
+    """
+    CeldaFoto numeradas para una lista de fotos, completando con recuadros vacíos hasta minimo.
+    """
+    total = max(len(paths), minimo)
+    celdas = []
+    for k in range(total):
+        texto = f"{leyenda} ({k + 1}/{total})" if total > 1 else leyenda
+        celdas.append(CeldaFoto(texto, paths[k] if k < len(paths) else None))
+    return celdas
+
+
+# ------------------------
+# Caché de secciones: cada sección del cuerpo se guarda ya armada (XML) con
+# clave en su nombre + los campos del Informe que usa. Las fotos que pidió se
+# guardan como consultas (tokens -> digests) y se comparan al reutilizarla, así
+# una regeneración sólo rearma las secciones cuyos datos o fotos cambiaron.
+# ------------------------
+# Tamaño máximo (XML serializado) de la caché de secciones de cada proceso; 0 la desactiva
+SECCIONES_CACHE_MAX_BYTES = int(os.environ.get("SECCIONES_CACHE_MAX_BYTES", 64 * 1024 * 1024))
+
+_R_EMBED = qn("r:embed")
+
 
+class SeccionArmada(NamedTuple):
+    elementos: tuple  # XML de cada elemento del cuerpo
+    consultas: tuple  # (tokens, limit, digests) de cada take
+    imagenes: dict  # rId en el XML -> digest de la foto
+    tamano: int
+
+
+_secciones_cache = OrderedDict()
+_secciones_cache_bytes = 0
+_secciones_cache_lock = threading.Lock()
+
+
+def _reset_secciones_cache_in_child():
+    global _secciones_cache_lock
+    _secciones_cache_lock = threading.Lock()
+
+
+if hasattr(os, "register_at_fork"):
+    os.register_at_fork(after_in_child=_reset_secciones_cache_in_child)
+
+
+def clave_seccion(nombre, informe, campos):
+    datos = repr([getattr(informe, c) for c in campos])
+    return nombre, hashlib.sha256(datos.encode("utf-8")).hexdigest()
+
+
+def _cache_get(clave):
+    with _secciones_cache_lock:
+        armada = _secciones_cache.get(clave)
+        if armada is not None:
+            _secciones_cache.move_to_end(clave)
+        return armada
+
+
+def _cache_put(clave, armada):
+    global _secciones_cache_bytes
+    if armada.tamano > SECCIONES_CACHE_MAX_BYTES:
+        return
+    with _secciones_cache_lock:
+        anterior = _secciones_cache.pop(clave, None)
+        if anterior is not None:
+            _secciones_cache_bytes -= anterior.tamano
+        _secciones_cache[clave] = armada
+        _secciones_cache_bytes += armada.tamano
+        while _secciones_cache_bytes > SECCIONES_CACHE_MAX_BYTES:
+            _, vieja = _secciones_cache.popitem(last=False)
+            _secciones_cache_bytes -= vieja.tamano
+
+
+def _capturar_seccion(doc, elementos, consultas):
+    # None si la sección tiene imágenes que no salieron de sus consultas
+    digests = {d for _, _, ds in consultas for d in ds}
+    imagenes = {}
+    for el in elementos:
+        for blip in el.iter(qn("a:blip")):
+            rid = blip.get(_R_EMBED)
+            imagenes[rid] = doc.part.related_parts[rid].sha1
+    if not set(imagenes.values()) <= digests:
+        return None
+    xml = tuple(etree.tostring(el) for el in elementos)
+    return SeccionArmada(xml, tuple(consultas), imagenes, sum(len(x) for x in xml))
+
+
+def _pegar_seccion(doc, armada, rutas):
+    rids = {}
+    for xml in armada.elementos:
+        el = parse_xml(xml)
+        for blip in el.iter(qn("a:blip")):
+            digest = armada.imagenes[blip.get(_R_EMBED)]
+            if digest not in rids:
+                rids[digest], _ = doc.part.get_or_add_image(rutas[digest])
+            blip.set(_R_EMBED, rids[digest])
+        append_body(doc, el)
+
+
+def armar_seccion(doc, informe, images_list, nombre, campos, construir):
+    """
+    Agrega la sección al final de doc: desde la caché si sus campos y sus fotos
+    no cambiaron, o con construir(doc, informe, images_list) (y se guarda).
+    Devuelve True si salió de la caché.
+    """
+    if SECCIONES_CACHE_MAX_BYTES <= 0:
+        construir(doc, informe, images_list)
+        return False
+    clave = clave_seccion(nombre, informe, campos)
+    armada = _cache_get(clave)
+    if armada is not None:
+        rutas = images_list.reproducir(armada.consultas)
+        if rutas is not None:
+            _pegar_seccion(doc, armada, rutas)
+            metricas.SECCIONES_CACHE.inc(resultado="hit")
+            return True
+    antes = len(_body_children(doc))
+    with images_list.grabar() as consultas:
+        construir(doc, informe, images_list)
+    armada = _capturar_seccion(doc, _body_children(doc)[antes:], consultas)
+    if armada is not None:
+        _cache_put(clave, armada)
+    metricas.SECCIONES_CACHE.inc(resultado="miss")
+    return False
+
+
+def renumerar_dibujos(doc):
+    """
+    Ids únicos para cada wp:docPr (las secciones reutilizadas traen los del documento original).
+    """
+    for i, docpr in enumerate(doc.element.body.iter(qn("wp:docPr")), start=1):
+        docpr.set("id", str(i))
+
+
+# ------------------------
+# Secciones del cuerpo: cada una es una función (doc, informe, images_list)
+# que agrega sus elementos al final del documento.
+# ------------------------
+MAPA_ACCESORIOS_RED = {
+    "llenado_toma_desplazada": "5.1. Válvula de llenado (toma desplazada)",
+    "retorno_toma_desplazada": "5.2. Válvula de retorno (toma desplazada)",
+    "alivio_hidrostatico": "5.3. Válvula de alivio hidrostático",
+    "regulador_primera_etapa": "5.4. Regulador de primera etapa",
+    "alivio": "5.5. Válvula de alivio",
+    "regulador_2da": "5.6. Regulador de segunda etapa",
+    "pull_away": "5.7. Válvula Pull Away",
+}
+
+
+def accesorios_red(informe):
+    """
+    {tipo de accesorio de red: lista} + 'zona_medidores' (bool), como lo usa la sección 9.
+    """
+    red = {clave: informe.red_por_tipo(clave) for clave in MAPA_ACCESORIOS_RED}
+    red["zona_medidores"] = any("true" in str(r.codigo).lower() for r in informe.red_por_tipo("zona_medidores"))
+    return red
+
+
+def _seccion_cliente(doc, informe, images_list):
     # === 1. Información de cliente
     add_subtitle(doc, "1. INFORMACIÓN DE CLIENTE")
-    campos = [
-        "Nombre o razón social del cliente",
-        "Fecha de inspección",
-        "Dirección",
-        "RUC o DNI",
-        "Número de instalación",
-        "Distrito",
-        "Departamento",
-        "Coordenadas",
-        "Nombre del contacto",
-        "Número del contacto",
-        "Correo de contacto",
-    ]
-    tabla1 = create_table(doc, len(campos), 2)
-    datos_generales = {}
-    if df_info is not None and not df_info.empty:
-        datos_generales = df_info.iloc[0].to_dict()
-    for i, campo in enumerate(campos):
-        valor = datos_generales.get(campo, None)
-        set_cell_style(tabla1.cell(i, 0), campo, align_center=False)
-        set_cell_style(tabla1.cell(i, 1), valOrDash(valor), align_center=False)
+    campos = CAMPOS_GENERALES
+    datos_generales = informe.general or {}
+    build_table(
+        doc,
+        [[campo, valOrDash(datos_generales.get(campo, None))] for campo in campos],
+        header_rows=0,
+        left_cols=(0, 1),
+    )
+
 
+def _seccion_tipo_instalacion(doc, informe, images_list):
     # === 2. Tipo de instalacion
     add_subtitle(doc, "2. TIPO DE INSTALACION")
-    tabla2 = create_table(doc, 3, 8)
-    tabla2.cell(0, 0).merge(tabla2.cell(0, 1)).text = "DOMESTICO"
-    tabla2.cell(0, 2).merge(tabla2.cell(0, 5)).text = "INDUSTRIAL"
-    tabla2.cell(0, 6).merge(tabla2.cell(0, 7)).text = "CANALIZADO"
-    for cell in tabla2.rows[0].cells:
-        set_cell_style(cell, cell.text, bold=True)
-    subtipos = [
-        "Doméstico",
-        "Comercio",
-        "Industrial",
-        "Agroindustrial",
-        "Minera",
-        "Avícola",
-        "Residencial",
-        "Comercial",
-    ]
-    for i, subtipo in enumerate(subtipos):
-        set_cell_style(tabla2.cell(1, i), subtipo)
-    for i in range(8):
-        set_cell_style(tabla2.cell(2, i), " ")
+    append_fragmento(doc, ("tabla_tipo_instalacion",), _build_tabla_tipo_instalacion)
 
+
+def _seccion_tanques(doc, informe, images_list):
     # === 3. Tanques inspeccionados
     add_subtitle(doc, "3. TANQUES INSPECCIONADOS")
     headers3 = [
@@ -357,105 +1035,40 @@ def generar_docx_desde_dfs(
         "Fabricante de Tanque",
         "% Actual",
     ]
-    num_tanques = len(df_tanques) if df_tanques is not None else 0
-    tabla3 = create_table(doc, num_tanques + 1, len(headers3))
-    for j, h in enumerate(headers3):
-        set_cell_style(tabla3.cell(0, j), h, bold=True)
-    for i in range(num_tanques):
-        for j, col in enumerate(headers3):
-            valor = None
-            if df_tanques is not None and col in df_tanques.columns:
-                valor = df_tanques.iloc[i][col]
-            else:
-                if col == "N° de serie" and df_tanques is not None:
-                    if "serie" in df_tanques.columns:
-                        valor = df_tanques.iloc[i].get("serie", None)
-            if j == 0:
-                valor = str(i + 1)
-            set_cell_style(tabla3.cell(i + 1, j), valOrDash(valor))
+    grid3 = [headers3]
+    for i, t in enumerate(informe.tanques):
+        grid3.append([str(i + 1)] + [valOrDash(t.columna(col)) for col in headers3[1:]])
+    build_table(doc, grid3)
 
+
+def _seccion_accesorios_tanques(doc, informe, images_list):
     # === 4. Accesorios de los tanques
     add_subtitle(doc, "4. ACCESORIOS DE LOS TANQUES")
-    accesorios = [
-        "Válvula de llenado",
-        "Medidor de porcentaje",
-        "Válvula de seguridad",
-        "Válvula de drenaje",
-        "Multiválvula",
-        "Válvula exceso de flujo (Retorno)",
-        "Válvula exceso de flujo (Bypass)",
-        "Val 3",
-    ]
-    atributos = ["Marca", "Código", "Serie", "Mes/Año de fabricación"]
-    if df_accesorios is None or df_accesorios.empty:
-        df_accesorios = pd.DataFrame(columns=["Tanque", "Atributo"] + accesorios)
-    unique_tanques = (
-        sorted(df_accesorios["Tanque"].unique()) if not df_accesorios.empty else []
-    )
-    nrows = 1 + len(atributos) * len(unique_tanques) if unique_tanques else 2
-    tabla4 = doc.add_table(rows=nrows, cols=2 + len(accesorios))
-    tabla4.style = "Table Grid"
-    tabla4.alignment = WD_TABLE_ALIGNMENT.CENTER
-    set_cell_style(tabla4.cell(0, 0), "N", font_size=7, bold=True)
-    set_cell_style(tabla4.cell(0, 1), "Tanques", font_size=7, bold=True)
-    for i, acc in enumerate(accesorios):
-        set_cell_style(tabla4.cell(0, i + 2), acc, font_size=7, bold=True)
-    row_idx = 1
+    accesorios = ACCESORIOS_TANQUE
+    atributos = ATRIBUTOS_ACCESORIO
+    unique_tanques = informe.tanques_accesorios
+    grid4 = [["N", "Tanques"] + accesorios]
+    merges4 = []
     for tanque in unique_tanques:
-        grupo = df_accesorios[df_accesorios["Tanque"] == tanque]
-        for attr in atributos:
-            set_cell_style(tabla4.cell(row_idx, 1), attr, font_size=7)
-            for i, acc in enumerate(accesorios):
-                try:
-                    val = grupo[grupo["Atributo"] == attr][acc].values
-                    if len(val) and pd.notna(val[0]) and str(val[0]).strip() != "":
-                        valor = val[0]
-                    else:
-                        valor = "-"
-                except Exception:
-                    valor = "-"
-                set_cell_style(tabla4.cell(row_idx, i + 2), str(valor), font_size=7)
-            row_idx += 1
-        # merge number column
-        if row_idx - 1 >= row_idx - 4:
-            tabla4.cell(row_idx - 4, 0).merge(tabla4.cell(row_idx - 1, 0))
-            set_cell_style(tabla4.cell(row_idx - 4, 0), str(tanque), font_size=7)
-
+        # la columna N se combina en las filas de atributos del tanque
+        merges4.append((len(grid4), 0, len(grid4) + len(atributos) - 1, 0))
+        for k, attr in enumerate(atributos):
+            fila4 = [str(tanque) if k == 0 else "", attr]
+            for acc in accesorios:
+                valor = informe.accesorios.get((tanque, attr, acc))
+                fila4.append(str(valor) if valor is not None and str(valor).strip() != "" else "-")
+            grid4.append(fila4)
+    if not unique_tanques:
+        grid4.append([""] * (2 + len(accesorios)))
+    build_table(doc, grid4, font_size=7, merges=merges4)
+
+
+def _seccion_accesorios_red(doc, informe, images_list):
     # === 5. Accesorios en redes ===
     add_subtitle(doc, "5. ACCESORIOS EN REDES")
-    df_red_local = (
-        df_red.copy()
-        if df_red is not None
-        else pd.DataFrame(
-            columns=["Tipo", "Marca", "Serie", "Código", "Mes/Año de fabricación"]
-        )
-    )
-    if "Tipo" in df_red_local.columns:
-        df_red_local["Tipo"] = df_red_local["Tipo"].astype(str).str.lower().fillna("")
-    else:
-        df_red_local["Tipo"] = ""
-    # Mapa de accesorios
-    mapa_accesorios = {
-        "llenado_toma_desplazada": "5.1. Válvula de llenado (toma desplazada)",
-        "retorno_toma_desplazada": "5.2. Válvula de retorno (toma desplazada)",
-        "alivio_hidrostatico": "5.3. Válvula de alivio hidrostático",
-        "regulador_primera_etapa": "5.4. Regulador de primera etapa",
-        "alivio": "5.5. Válvula de alivio",
-        "regulador_2da": "5.6. Regulador de segunda etapa",
-        "pull_away": "5.7. Válvula Pull Away",
-    }
-    grupos = df_red_local.groupby("Tipo") if not df_red_local.empty else {}
-
-    accesorios_red_dict = {}
-    for clave, titulo in mapa_accesorios.items():
+    for clave, titulo in MAPA_ACCESORIOS_RED.items():
         add_subtitle(doc, titulo, indent=True)
-        lista = (
-            grupos.get_group(clave).to_dict(orient="records")
-            if (hasattr(grupos, "groups") and clave in grupos.groups)
-            else []
-        )
-        filas = max(2, len(lista) + 1)
-        tabla = create_table(doc, filas, 5, indent=True)
+        lista = informe.red_por_tipo(clave)
         headers = [
             "Válvula",
             "Marca",
@@ -463,95 +1076,49 @@ def generar_docx_desde_dfs(
             "Código",
             "Mes/Año de fabricación",
         ]
-        for j, h in enumerate(headers):
-            set_cell_style(tabla.cell(0, j), h, bold=True)
+        grid = [headers]
         if lista:
             for idx, acc in enumerate(lista):
-                set_cell_style(tabla.cell(idx + 1, 0), str(idx + 1))
-                set_cell_style(tabla.cell(idx + 1, 1), valOrDash(acc.get("Marca")))
-                set_cell_style(tabla.cell(idx + 1, 2), valOrDash(acc.get("Serie")))
-                set_cell_style(tabla.cell(idx + 1, 3), valOrDash(acc.get("Código")))
-                set_cell_style(
-                    tabla.cell(idx + 1, 4), valOrDash(acc.get("Mes/Año de fabricación"))
+                grid.append(
+                    [
+                        str(idx + 1),
+                        valOrDash(acc.marca),
+                        valOrDash(acc.serie),
+                        valOrDash(acc.codigo),
+                        valOrDash(acc.fabricacion),
+                    ]
                 )
         else:
-            for j in range(5):
-                set_cell_style(tabla.cell(1, j), "-")
-        accesorios_red_dict[clave] = lista
+            grid.append(["-"] * 5)
+        build_table(doc, grid, indent=True)
 
-    # Zona medidores 
-    zona_medidores_bool = False
-    try:
-        zona_medidores_bool = (
-            df_red_local[df_red_local["Tipo"] == "zona_medidores"]["Código"]
-            .astype(str)
-            .str.lower()
-            .str.contains("true")
-            .any()
-        )
-    except Exception:
-        zona_medidores_bool = False
-    accesorios_red_dict["zona_medidores"] = zona_medidores_bool
 
+def _seccion_equipos(doc, informe, images_list):
     # === 6. Equipos de la instalación ===
     add_subtitle(doc, "6. EQUIPOS DE LA INSTALACIÓN")
-    df_equipos_local = df_equipos.copy() if df_equipos is not None else pd.DataFrame()
-    if "Tipo de equipo" in df_equipos_local.columns:
-        df_equipos_local["Tipo de equipo"] = (
-            df_equipos_local["Tipo de equipo"].astype(str).str.lower().fillna("")
-        )
-    else:
-        df_equipos_local["Tipo de equipo"] = ""
-
-    estructura_equipos = {
-        "vaporizador": ["Equipo", "Marca", "Tipo", "Serie", "Año de fabricación", "Capacidad"],
-        "quemador": ["Equipo", "Marca", "Modelo", "Tipo", "Serie", "Año de fabricación", "Capacidad (kW)"],
-        "decantador": ["Equipo", "Fabricante", "Modelo", "Tipo", "Serie", "Año de fabricación", "Capacidad (gal)"],
-        "dispensador_de_gas": ["Equipo", "Marca", "Modelo", "Serie"],
-        "bomba": ["Equipo", "Marca", "Modelo", "Serie"],
-        "tablero": ["Equipo", "TAG"],
-        "estabilizador": ["Equipo", "Marca", "Modelo", "Serie"],
-        "detector": ["Equipo", "Marca", "Modelo", "Serie"],
-        "extintor": ["Equipo", "Marca", "Serie", "Año de fabricación", "Próxima PH", "Fecha de próxima recarga"],
-    }
-
-    grupos_e = df_equipos_local.groupby("Tipo de equipo") if not df_equipos_local.empty else {}
+    estructura_equipos = ESTRUCTURA_EQUIPOS
+    equipos_instalacion = {k: informe.equipos_por_tipo(k) for k in estructura_equipos.keys()}
 
     for idx, (tipo_equipo, columnas) in enumerate(estructura_equipos.items(), start=1):
         nombre_limpio = tipo_equipo.replace("_", " ").capitalize()
         subtitulo = f"6.{idx}. {nombre_limpio}"
         add_subtitle(doc, subtitulo, indent=True)
-        datos = (
-            grupos_e.get_group(tipo_equipo)
-            if (hasattr(grupos_e, "groups") and tipo_equipo in grupos_e.groups)
-            else pd.DataFrame(columns=columnas)
-        )
-        filas = max(2, len(datos) + 1)
-        tabla = create_table(doc, filas, len(columnas), indent=True)
-        for j, col in enumerate(columnas):
-            set_cell_style(tabla.cell(0, j), col, bold=True)
-        if not datos.empty:
-            for i, (_, fila) in enumerate(datos.iterrows()):
-                for j, col in enumerate(columnas):
-                    valor = fila.get(col, None)
-                    if j == 0:
-                        set_cell_style(tabla.cell(i + 1, j), str(i + 1))
-                    else:
-                        set_cell_style(tabla.cell(i + 1, j), valOrDash(valor))
+        datos = equipos_instalacion[tipo_equipo]
+        grid = [list(columnas)]
+        if datos:
+            for i, fila in enumerate(datos):
+                grid.append(
+                    [str(i + 1)] + [valOrDash(fila.get(col, None)) for col in columnas[1:]]
+                )
         else:
-            for j in range(len(columnas)):
-                set_cell_style(tabla.cell(1, j), "-")
-
-    equipos_instalacion = {
-        k: grupos_e.get_group(k).to_dict(orient="records")
-        if (hasattr(grupos_e, "groups") and k in grupos_e.groups)
-        else []
-        for k in estructura_equipos.keys()
-    }
+            grid.append(["-"] * len(columnas))
+        build_table(doc, grid, indent=True)
 
+
+def _seccion_observaciones(doc, informe, images_list):
     # === 7. Observaciones generales ===
     add_subtitle(doc, "7. OBSERVACIONES GENERALES")
-    df_obs_local = df_obs.copy() if df_obs is not None else pd.DataFrame(columns=["Subpunto", "Observación"])
+    observaciones = informe.observaciones or {}
     subtitulos_7 = {
         "7.1": "7.1. Observaciones al cliente",
         "7.2": "7.2. Observaciones en red de llenado y retorno",
@@ -560,9 +1127,9 @@ def generar_docx_desde_dfs(
     }
     for clave, titulo in subtitulos_7.items():
         add_subtitle(doc, titulo, indent=True)
-        texto = df_obs_local[df_obs_local["Subpunto"] == clave]["Observación"].values
-        if len(texto) and str(texto[0]).strip() != "":
-            doc.add_paragraph(str(texto[0]).strip())
+        texto = observaciones.get(clave)
+        if texto is not None and str(texto).strip() != "":
+            doc.add_paragraph(str(texto).strip())
         else:
             doc.add_paragraph("-")
 
@@ -578,41 +1145,37 @@ def generar_docx_desde_dfs(
         "Detector de gases",
         "Extintor",
     ]
-    tabla_obs = create_table(doc, len(equipos_obs) + 1, 2, indent=True)
-    set_cell_style(tabla_obs.cell(0, 0), "Equipo", bold=True)
-    set_cell_style(tabla_obs.cell(0, 1), "Observación", bold=True)
-    texto_75 = df_obs_local[df_obs_local["Subpunto"] == "7.5"]["Observación"].values
+    texto_75 = observaciones.get("7.5")
     observaciones_75 = []
-    if len(texto_75) and str(texto_75[0]).strip():
-        observaciones_75 = [x.strip() for x in str(texto_75[0]).split(".") if x.strip()]
+    if texto_75 is not None and str(texto_75).strip():
+        observaciones_75 = [x.strip() for x in str(texto_75).split(".") if x.strip()]
+    grid_obs = [["Equipo", "Observación"]]
     for i, equipo in enumerate(equipos_obs):
-        set_cell_style(tabla_obs.cell(i + 1, 0), equipo)
-        set_cell_style(tabla_obs.cell(i + 1, 1), observaciones_75[i] if i < len(observaciones_75) else "-")
+        grid_obs.append([equipo, observaciones_75[i] if i < len(observaciones_75) else "-"])
+    build_table(doc, grid_obs, indent=True)
+
 
+def _seccion_evidencia_general(doc, informe, images_list):
     # === 8. Evidencia general ===
     add_subtitle(doc, "8. EVIDENCIA FOTOGRÁFICA (del establecimiento)")
     # tokens que el frontend puede usar: 'sub_8_establecimiento' o '8' o '8_establecimiento'
     imgs_8 = find_images_for_any_token(images_list, ["sub_8_establecimiento", "8_establecimiento", "8"])
-    if imgs_8:
+    if informe.diseno == "compacto":
+        build_grilla_fotos(doc, celdas_fotos("FOTO DEL ESTABLECIMIENTO", imgs_8))
+    elif imgs_8:
         insert_images_one_per_line(doc, imgs_8, ancho_cm=15, alto_cm=10)
     else:
         insertar_recuadro_foto(doc)
 
+
+def _seccion_evidencia_elementos(doc, informe, images_list):
     # === 9. Evidencia fotográfica de elementos de la instalación ===
     add_subtitle(doc, "9. Evidencia fotográfica de elementos de la instalación")
 
     # Construyo un bloque flexible: intentaré encontrar imágenes por tokens numéricos (9_1, 9_2...) y por tokens descriptivos que usa el frontend
-    tanques_for_block = (
-        df_tanques.to_dict(orient="records")
-        if df_tanques is not None and not df_tanques.empty
-        else []
-    )
-    equipos_for_block = (
-        df_equipos_local.to_dict(orient="records")
-        if df_equipos_local is not None and not df_equipos_local.empty
-        else []
-    )
-    accesorios_red_for_block = accesorios_red_dict
+    tanques_for_block = informe.tanques
+    accesorios_red_for_block = accesorios_red(informe)
+    equipos_instalacion = {k: informe.equipos_por_tipo(k) for k in ESTRUCTURA_EQUIPOS.keys()}
 
     bloque_9 = []
     contador = 1
@@ -622,19 +1185,19 @@ def generar_docx_desde_dfs(
 
     # Placas por tanque -> tokens: numeric '9_{n}' and descriptive 'tanque_{i}_placa'
     for i, t in enumerate(tanques_for_block):
-        serie = valOrDash(t.get("N° de serie") or t.get("serie"))
+        serie = valOrDash(t.serie)
         tokens = [f"9_{contador}", f"tanque_{i+1}_placa", f"tanque_{i+1}__placa"]
         bloque_9.append((f"9.{contador}. PLACA DE TANQUE {i+1} DE SERIE: {serie}", True, 1, tokens)); contador += 1
 
     # Panorámica de alrededores por tanque (4 recuadros). tokens: tanque_{i}_panoramica
     for i, t in enumerate(tanques_for_block):
-        serie = valOrDash(t.get("N° de serie") or t.get("serie"))
+        serie = valOrDash(t.serie)
         tokens = [f"9_{contador}", f"tanque_{i+1}_panoramica", f"tanque_{i+1}__panoramica"]
         bloque_9.append((f"9.{contador}. FOTO PANORÁMICA DE ALREDEDORES DE TANQUE {i+1} DE SERIE: {serie}", True, 4, tokens)); contador += 1
 
     # Bloque iterativo por tanque: varias fotos específicas
     for i, t in enumerate(tanques_for_block):
-        serie = valOrDash(t.get("N° de serie") or t.get("serie"))
+        serie = valOrDash(t.serie)
         items_per_tank = [
             ("FOTO DE BASES DE CONCRETO", f"tanque_{i+1}_bases"),
             ("FOTO DE MANÓMETROS 0-60 PSI", f"tanque_{i+1}_manometro_0_60"),
@@ -660,7 +1223,8 @@ def generar_docx_desde_dfs(
         if lista_eq:
             for eq in lista_eq:
                 serie = valOrDash(eq.get("Serie"))
-                tokens = [f"9_{contador}", f"{tipo}_placa", f"{tipo}_foto", f"equipo_{serie}_placa"]
+                # sólo sus tokens: la foto del equipo ('{tipo}_foto') es del recuadro siguiente
+                tokens = [f"9_{contador}", f"{tipo}_placa", f"equipo_{serie}_placa"]
                 bloque_9.append((f"9.{contador}. FOTO DE PLACA DE {tipo.upper()} DE SERIE: {serie}", True, 1, tokens)); contador += 1
                 bloque_9.append((f"9.{contador}. FOTO DE {tipo.upper()}", True, 1, [f"9_{contador}", f"{tipo}_foto"])); contador += 1
         else:
@@ -695,7 +1259,7 @@ def generar_docx_desde_dfs(
         # only mark 'existe' True for those that actually are present (so frontend shows valve rows only when user added that valve)
         for idx in range(cantidad):
             if idx < len(lista):
-                codigo = valOrDash(lista[idx].get("Código"))
+                codigo = valOrDash(lista[idx].codigo)
                 existe = True
             else:
                 codigo = "-"
@@ -712,9 +1276,13 @@ def generar_docx_desde_dfs(
     def add_foto_con_subtitulo_with_tokens(doc, texto, candidate_tokens, incluir_imagen=True, num_recuadros=1):
         add_subtitle(doc, texto, indent=True)
         if incluir_imagen:
-            imgs = find_images_for_any_token(images_list, candidate_tokens if isinstance(candidate_tokens, (list,tuple)) else [candidate_tokens])
+            imgs = find_images_for_any_token(
+                images_list,
+                candidate_tokens if isinstance(candidate_tokens, (list, tuple)) else [candidate_tokens],
+                limit=num_recuadros,
+            )
             if imgs:
-                imgs_to_use = imgs[:num_recuadros] if num_recuadros <= len(imgs) else imgs
+                imgs_to_use = imgs
                 insert_images_one_per_line(doc, imgs_to_use, ancho_cm=15, alto_cm=10)
                 if len(imgs_to_use) < num_recuadros:
                     for _ in range(num_recuadros - len(imgs_to_use)):
@@ -725,6 +1293,18 @@ def generar_docx_desde_dfs(
         else:
             add_note(doc, "*NO CUENTA CON DICHO ELEMENTO")
 
+    if informe.diseno == "compacto":
+        # todo el bloque en una grilla: cada recuadro es una celda con el título como leyenda
+        celdas = []
+        for texto, incluir, num_recuadros, tokens in bloque_9:
+            if incluir:
+                imgs = find_images_for_any_token(images_list, tokens, limit=num_recuadros)
+                celdas.extend(celdas_fotos(texto, imgs, minimo=num_recuadros))
+            else:
+                celdas.append(CeldaFoto(texto, nota="*NO CUENTA CON DICHO ELEMENTO"))
+        build_grilla_fotos(doc, celdas)
+        return
+
     # Recorrer bloque_9 y añadir al doc
     for item in bloque_9:
         texto, incluir, num_recuadros, tokens = item
@@ -736,7 +1316,11 @@ def generar_docx_desde_dfs(
         else:
             add_foto_con_subtitulo_with_tokens(doc, texto, tokens, incluir_imagen=False, num_recuadros=1)
 
+
+def _seccion_mantenimiento(doc, informe, images_list):
     # === 10. EVIDENCIA FOTOGRÁFICA (MANTENIMIENTO REALIZADO) ===
+    actividades_list = informe.actividades or []
+    tanques_for_block = informe.tanques
     add_subtitle(doc, "10. EVIDENCIA FOTOGRÁFICA (MANTENIMIENTO REALIZADO)")
     add_note(doc, "NOTA 1: SE DEBERÁ MENCIONAR LOS TRABAJOS EJECUTADOS POR TANQUE (INCLUIR LAS INSPECCIONES QUE SE REALICEN)")
     add_note(doc, "NOTA 2: LAS IMÁGENES DEBEN TENER UN TAMAÑO DE 15CM (LARGO) X 10CM (ALTO) MÁXIMO Y SE DEBERÁ VISUALIZAR CLARAMENTE LOS DATOS RELEVANTES (OBSERVACIONES, DESCRIPCIONES DE ESTADO DE ELEMENTOS, TRABAJO REALIZADO, ETC) DE LOS ELEMENTOS EN LOS TRABAJOS REALIZADOS (TANQUES, ACCESORIOS, REDES)")
@@ -752,37 +1336,29 @@ def generar_docx_desde_dfs(
     # - por cada tanque existente, si tiene actividades → 10.1, 10.2...
     # - luego por cada equipo con actividades → continuación de la numeración
     # - luego red_llenado y red_consumo si aplican
-    sec_idx = 1
+    # grupos: (subtítulo sin numerar, [(texto de la actividad, fotos antes, fotos después)])
+    grupos = []
 
-    # 1) Tanques
-    for t_idx in range(len(tanques_for_block)):
-        ctx_key = f"tanque_{t_idx+1}"
-        acts = actividades_por_contexto.get(ctx_key, [])
-        if not acts:
-            continue
-        # Subtítulo para el tanque
-        add_subtitle(doc, f"10.{sec_idx}. TRABAJOS REALIZADOS EN EL TANQUE {t_idx+1} DE SERIE: {valOrDash(tanques_for_block[t_idx].get('N° de serie') or tanques_for_block[t_idx].get('serie'))}", indent=True)
-        # para cada actividad en este tanque, insertar título y antes/después buscando por el id del activity
+    def con_fotos(acts, texto):
+        # buscar imágenes con token actividad.id + "_before" / "_after"
+        filas = []
         for a in acts:
-            # activity title
-            doc.add_paragraph(f" * {a.get('titulo','Actividad')}." )
-            # buscar imágenes con token actividad.id + "_before" / "_after" o solo actividad.id
             aid = a.get("id")
             before_tokens = [f"{aid}_before", f"{aid}__before", f"{aid}_antes"]
             after_tokens = [f"{aid}_after", f"{aid}__after", f"{aid}_despues"]
             imgs_b = find_images_for_any_token(images_list, before_tokens)
             imgs_a = find_images_for_any_token(images_list, after_tokens)
-            # insertar antes
-            if imgs_b:
-                insert_images_one_per_line(doc, imgs_b, ancho_cm=15, alto_cm=10)
-            else:
-                insertar_recuadro_foto(doc)
-            # insertar despues
-            if imgs_a:
-                insert_images_one_per_line(doc, imgs_a, ancho_cm=15, alto_cm=10)
-            else:
-                insertar_recuadro_foto(doc)
-        sec_idx += 1
+            filas.append((texto(a), imgs_b, imgs_a))
+        return filas
+
+    # 1) Tanques
+    for t_idx in range(len(tanques_for_block)):
+        acts = actividades_por_contexto.get(f"tanque_{t_idx+1}", [])
+        if acts:
+            grupos.append((
+                f"TRABAJOS REALIZADOS EN EL TANQUE {t_idx+1} DE SERIE: {valOrDash(tanques_for_block[t_idx].serie)}",
+                con_fotos(acts, lambda a: f" * {a.get('titulo','Actividad')}."),
+            ))
 
     # 2) Equipos (si hay)
     equipo_keys = sorted([k for k in actividades_por_contexto.keys() if k.startswith("equipo_")], key=lambda x: int(re.sub(r"\D", "", x) or 0))
@@ -793,72 +1369,50 @@ def generar_docx_desde_dfs(
         # extraer índice
         m = re.match(r"equipo_(\d+)", ek)
         num_eq = m.group(1) if m else ek
-        add_subtitle(doc, f"10.{sec_idx}. TRABAJOS REALIZADOS EN EL EQUIPO {num_eq}", indent=True)
-        for a in acts:
-            doc.add_paragraph(f"- {a.get('titulo','Actividad')}. Tiempo: {a.get('tiempo','')}. Estado: {a.get('estado','')}")
-            aid = a.get("id")
-            before_tokens = [f"{aid}_before", f"{aid}__before", f"{aid}_antes"]
-            after_tokens = [f"{aid}_after", f"{aid}__after", f"{aid}_despues"]
-            imgs_b = find_images_for_any_token(images_list, before_tokens)
-            imgs_a = find_images_for_any_token(images_list, after_tokens)
-            if imgs_b:
-                insert_images_one_per_line(doc, imgs_b, ancho_cm=15, alto_cm=10)
-            else:
-                insertar_recuadro_foto(doc)
-            if imgs_a:
-                insert_images_one_per_line(doc, imgs_a, ancho_cm=15, alto_cm=10)
-            else:
-                insertar_recuadro_foto(doc)
-        sec_idx += 1
+        grupos.append((
+            f"TRABAJOS REALIZADOS EN EL EQUIPO {num_eq}",
+            con_fotos(acts, lambda a: f"- {a.get('titulo','Actividad')}. Tiempo: {a.get('tiempo','')}. Estado: {a.get('estado','')}"),
+        ))
 
     # 3) Red de llenado (si hay actividades con contexto 'red_llenado')
     acts_llenado = actividades_por_contexto.get("red_llenado", [])
     if acts_llenado:
-        add_subtitle(doc, f"10.{sec_idx}. TRABAJOS REALIZADOS EN RED DE LLENADO Y RETORNO", indent=True)
-        for a in acts_llenado:
-            doc.add_paragraph(f"* {a.get('titulo','Actividad')}.")
-            aid = a.get("id")
-            before_tokens = [f"{aid}_before", f"{aid}__before", f"{aid}_antes"]
-            after_tokens = [f"{aid}_after", f"{aid}__after", f"{aid}_despues"]
-            imgs_b = find_images_for_any_token(images_list, before_tokens)
-            imgs_a = find_images_for_any_token(images_list, after_tokens)
-            if imgs_b:
-                insert_images_one_per_line(doc, imgs_b, ancho_cm=15, alto_cm=10)
-            else:
-                insertar_recuadro_foto(doc)
-            if imgs_a:
-                insert_images_one_per_line(doc, imgs_a, ancho_cm=15, alto_cm=10)
-            else:
-                insertar_recuadro_foto(doc)
-        sec_idx += 1
+        grupos.append(("TRABAJOS REALIZADOS EN RED DE LLENADO Y RETORNO", con_fotos(acts_llenado, lambda a: f"* {a.get('titulo','Actividad')}.")))
 
     # 4) Red de consumo (si hay actividades con contexto 'red_consumo')
     acts_consumo = actividades_por_contexto.get("red_consumo", [])
     if acts_consumo:
-        add_subtitle(doc, f"10.{sec_idx}. TRABAJOS REALIZADOS EN RED DE CONSUMO", indent=True)
-        for a in acts_consumo:
-            doc.add_paragraph(f"- {a.get('titulo','Actividad')}.")
-            aid = a.get("id")
-            before_tokens = [f"{aid}_before", f"{aid}__before", f"{aid}_antes"]
-            after_tokens = [f"{aid}_after", f"{aid}__after", f"{aid}_despues"]
-            imgs_b = find_images_for_any_token(images_list, before_tokens)
-            imgs_a = find_images_for_any_token(images_list, after_tokens)
-            if imgs_b:
-                insert_images_one_per_line(doc, imgs_b, ancho_cm=15, alto_cm=10)
-            else:
-                insertar_recuadro_foto(doc)
-            if imgs_a:
-                insert_images_one_per_line(doc, imgs_a, ancho_cm=15, alto_cm=10)
-            else:
-                insertar_recuadro_foto(doc)
-        sec_idx += 1
+        grupos.append(("TRABAJOS REALIZADOS EN RED DE CONSUMO", con_fotos(acts_consumo, lambda a: f"- {a.get('titulo','Actividad')}.")))
+
+    for sec_idx, (subtitulo, filas) in enumerate(grupos, start=1):
+        add_subtitle(doc, f"10.{sec_idx}. {subtitulo}", indent=True)
+        if informe.diseno == "compacto":
+            # una grilla por grupo: el título de cada actividad y sus pares antes / después
+            celdas = []
+            for texto, imgs_b, imgs_a in filas:
+                celdas.append(FilaTitulo(texto))
+                for k in range(max(len(imgs_b), len(imgs_a), 1)):
+                    celdas.append(CeldaFoto("ANTES", imgs_b[k] if k < len(imgs_b) else None))
+                    celdas.append(CeldaFoto("DESPUÉS", imgs_a[k] if k < len(imgs_a) else None))
+            build_grilla_fotos(doc, celdas)
+            continue
+        for texto, imgs_b, imgs_a in filas:
+            doc.add_paragraph(texto)
+            # insertar antes y después
+            for imgs in (imgs_b, imgs_a):
+                if imgs:
+                    insert_images_one_per_line(doc, imgs, ancho_cm=15, alto_cm=10)
+                else:
+                    insertar_recuadro_foto(doc)
 
-    # NOTA: No incluimos secciones de 'general' aquí por petición.
 
+def _seccion_cierre(doc, informe, images_list):
     # === 11,12,13 ===
     add_subtitle(doc, "11. EVIDENCIA FOTOGRÁFICA DE LA INSTALACIÓN")
     imgs_11 = find_images_for_any_token(images_list, ["11", "11_evidencia", "11_evidencia_instalacion"])
-    if imgs_11:
+    if informe.diseno == "compacto":
+        build_grilla_fotos(doc, celdas_fotos("FOTO DE LA INSTALACIÓN", imgs_11))
+    elif imgs_11:
         insert_images_one_per_line(doc, imgs_11, ancho_cm=15, alto_cm=10)
     else:
         insertar_recuadro_foto(doc)
@@ -868,11 +1422,72 @@ def generar_docx_desde_dfs(
     add_subtitle(doc, "13. Recomendaciones")
     doc.add_paragraph("-")
 
-    # Guardar docx en archivo temporal
-    fd, path = tempfile.mkstemp(prefix="Informe_Mantenimiento_", suffix=".docx")
-    os.close(fd)
-    doc.save(path)
-    return path
+
+# (tramo, descripción, campos del Informe que usa, función); los campos forman
+# la clave de la sección en la caché de secciones
+SECCIONES_DOCX = (
+    ("s1", "1. Cliente", ("general",), _seccion_cliente),
+    ("s2", "2. Tipo de instalación", (), _seccion_tipo_instalacion),
+    ("s3", "3. Tanques", ("tanques",), _seccion_tanques),
+    ("s4", "4. Accesorios de tanques", ("accesorios", "tanques_accesorios"), _seccion_accesorios_tanques),
+    ("s5", "5. Accesorios en redes", ("red",), _seccion_accesorios_red),
+    ("s6", "6. Equipos", ("equipos",), _seccion_equipos),
+    ("s7", "7. Observaciones", ("observaciones",), _seccion_observaciones),
+    ("s8", "8. Evidencia general", ("diseno",), _seccion_evidencia_general),
+    ("s9", "9. Evidencia de elementos", ("tanques", "red", "equipos", "diseno"), _seccion_evidencia_elementos),
+    ("s10", "10. Mantenimiento realizado", ("tanques", "actividades", "diseno"), _seccion_mantenimiento),
+    ("s11_13", "11-13. Instalación y cierre", ("diseno",), _seccion_cierre),
+)
+
+
+# ------------------------
+# Función central: genera docx desde el Informe + lista de imágenes temporales
+# ------------------------
+def generar_docx_desde_dfs(
+    df_info, df_tanques, df_accesorios, df_red, df_equipos, df_obs, actividades_list=None, images_list=None
+):
+    """
+    Entrada histórica con DataFrames: se adapta al Informe y se llama a generar_docx.
+    actividades_list: lista de dicts {id, contexto, titulo, tiempo, estado}
+    images_list: ImageIndex o lista de dicts {'field','filename','path'}
+    """
+    with metricas.tramo("modelo", "Modelo del informe"):
+        informe = informe_desde_dfs(df_info, df_tanques, df_accesorios, df_red, df_equipos, df_obs, actividades_list)
+    return generar_docx(informe, images_list=images_list)
+
+
+def generar_docx(informe, images_list=None):
+    """
+    informe: modelo.Informe (ver informe_desde_json / informe_desde_dfs)
+    images_list: ImageIndex o lista de dicts {'field','filename','path'}
+    Devuelve un SpooledTemporaryFile posicionado al inicio; quien lo recibe lo cierra.
+    """
+    images_list = images_list if isinstance(images_list, ImageIndex) else ImageIndex(images_list)
+    secciones = metricas.Secciones()
+    # --- Título (ya incluido en el documento base)
+    secciones.siguiente("base", "Documento base")
+    doc = documento_base()
+    propiedades_documento(doc, informe)
+
+    desde_cache = False
+    for nombre, desc, campos, construir in SECCIONES_DOCX:
+        secciones.siguiente(nombre, desc)
+        desde_cache |= armar_seccion(doc, informe, images_list, nombre, campos, construir)
+    if desde_cache:
+        renumerar_dibujos(doc)
+
+    # Guardar docx en un buffer (en memoria hasta DOCX_SPOOL_MAX_BYTES, luego en disco);
+    # las fotos se copian desde sus archivos sin recomprimir
+    secciones.siguiente("guardar", "Escritura del paquete")
+    buf = tempfile.SpooledTemporaryFile(max_size=DOCX_SPOOL_MAX_BYTES, prefix="Informe_Mantenimiento_", suffix=".docx")
+    try:
+        paquete.guardar(doc, buf)
+    except Exception:
+        buf.close()
+        raise
+    buf.seek(0)
+    secciones.cerrar()
+    return buf
 
 
 # ------------------------
@@ -882,7 +1497,10 @@ def build_dfs_from_json(payload):
     """
     Construye DataFrames desde el payload JSON esperado.
     Retorna: df_info, df_tanques, df_accesorios, df_red, df_equipos, df_obs
+    (el render usa informe_desde_json; esto queda para quien necesite DataFrames)
     """
+    import pandas as pd
+
     general = payload.get("general", {}) or {}
     tanques = payload.get("tanques", []) or []
     accesorios_tanque = payload.get("accesoriosTanque", {}) or {}
@@ -891,19 +1509,7 @@ def build_dfs_from_json(payload):
     observaciones = payload.get("observaciones", {}) or {}
 
     # df_info
-    campos = [
-        "Nombre o razón social del cliente",
-        "Fecha de inspección",
-        "Dirección",
-        "RUC o DNI",
-        "Número de instalación",
-        "Distrito",
-        "Departamento",
-        "Coordenadas",
-        "Nombre del contacto",
-        "Número del contacto",
-        "Correo de contacto",
-    ]
+    campos = CAMPOS_GENERALES
     row_info = {c: general.get(c, "") for c in campos}
     df_info = pd.DataFrame([row_info])
 
@@ -975,139 +1581,1003 @@ def build_dfs_from_json(payload):
     return df_info, df_tanques, df_accesorios, df_red, df_equipos, df_obs
 
 
+# ------------------------
+# Endpoint /generar actualizado para multipart/form-data (JSON + imágenes)
+# ------------------------
+def _texto(v):
+    return str(v).strip() if v is not None else ""
+
+
+# secciones del payload que son un objeto y las que son una lista de objetos
+SECCIONES_OBJETO = ("general", "observaciones", "accesoriosTanque")
+SECCIONES_LISTA = ("tanques", "accesoriosRed", "equipos", "actividades")
+
+
+def _estructura(payload):
+    """
+    Errores de forma de las secciones (objeto / lista de objetos, y los
+    accesorios de cada tanque) y las secciones listas para validar sus campos:
+    un objeto mal formado queda vacío y las listas conservan todos sus
+    elementos (para no mover los índices; los que no son objetos se saltean).
+    """
+    errores = []
+    secciones = {}
+    for campo in SECCIONES_OBJETO:
+        valor = payload.get(campo) or {}
+        if not isinstance(valor, dict):
+            errores.append({"error": f"'{campo}' debe ser un objeto"})
+            valor = {}
+        secciones[campo] = valor
+    for campo in SECCIONES_LISTA:
+        valor = payload.get(campo) or []
+        if not isinstance(valor, list):
+            errores.append({"error": f"'{campo}' debe ser una lista"})
+            valor = []
+        malos = [i for i, item in enumerate(valor) if not isinstance(item, dict)]
+        if malos:
+            errores.append({"error": f"Los elementos de '{campo}' deben ser objetos", "indices": malos})
+        secciones[campo] = valor
+    accesorios = {}
+    for tk, accs in secciones["accesoriosTanque"].items():
+        accs = accs or {}
+        if not isinstance(accs, dict):
+            errores.append({"error": f"accesoriosTanque.{tk} debe ser un objeto"})
+            continue
+        malos = [nombre for nombre, fields in accs.items() if fields and not isinstance(fields, dict)]
+        for nombre in malos:
+            errores.append({"error": f"accesoriosTanque.{tk}.{nombre} debe ser un objeto"})
+        accesorios[tk] = {nombre: fields for nombre, fields in accs.items() if nombre not in malos}
+    secciones["accesoriosTanque"] = accesorios
+    return errores, secciones
+
+
+def validar_payload(payload):
+    """
+    Valida el payload completo y devuelve TODOS los errores encontrados
+    (lista vacía si es válido). Cada error es un dict con al menos 'error'.
+    """
+    if not payload:
+        return [{"error": "No JSON recibido o body vacío"}]
+    if not isinstance(payload, dict):
+        return [{"error": "El JSON debe ser un objeto"}]
+
+    errores, secciones = _estructura(payload)
+    general = secciones["general"]
+    tanques = secciones["tanques"]
+
+    missing = [k for k in CAMPOS_GENERALES if not _texto(general.get(k))]
+    if missing:
+        errores.append({"error": "Faltan campos obligatorios en 'general'", "missing": missing})
+
+    if len(tanques) == 0 and isinstance(payload.get("tanques") or [], list):
+        errores.append({"error": "Se requiere al menos un tanque en 'tanques'"})
+
+    # Validación accesoriosTanque
+    accesorios_tanque = secciones["accesoriosTanque"]
+    for tk, accs in accesorios_tanque.items():
+        for acc_name, fields in accs.items():
+            fields = fields or {}
+            if any(_texto(fields.get(f)) for f in ATRIBUTOS_ACCESORIO):
+                missingf = [f for f in ATRIBUTOS_ACCESORIO if not _texto(fields.get(f))]
+                if missingf:
+                    errores.append({"error": f"En accesoriosTanque.{tk}.{acc_name} faltan campos: {missingf}"})
+
+    # Validación accesoriosRed
+    accesorios_red = secciones["accesoriosRed"]
+    for i, r in enumerate(accesorios_red):
+        if not isinstance(r, dict):
+            continue
+        if any(_texto(r.get(k)) for k in ["Marca", "Serie", "Código", "Mes/Año de fabricación"]):
+            if not _texto(r.get("Tipo")):
+                errores.append({"error": f"AccesoriosRed[{i}] tiene campos pero falta 'Tipo'"})
+
+    # Validación equipos
+    equipos = secciones["equipos"]
+    for i, eq in enumerate(equipos):
+        if not isinstance(eq, dict):
+            continue
+        tipo = _texto(eq.get("Tipo de equipo") or eq.get("tipo")).lower()
+        if tipo and tipo in ESTRUCTURA_EQUIPOS:
+            missing_eq = [c for c in ESTRUCTURA_EQUIPOS[tipo] if not _texto(eq.get(c))]
+            if missing_eq:
+                errores.append({"error": f"Equipo[{i}] de tipo '{tipo}' faltan campos: {missing_eq}"})
+
+    diseno = _texto(payload.get("diseno")).lower()
+    if diseno and diseno not in DISENOS:
+        errores.append({"error": f"Diseño '{payload.get('diseno')}' desconocido", "permitidos": list(DISENOS)})
+
+    return errores
+
+
+def respuesta_errores(errores, codigo=400):
+    """
+    400 con el primer error en la raíz (formato histórico) y la lista completa en 'errores'.
+    """
+    body = dict(errores[0])
+    body["errores"] = errores
+    return jsonify(body), codigo
+
+
+def parse_payload(data_raw):
+    try:
+        return json.loads(data_raw) if data_raw else {}
+    except Exception:
+        return {}
+
+
+def spool_multipart(req, validar, chunk_size=64 * 1024, por_campo=False):
+    """
+    Lee un multipart/form-data en streaming desde req.stream.
+    Los campos de texto se acumulan en memoria; al llegar el primer archivo
+    (handleGenerate envía 'json' antes que las fotos) se llama validar(form) y,
+    si devuelve errores, se deja de leer sin escribir ninguna imagen a disco.
+    Con por_campo cada campo de archivo va a su propia subcarpeta (en un lote
+    dos instalaciones pueden mandar el mismo nombre de foto).
+    Retorna (form, saved, tmpdir, errores) con saved en el formato de
+    save_uploaded_files_tmp (más el 'sha256' de cada foto, calculado al escribirla).
+    """
+    boundary = req.mimetype_params.get("boundary", "").encode("latin-1")
+    decoder = MultipartDecoder(boundary, max_form_memory_size=req.max_form_memory_size)
+    form = {}
+    saved = []
+    tmpdir = None
+    validado = False
+    parte = None
+    buf = None
+    fh = None
+    sha = None
+    try:
+        while True:
+            chunk = req.stream.read(chunk_size)
+            decoder.receive_data(chunk or None)
+            event = decoder.next_event()
+            while not isinstance(event, (Epilogue, NeedData)):
+                if isinstance(event, Field):
+                    parte, buf = event, []
+                elif isinstance(event, File):
+                    if not validado:
+                        validado = True
+                        errores = validar(form)
+                        if errores:
+                            return form, saved, tmpdir, errores
+                    parte = event
+                    if tmpdir is None:
+                        tmpdir = tempfile.mkdtemp(prefix="uploaded_imgs_")
+                    safe_name = os.path.basename(event.filename or "") or f"archivo_{len(saved)}"
+                    carpeta = tmpdir
+                    if por_campo:
+                        carpeta = os.path.join(tmpdir, normalizar(event.name) or "images")
+                        os.makedirs(carpeta, exist_ok=True)
+                    path = os.path.join(carpeta, safe_name)
+                    fh = open(path, "wb")
+                    sha = hashlib.sha256()
+                elif isinstance(event, Data):
+                    if isinstance(parte, Field):
+                        buf.append(event.data)
+                        if not event.more_data:
+                            form.setdefault(parte.name, b"".join(buf).decode("utf-8", "replace"))
+                    elif fh is not None:
+                        fh.write(event.data)
+                        sha.update(event.data)
+                        if not event.more_data:
+                            fh.close()
+                            if parte.filename:
+                                saved.append(
+                                    {
+                                        "field": parte.name,
+                                        "filename": os.path.basename(fh.name),
+                                        "path": fh.name,
+                                        "sha256": sha.hexdigest(),
+                                    }
+                                )
+                            fh = None
+                event = decoder.next_event()
+            if isinstance(event, Epilogue) or not chunk:
+                break
+    finally:
+        if fh is not None:
+            fh.close()
+
+    errores = [] if validado else validar(form)
+    return form, saved, tmpdir, errores
+
+
+def indice_imagenes(images, images_dir):
+    """
+    ImageIndex con el preproceso encolado; las fotos marcadas 'preparada'
+    (ya procesadas en una sesión de subida) se usan tal cual.
+    """
+    listas = [i for i in images if i.get("preparada")]
+    pendientes = [i for i in images if not i.get("preparada")]
+    if pendientes:
+        pendientes = preprocess_images(pendientes, images_dir)
+    return ImageIndex(listas + pendientes)
+
+
+def render_report(payload, images=None, images_dir=None):
+    """
+    Payload ya validado + imágenes guardadas -> docx generado (archivo abierto, ver generar_docx).
+    images puede ser un ImageIndex (preproceso ya encolado) o la lista de
+    save_uploaded_files_tmp; en ese caso el preproceso se encola aquí.
+    """
+    if images and not isinstance(images, ImageIndex):
+        with metricas.tramo("imagenes", "Encolar preproceso"):
+            images = indice_imagenes(images, images_dir)
+
+    # Modelo del informe (incluye payload.actividades) y docx
+    with metricas.tramo("modelo", "Modelo del informe"):
+        informe = informe_desde_json(payload)
+    docx = generar_docx(informe, images_list=images)
+    if isinstance(images, ImageIndex):
+        metricas.registrar_imagenes(log_preprocess_stats(images.items()))
+    metricas.DOCX_BYTES.observe(tamano_archivo(docx))
+    return docx
+
+
+def render_report_archivo(payload, images, images_dir, destino):
+    """
+    Variante para los procesos de /generar/lote: prepara las fotos en el mismo
+    proceso (ya corre dentro de un pool) y escribe el docx en destino.
+    """
+    if images:
+        images = ImageIndex(preprocess_images_local(images, images_dir))
+    docx = render_report(payload, images, images_dir)
+    try:
+        with open(destino, "wb") as fh:
+            shutil.copyfileobj(docx, fh)
+    finally:
+        docx.close()
+
+
+def tamano_archivo(fh):
+    # tamaño de un archivo abierto sin mover su posición
+    pos = fh.tell()
+    fh.seek(0, io.SEEK_END)
+    tamano = fh.tell()
+    fh.seek(pos)
+    return tamano
+
+
+def nombre_informe():
+    return datetime.now().strftime("Informe_Mantenimiento_%Y%m%d_%H%M%S.docx")
+
+
+def enviar_docx(docx, nombre, etag=None):
+    """
+    Respuesta que envía el docx por trozos con Content-Length exacto y lo
+    cierra (liberando memoria o el temporal en disco) al terminar la respuesta,
+    aunque el cliente corte antes.
+    """
+
+    def trozos():
+        while True:
+            chunk = docx.read(DOCX_CHUNK_BYTES)
+            if not chunk:
+                break
+            yield chunk
+
+    response = Response(trozos(), mimetype=DOCX_MIMETYPE)
+    response.content_length = tamano_archivo(docx)
+    response.headers.set("Content-Disposition", "attachment", filename=nombre)
+    if etag:
+        response.set_etag(etag)
+    response.call_on_close(docx.close)
+    return response
+
+
+def servir_resultado(dig, generar=None):
+    """
+    Respuesta para un envío ya resumido en su digest (ver resultados.py): 304
+    si el cliente ya tiene ese docx, el de la caché si existe (esperando si
+    otro worker lo está generando) o el que devuelva generar(), que queda en
+    la caché para los duplicados. Sin generar, None si no está en la caché.
+    """
+    tag = resultados.etag(dig)
+    if request.if_none_match.contains(tag):
+        metricas.RESULTADOS.inc(resultado="no_modificado")
+        response = Response(status=304)
+        response.set_etag(tag)
+        return response
+    with resultados.exclusivo(dig) as esperado:
+        docx = resultados.cache.open(dig)
+        if docx is not None:
+            resultados.cache.record(True)
+            metricas.RESULTADOS.inc(resultado="espera" if esperado else "acierto")
+        elif generar is not None:
+            docx = generar()
+            try:
+                resultados.cache.record(False, resultados.cache.put(dig, docx))
+            finally:
+                docx.seek(0)
+            metricas.RESULTADOS.inc(resultado="generado")
+    if docx is None:
+        return None
+    return enviar_docx(docx, nombre_informe(), tag)
+
+
+def quiere_async(req):
+    """
+    Modo asíncrono opcional: /generar?async=1 o cabecera 'Prefer: respond-async'.
+    """
+    if (req.args.get("async") or "").lower() in ("1", "true", "si", "sí"):
+        return True
+    return "respond-async" in (req.headers.get("Prefer") or "").lower()
+
+
+def estado_trabajo_json(job):
+    body = {
+        "id": job["id"],
+        "estado": job["estado"],
+        "creado": job["creado"],
+        "actualizado": job["actualizado"],
+    }
+    if job["estado"] == trabajos.LISTO:
+        body["resultado_url"] = url_for("estado_trabajo", job_id=job["id"], descargar=1)
+    if job["estado"] == trabajos.ERROR:
+        body["error"] = job["error"]
+    return body
+
+
+def entregar_informe(payload, saved_images, tmp_images_dir=None, sesion=None):
+    """
+    Payload ya validado -> respuesta: el docx en streaming, o 202 con el trabajo
+    si se pidió modo asíncrono. Toma posesión de tmp_images_dir (lo borra al
+    terminar o lo pasa al trabajo). sesion: además de saved_images, usa las fotos
+    ya subidas por /uploads/<sesion>/<token>.
+    En modo síncrono los envíos idénticos salen de la caché de informes y la
+    cabecera Idempotency-Key queda asociada al digest del envío.
+    """
+    try:
+        if sesion:
+            if tmp_images_dir is None:
+                tmp_images_dir = tempfile.mkdtemp(prefix="uploaded_imgs_")
+            de_sesion = subidas.imagenes(sesion)
+            if quiere_async(request):
+                de_sesion = subidas.copiar_a(de_sesion, os.path.join(tmp_images_dir, "sesion"))
+            saved_images = de_sesion + list(saved_images)
+
+        # tamaño de las fotos según su cabecera, antes de decodificar ninguna
+        errores = revisar_pixeles(saved_images)
+        if errores:
+            return respuesta_errores(errores, 413)
+
+        if quiere_async(request):
+            # la carpeta de imágenes pasa a ser del trabajo: no se borra aquí
+            job_id = trabajos.enqueue(payload, saved_images, tmp_images_dir)
+            tmp_images_dir = None
+            trabajos.ensure_workers(render_report)
+            url = url_for("estado_trabajo", job_id=job_id)
+            return jsonify({"id": job_id, "estado": trabajos.PENDIENTE, "url": url}), 202, {"Location": url}
+
+        with metricas.tramo("digest", "Digest del envío"):
+            dig = resultados.digest(payload, saved_images)
+        clave = request.headers.get("Idempotency-Key")
+        if clave:
+            try:
+                resultados.recordar_clave(clave, dig)
+            except resultados.ClaveReutilizada as e:
+                return respuesta_errores([{"error": str(e)}], 422)
+
+        def generar():
+            # reducir / re-codificar en el pool mientras se arma el documento
+            images = saved_images
+            if images:
+                with metricas.tramo("imagenes", "Encolar preproceso"):
+                    images = indice_imagenes(images, tmp_images_dir)
+            return render_report(payload, images, tmp_images_dir)
+
+        # Enviar archivo (el buffer se cierra al terminar la respuesta)
+        return servir_resultado(dig, generar)
+    finally:
+        if tmp_images_dir and os.path.isdir(tmp_images_dir):
+            shutil.rmtree(tmp_images_dir, ignore_errors=True)
+
+
+# ------------------------
+# Métricas por petición: Server-Timing y /metrics
+# ------------------------
+@app.before_request
+def iniciar_metricas():
+    g.metricas_inicio = time.perf_counter()
+    g.trazas, g.trazas_token = metricas.iniciar_trazas()
+    metricas.EN_CURSO.inc(endpoint=request.endpoint or "-")
+
+
+@app.after_request
+def agregar_server_timing(response):
+    endpoint = request.endpoint or "-"
+    trazas = g.get("trazas")
+    if trazas is not None:
+        total = time.perf_counter() - g.metricas_inicio
+        trazas.agregar("total", total)
+        response.headers["Server-Timing"] = trazas.server_timing()
+        metricas.PETICION_SEGUNDOS.observe(total, endpoint=endpoint)
+    metricas.PETICIONES.inc(endpoint=endpoint, codigo=response.status_code)
+    return response
+
+
+@app.teardown_request
+def terminar_metricas(exc):
+    token = g.pop("trazas_token", None)
+    if token is not None:
+        metricas.terminar_trazas(token)
+        metricas.EN_CURSO.dec(endpoint=request.endpoint or "-")
+
+
+@app.route("/metrics")
+def metrics():
+    metricas.registrar_admision(admision.control.estado())
+    return metricas.exponer(), 200, {"Content-Type": "text/plain; version=0.0.4; charset=utf-8"}
+
+
+# ------------------------
+# Control de admisión: los endpoints que generan informes entran sólo si su
+# costo estimado cabe en el presupuesto (ver admision.py)
+# ------------------------
+ENDPOINTS_ADMISION = ("generar_informe", "generar_borrador", "generar_lote", "generar_inventario")
+
+
+def fotos_de_sesion(req):
+    # fotos ya subidas que va a usar la petición (el id del borrador es su sesión)
+    sesion = (req.view_args or {}).get("borrador_id") or req.args.get("sesion")
+    if not sesion and req.is_json:
+        payload = req.get_json(silent=True)
+        sesion = payload.get("sesion") if isinstance(payload, dict) else None
+    try:
+        return len(subidas.imagenes(sesion)) if sesion else 0
+    except subidas.SubidaInvalida:
+        return 0
+
+
+@app.before_request
+def admitir():
+    # el modo asíncrono no se limita aquí: el trabajo queda en la cola de trabajos.py
+    if request.endpoint not in ENDPOINTS_ADMISION or quiere_async(request):
+        return None
+    multipart = request.mimetype == "multipart/form-data"
+    costo = admision.estimar_mb(request.content_length, fotos_de_sesion(request), multipart)
+    try:
+        ticket = admision.control.entrar(costo)
+    except admision.Saturado as e:
+        metricas.ADMISION.inc(resultado=e.motivo.replace(" ", "_"))
+        body = {"error": "Servidor ocupado, reintentar más tarde", "motivo": e.motivo, "retry_after": e.retry_after}
+        return jsonify(body), 503, {"Retry-After": str(e.retry_after)}
+    g.admision = ticket
+    metricas.ADMISION.inc(resultado="admitida")
+    metricas.ADMISION_ESPERA.observe(ticket.espera)
+    metricas.registrar("admision", ticket.espera, "Espera de admisión")
+    return None
+
+
+@app.after_request
+def liberar_admision(response):
+    # con respuestas en streaming (zip de lotes) el trabajo sigue hasta cerrar la respuesta
+    ticket = g.pop("admision", None)
+    if ticket is not None:
+        response.call_on_close(lambda: admision.control.salir(ticket))
+    return response
+
+
+@app.teardown_request
+def liberar_admision_error(exc):
+    ticket = g.pop("admision", None)
+    if ticket is not None:
+        admision.control.salir(ticket)
+
+
+@app.route("/admision")
+def estado_admision():
+    return jsonify(admision.control.estado())
+
+
+# ------------------------
+# Perfiles a pedido (ver perfiles.py): cabecera X-Perfil-Token o umbral de
+# duración; los perfiles guardados se listan en /perfiles con el mismo token.
+# ------------------------
+def perfilable(vista):
+    """
+    Corre la vista bajo perfiles.Perfil cuando corresponde; si el perfil se
+    guarda, la respuesta lleva su id en X-Perfil-Id.
+    """
+
+    @functools.wraps(vista)
+    def envuelta(*args, **kwargs):
+        disparo = perfiles.disparo(request.headers.get(perfiles.CABECERA))
+        if disparo is None:
+            return vista(*args, **kwargs)
+        perfil = perfiles.Perfil(perfiles.nuevo_id(), disparo, request.headers.get("X-Request-Id"))
+        with perfil:
+            response = app.make_response(vista(*args, **kwargs))
+        if perfil.debe_guardarse():
+            trazas = g.get("trazas")
+            try:
+                perfil.guardar(
+                    {
+                        "endpoint": request.endpoint,
+                        "ruta": request.full_path.rstrip("?"),
+                        "codigo": response.status_code,
+                        "content_length": request.content_length,
+                        "server_timing": trazas.server_timing() if trazas is not None else None,
+                    }
+                )
+            except OSError:
+                app.logger.exception("No se pudo guardar el perfil %s", perfil.id)
+            else:
+                response.headers["X-Perfil-Id"] = perfil.id
+                metricas.PERFILES.inc(disparo=disparo)
+        return response
+
+    return envuelta
+
+
+def _perfiles_autorizado():
+    if not perfiles.PERFILES_TOKEN:
+        return jsonify({"error": "Perfiles desactivados (PERFILES_TOKEN)"}), 404
+    if not perfiles.autorizado(request.headers.get(perfiles.CABECERA)):
+        return jsonify({"error": f"Falta o no es válida la cabecera {perfiles.CABECERA}"}), 403
+    return None
+
+
+@app.route("/perfiles")
+def listar_perfiles():
+    denegado = _perfiles_autorizado()
+    if denegado:
+        return denegado
+    lista = perfiles.listar(request.args.get("request_id") or None)
+    for meta in lista:
+        meta["url"] = url_for("ver_perfil", perfil_id=meta["id"])
+    return jsonify({"umbral_s": perfiles.PERFILES_UMBRAL_S, "max": perfiles.PERFILES_MAX, "perfiles": lista})
+
+
+@app.route("/perfiles/<perfil_id>")
+def ver_perfil(perfil_id):
+    denegado = _perfiles_autorizado()
+    if denegado:
+        return denegado
+    meta = perfiles.leer_meta(perfil_id)
+    if meta is None:
+        return jsonify({"error": "Perfil no encontrado"}), 404
+    meta["urls"] = {a: url_for("archivo_perfil", perfil_id=perfil_id, nombre=a) for a in meta["archivos"]}
+    return jsonify(meta)
+
+
+@app.route("/perfiles/<perfil_id>/<nombre>")
+def archivo_perfil(perfil_id, nombre):
+    denegado = _perfiles_autorizado()
+    if denegado:
+        return denegado
+    path = perfiles.archivo(perfil_id, nombre)
+    if path is None:
+        return jsonify({"error": "Archivo no encontrado"}), 404
+    if nombre.endswith(".pstats"):
+        return send_file(path, mimetype="application/octet-stream", as_attachment=True, download_name=f"{perfil_id}.pstats")
+    return send_file(path, mimetype="application/json" if nombre.endswith(".json") else "text/plain; charset=utf-8")
+
+
+# ------------------------
+# Endpoint /validar: sólo JSON, devuelve todos los errores de una vez
+# ------------------------
+@app.route("/validar", methods=["POST"])
+def validar_informe():
+    if request.content_type and "multipart/form-data" in request.content_type:
+        payload = parse_payload(request.form.get("json") or request.form.get("payload"))
+    else:
+        payload = request.get_json(silent=True) or {}
+    errores = validar_payload(payload)
+    return jsonify({"ok": not errores, "errores": errores})
+
+
 # ------------------------
 # Endpoint /generar actualizado para multipart/form-data (JSON + imágenes)
 # ------------------------
 @app.route("/generar", methods=["POST"])
+@perfilable
 def generar_informe():
     tmp_images_dir = None
     saved_images = []
     try:
+        # reintento con una Idempotency-Key conocida: se responde sin leer las fotos
+        clave = request.headers.get("Idempotency-Key")
+        if clave is not None and not quiere_async(request):
+            if not resultados.clave_valida(clave):
+                return respuesta_errores([{"error": "Idempotency-Key inválida"}])
+            previo = resultados.digest_de_clave(clave)
+            if previo:
+                respuesta = servir_resultado(previo)
+                if respuesta is not None:
+                    return respuesta
+
         # Si el cliente envía multipart/form-data:
         if request.content_type and "multipart/form-data" in request.content_type:
-            # Se espera que haya un campo 'json' con el payload
-            data_raw = request.form.get("json") or request.form.get("payload") or None
-            if not data_raw:
-                try:
-                    data_raw = request.get_data(as_text=True)
-                except Exception:
-                    data_raw = None
-            try:
-                payload = json.loads(data_raw) if data_raw else {}
-            except Exception:
-                payload = request.get_json(silent=True) or {}
-            # guardar archivos
-            saved_images, tmp_images_dir = save_uploaded_files_tmp(request.files)
+            # Se espera que haya un campo 'json' con el payload; se valida antes
+            # de aceptar los bytes de las fotos
+            estado = {}
+
+            def _validar(form):
+                with metricas.tramo("validacion", "Validación"):
+                    estado["payload"] = parse_payload(form.get("json") or form.get("payload"))
+                    return validar_payload(estado["payload"])
+
+            # el tramo 'spool' incluye la validación (se hace al llegar la primera foto)
+            with metricas.tramo("spool", "Lectura del multipart"):
+                _, saved_images, tmp_images_dir, errores = spool_multipart(request, _validar)
+            if errores:
+                return respuesta_errores(errores)
+            payload = estado["payload"]
         else:
             # si no es multipart: cuerpo JSON
-            payload = request.get_json() or {}
+            payload = request.get_json(silent=True) or {}
             saved_images = []
+            with metricas.tramo("validacion", "Validación"):
+                errores = validar_payload(payload)
+            if errores:
+                return respuesta_errores(errores)
+
+        # diseño de la evidencia también por query (?diseno=compacto); queda en el payload
+        # para que entre en el digest del envío
+        if request.args.get("diseno"):
+            payload["diseno"] = request.args["diseno"]
+            errores = validar_payload(payload)
+            if errores:
+                return respuesta_errores(errores)
+
+        # fotos ya subidas por /uploads/<sesion>/<token> (más las que vengan en este multipart)
+        sesion = payload.pop("sesion", None) or request.args.get("sesion")
+        tmpdir, tmp_images_dir = tmp_images_dir, None
+        return entregar_informe(payload, saved_images, tmpdir, sesion)
+    except subidas.SubidaInvalida as e:
+        return respuesta_errores([{"error": str(e)}])
+    except Exception as e:
+        import traceback
+        traceback.print_exc()
+        return jsonify({"error": "Error interno del servidor", "detail": str(e)}), 500
+    finally:
+        # limpieza: remover archivos temporales si se crearon
+        try:
+            if tmp_images_dir and os.path.isdir(tmp_images_dir):
+                shutil.rmtree(tmp_images_dir, ignore_errors=True)
+        except Exception:
+            pass
 
-        if not payload:
-            return jsonify({"error": "No JSON recibido o body vacío"}), 400
-
-        # Validaciones mínimas
-        general = payload.get("general", {}) or {}
-        tanques = payload.get("tanques", []) or []
-
-        required_general = [
-            "Nombre o razón social del cliente",
-            "Fecha de inspección",
-            "Dirección",
-            "RUC o DNI",
-            "Número de instalación",
-            "Distrito",
-            "Departamento",
-            "Coordenadas",
-            "Nombre del contacto",
-            "Número del contacto",
-            "Correo de contacto",
-        ]
-        missing = [k for k in required_general if not (general.get(k) or "").strip()]
-        if missing:
-            return (
-                jsonify({"error": "Faltan campos obligatorios en 'general'", "missing": missing}),
-                400,
-            )
 
-        if len(tanques) == 0:
-            return jsonify({"error": "Se requiere al menos un tanque en 'tanques'"}), 400
-
-        # Validación accesoriosTanque
-        accesorios_tanque = payload.get("accesoriosTanque", {}) or {}
-        for tk, accs in accesorios_tanque.items():
-            for acc_name, fields in (accs or {}).items():
-                if any((fields.get(f) or "").strip() for f in ["Marca", "Código", "Serie", "Mes/Año de fabricación"]):
-                    missingf = [f for f in ["Marca", "Código", "Serie", "Mes/Año de fabricación"] if not (fields.get(f) or "").strip()]
-                    if missingf:
-                        return jsonify({"error": f"En accesoriosTanque.{tk}.{acc_name} faltan campos: {missingf}"}), 400
-
-        # Validación accesoriosRed
-        accesorios_red = payload.get("accesoriosRed", []) or []
-        for i, r in enumerate(accesorios_red):
-            if any((r.get(k) or "").strip() for k in ["Marca", "Serie", "Código", "Mes/Año de fabricación"]):
-                if not (r.get("Tipo") or "").strip():
-                    return jsonify({"error": f"AccesoriosRed[{i}] tiene campos pero falta 'Tipo'"}), 400
-
-        # Validación equipos
-        equipos = payload.get("equipos", []) or []
-        estructura_equipos = {
-            "vaporizador": ["Equipo", "Marca", "Tipo", "Serie", "Año de fabricación", "Capacidad"],
-            "quemador": ["Equipo", "Marca", "Modelo", "Tipo", "Serie", "Año de fabricación", "Capacidad (kW)"],
-            "decantador": ["Equipo", "Fabricante", "Modelo", "Tipo", "Serie", "Año de fabricación", "Capacidad (gal)"],
-            "dispensador_de_gas": ["Equipo", "Marca", "Modelo", "Serie"],
-            "bomba": ["Equipo", "Marca", "Modelo", "Serie"],
-            "tablero": ["Equipo", "TAG"],
-            "estabilizador": ["Equipo", "Marca", "Modelo", "Serie"],
-            "detector": ["Equipo", "Marca", "Modelo", "Serie"],
-            "extintor": ["Equipo", "Marca", "Serie", "Año de fabricación", "Próxima PH", "Fecha de próxima recarga"],
-        }
-        for i, eq in enumerate(equipos):
-            tipo = (eq.get("Tipo de equipo") or eq.get("tipo") or "").strip().lower()
-            if tipo and tipo in estructura_equipos:
-                required_cols = estructura_equipos[tipo]
-                missing_eq = [c for c in required_cols if not (eq.get(c) or "").strip()]
-                if missing_eq:
-                    return jsonify({"error": f"Equipo[{i}] de tipo '{tipo}' faltan campos: {missing_eq}"}), 400
+# ------------------------
+# Subida incremental de fotos: /uploads/<sesion>/<token>
+# ------------------------
+@app.route("/uploads/<sesion>/<token>", methods=["PUT", "POST"])
+def subir_foto(sesion, token):
+    """
+    Cuerpo: los bytes de la foto. ?n=<índice> hace idempotente el reintento;
+    ?ext= la extensión original. El preproceso arranca en segundo plano.
+    """
+    n = request.args.get("n", type=int)
+    try:
+        nombre = subidas.guardar(sesion, token, request.stream, n=n, ext=request.args.get("ext"))
+    except subidas.SubidaInvalida as e:
+        return respuesta_errores([{"error": str(e)}])
+    return jsonify({"ok": True, "sesion": sesion, "token": token, "filename": nombre}), 201
 
-        # Construir DataFrames
-        df_info, df_tanques, df_accesorios, df_red, df_equipos, df_obs = build_dfs_from_json(payload)
 
-        # Actividades (pueden venir en payload.actividades)
-        actividades = payload.get("actividades", []) or []
+@app.route("/uploads/<sesion>/<token>", methods=["DELETE"])
+def borrar_fotos_token(sesion, token):
+    try:
+        subidas.borrar_token(sesion, token)
+    except subidas.SubidaInvalida as e:
+        return respuesta_errores([{"error": str(e)}])
+    return "", 204
 
-        # Generar docx (pasando lista de imágenes guardadas y actividades)
-        ruta = generar_docx_desde_dfs(df_info, df_tanques, df_accesorios, df_red, df_equipos, df_obs, actividades_list=actividades, images_list=saved_images)
 
-        # Enviar archivo
-        try:
-            response = send_file(ruta, as_attachment=True, download_name=os.path.basename(ruta))
-            return response
-        except TypeError:
-            return send_file(ruta, as_attachment=True)
+@app.route("/uploads/<sesion>", methods=["GET", "DELETE"])
+def sesion_subidas(sesion):
+    try:
+        if request.method == "DELETE":
+            subidas.borrar(sesion)
+            return "", 204
+        fotos = subidas.imagenes(sesion)
+    except subidas.SubidaInvalida as e:
+        return respuesta_errores([{"error": str(e)}])
+    return jsonify({"sesion": sesion, "fotos": [{"filename": f["filename"], "procesada": bool(f.get("preparada"))} for f in fotos]})
+
+
+# ------------------------
+# Borradores: payload guardado por secciones + fotos de la sesión con el mismo id
+# ------------------------
+def borrador_json(borrador):
+    return {
+        "id": borrador["id"],
+        "payload": borrador["payload"],
+        "fotos": [f["filename"] for f in subidas.imagenes(borrador["id"])],
+        "actualizado": borrador["actualizado"],
+    }
+
+
+@app.route("/borradores/<borrador_id>", methods=["GET"])
+def obtener_borrador(borrador_id):
+    borrador = borradores.obtener(borrador_id)
+    if borrador is None:
+        return jsonify({"error": "Borrador no encontrado"}), 404
+    try:
+        return jsonify(borrador_json(borrador))
+    except subidas.SubidaInvalida as e:
+        return respuesta_errores([{"error": str(e)}])
+
+
+@app.route("/borradores/<borrador_id>", methods=["PUT", "PATCH"])
+def guardar_borrador(borrador_id):
+    """
+    Cuerpo JSON con las secciones completadas ({"general": {...}, "tanques": [...]});
+    las que no vienen se conservan. El id es también el de la sesión de fotos.
+    """
+    cambios = request.get_json(silent=True)
+    if not isinstance(cambios, dict):
+        return respuesta_errores([{"error": "Se esperaba un objeto JSON con secciones del informe"}])
+    try:
+        subidas.conservar(borrador_id)
+    except subidas.SubidaInvalida as e:
+        return respuesta_errores([{"error": str(e)}])
+    for vencido in borradores.purge_expired():
+        subidas.borrar(vencido)
+    borrador, guardadas = borradores.guardar(borrador_id, cambios)
+    return jsonify({"id": borrador["id"], "guardadas": guardadas, "actualizado": borrador["actualizado"]})
+
+
+@app.route("/borradores/<borrador_id>", methods=["DELETE"])
+def borrar_borrador(borrador_id):
+    try:
+        subidas.borrar(borrador_id)
+    except subidas.SubidaInvalida as e:
+        return respuesta_errores([{"error": str(e)}])
+    borradores.borrar(borrador_id)
+    return "", 204
+
+
+@app.route("/borradores/<borrador_id>/generar", methods=["POST"])
+@perfilable
+def generar_borrador(borrador_id):
+    """
+    Regenera el informe desde el borrador guardado y sus fotos ya subidas.
+    El cuerpo (opcional) trae sólo las secciones corregidas, que se guardan antes.
+    Sólo regenera borradores existentes: un id inventado o vencido da 404.
+    """
+    try:
+        subidas.sesion_dir(borrador_id)
+        for vencido in borradores.purge_expired():
+            subidas.borrar(vencido)
+        borrador = borradores.obtener(borrador_id)
+        if borrador is None:
+            return jsonify({"error": "Borrador no encontrado"}), 404
+        # las fotos del borrador viven lo que el borrador, no UPLOADS_TTL
+        subidas.conservar(borrador_id)
+        cambios = request.get_json(silent=True)
+        if isinstance(cambios, dict) and cambios:
+            borrador, _ = borradores.guardar(borrador_id, cambios)
+        payload = borrador["payload"]
+        with metricas.tramo("validacion", "Validación"):
+            errores = validar_payload(payload)
+        if errores:
+            return respuesta_errores(errores)
+        return entregar_informe(payload, [], sesion=borrador_id)
+    except subidas.SubidaInvalida as e:
+        return respuesta_errores([{"error": str(e)}])
+    except Exception as e:
+        import traceback
+        traceback.print_exc()
+        return jsonify({"error": "Error interno del servidor", "detail": str(e)}), 500
+
+
+# ------------------------
+# Endpoint /generar/lote: varios informes -> zip en streaming
+# ------------------------
+def validar_lote(form):
+    """
+    Sólo rechaza el lote entero si 'json' no es una lista de informes;
+    los errores de cada informe van al manifiesto.
+    """
+    lote = parse_payload(form.get("json") or form.get("payload"))
+    if not isinstance(lote, list) or not lote:
+        return [{"error": "Se esperaba en 'json' una lista de informes en el formato de /generar"}]
+    if len(lote) > lotes.LOTE_MAX_INFORMES:
+        return [{"error": f"El lote supera el máximo de {lotes.LOTE_MAX_INFORMES} informes"}]
+    return []
+
+
+def items_lote(lote, saved_images, tmpdir):
+    """
+    Un item por informe con sus fotos (campo images_<n> o images[<n>]) y su
+    carpeta, listo para lotes.generar_zip.
+    """
+    fotos = {}
+    for img in saved_images:
+        indice = lotes.indice_de_campo(img["field"])
+        if indice is not None:
+            fotos.setdefault(indice, []).append(img)
+    items = []
+    for indice, payload in enumerate(lote):
+        errores = validar_payload(payload) if isinstance(payload, dict) else [{"error": "Informe inválido"}]
+        imgs = fotos.get(indice, [])
+        errores = errores or revisar_pixeles(imgs)
+        items.append(
+            {
+                "indice": indice,
+                "nombre": lotes.nombre_entrada(indice, payload, normalizar),
+                "payload": payload,
+                "images": imgs,
+                "images_dir": os.path.dirname(imgs[0]["path"]) if imgs else None,
+                "errores": errores,
+            }
+        )
+    return items
+
+
+@app.route("/generar/lote", methods=["POST"])
+def generar_lote():
+    tmp_images_dir = None
+    try:
+        if request.content_type and "multipart/form-data" in request.content_type:
+            estado = {}
+
+            def _validar(form):
+                with metricas.tramo("validacion", "Validación"):
+                    estado["form"] = form
+                    return validar_lote(form)
+
+            with metricas.tramo("spool", "Lectura del multipart"):
+                form, saved_images, tmp_images_dir, errores = spool_multipart(request, _validar, por_campo=True)
+            if errores:
+                return respuesta_errores(errores)
+        else:
+            form = {"json": request.get_data(as_text=True)}
+            saved_images = []
+            errores = validar_lote(form)
+            if errores:
+                return respuesta_errores(errores)
+
+        lote = parse_payload(form.get("json") or form.get("payload"))
+        items = items_lote(lote, saved_images, tmp_images_dir)
+        # la carpeta de imágenes pasa a ser del generador del zip
+        tmpdir = tmp_images_dir or tempfile.mkdtemp(prefix="lote_")
+        tmp_images_dir = None
+        nombre = datetime.now().strftime("Informes_%Y%m%d_%H%M%S.zip")
+        response = Response(lotes.generar_zip(items, render_report_archivo, tmpdir), mimetype="application/zip")
+        response.headers.set("Content-Disposition", "attachment", filename=nombre)
+        return response
     except Exception as e:
         import traceback
         traceback.print_exc()
         return jsonify({"error": "Error interno del servidor", "detail": str(e)}), 500
     finally:
-        # limpieza: remover archivos temporales si se crearon
+        if tmp_images_dir and os.path.isdir(tmp_images_dir):
+            shutil.rmtree(tmp_images_dir, ignore_errors=True)
+
+
+# ------------------------
+# Endpoint /generar/inventario: hoja CSV/XLSX -> zip de informes pre-llenados
+# ------------------------
+def items_inventario(payloads):
+    for indice, payload in enumerate(payloads):
+        yield {
+            "indice": indice,
+            "nombre": lotes.nombre_entrada(indice, payload, normalizar),
+            "payload": payload,
+            "images": [],
+            "images_dir": None,
+            # pre-llenados: el resto de datos se completa luego en el formulario
+            "errores": [] if payload["tanques"] else [{"error": "La instalación no tiene tanques en el inventario"}],
+        }
+
+
+@app.route("/generar/inventario", methods=["POST"])
+def generar_inventario():
+    """
+    multipart con el archivo en 'inventario' y, opcional, 'json' con un payload
+    base cuyos datos se repiten en todos los informes. La hoja se lee por
+    bloques a medida que el zip se va enviando.
+    """
+    tmpdir = None
+    try:
+        if not (request.content_type and "multipart/form-data" in request.content_type):
+            return respuesta_errores([{"error": "Se espera multipart/form-data con el archivo en 'inventario'"}])
+        form, saved, tmpdir, _ = spool_multipart(request, lambda form: [])
+        archivo = next((f for f in saved if f["field"] == "inventario"), None)
+        if archivo is None:
+            return respuesta_errores([{"error": "Falta el archivo 'inventario' (CSV o XLSX)"}])
+        base = parse_payload(form.get("json") or form.get("payload"))
+        base = base if isinstance(base, dict) else {}
+
+        # se lee el primer bloque ya para responder 400 si el archivo no sirve
         try:
-            if tmp_images_dir and os.path.isdir(tmp_images_dir):
-                shutil.rmtree(tmp_images_dir, ignore_errors=True)
-        except Exception:
-            pass
+            payloads = inventario.payloads_desde_archivo(archivo["path"], archivo["filename"], base)
+            primero = next(payloads, None)
+        except Exception as e:
+            return respuesta_errores([{"error": f"No se pudo leer el inventario: {e}"}])
+        if primero is None:
+            return respuesta_errores([{"error": "El inventario no tiene filas"}])
+
+        items = items_inventario(itertools.chain([primero], payloads))
+        nombre = datetime.now().strftime("Informes_inventario_%Y%m%d_%H%M%S.zip")
+        response = Response(lotes.generar_zip(items, render_report_archivo, tmpdir), mimetype="application/zip")
+        response.headers.set("Content-Disposition", "attachment", filename=nombre)
+        # la carpeta (con la hoja) pasa a ser del generador del zip
+        tmpdir = None
+        return response
+    except Exception as e:
+        import traceback
+        traceback.print_exc()
+        return jsonify({"error": "Error interno del servidor", "detail": str(e)}), 500
+    finally:
+        if tmpdir and os.path.isdir(tmpdir):
+            shutil.rmtree(tmpdir, ignore_errors=True)
+
+
+# ------------------------
+# Estado / resultado de trabajos asíncronos
+# ------------------------
+@app.route("/jobs/<job_id>", methods=["GET"])
+def estado_trabajo(job_id):
+    job = trabajos.get_job(job_id)
+    if job is None:
+        return jsonify({"error": "Trabajo no encontrado"}), 404
+    if request.args.get("descargar"):
+        if job["estado"] != trabajos.LISTO:
+            return jsonify(estado_trabajo_json(job)), 409
+        if not os.path.isfile(job["resultado"] or ""):
+            return jsonify({"error": "El resultado ya no está disponible"}), 410
+        return send_file(job["resultado"], as_attachment=True, download_name=job["nombre"])
+    return jsonify(estado_trabajo_json(job))
 
 
 # Página simple para probar manualmente
 @app.route("/")
 def index():
     try:
-        return render_template("pagina.html")
+        # la página reduce cada foto antes de subirla: al tamaño del recuadro y con la calidad del servidor
+        return render_template("pagina.html", foto_slot=list(slot_pixels()), foto_calidad=IMG_JPEG_QUALITY)
     except Exception:
         return "<h3>Servidor Flask funcionando. Envia POST JSON a /generar</h3>"
 
 
+# ------------------------
+# Calentamiento (warm-up) y readiness
+# ------------------------
+_calentado = threading.Event()
+
+
+def calentar():
+    """
+    Deja el motor listo antes de atender: compila fragmentos y genera un informe
+    mínimo con una imagen (importa y ejercita python-docx, lxml y Pillow).
+    En producción (wsgi.py) se ejecuta en el proceso padre antes del fork, así
+    los workers comparten esas páginas copy-on-write.
+    """
+    if _calentado.is_set():
+        return
+    compilar_fragmentos()
+    tmpdir = tempfile.mkdtemp(prefix="calentar_")
+    try:
+        from PIL import Image
+        from imagenes import prepare_image
+
+        src = os.path.join(tmpdir, "8_1.png")
+        Image.new("RGB", (64, 48), (200, 200, 200)).save(src)
+        dst = prepare_image(src, os.path.join(tmpdir, "8_1.jpg"))
+        payload = {"general": {c: "-" for c in CAMPOS_GENERALES}, "tanques": [{"serie": "-"}]}
+        generar_docx(
+            informe_desde_json(payload),
+            images_list=[{"field": "images", "filename": "8_1.jpg", "path": dst}],
+        ).close()
+    finally:
+        shutil.rmtree(tmpdir, ignore_errors=True)
+    _calentado.set()
+
+
+@app.route("/healthz")
+def healthz():
+    if not _calentado.is_set():
+        return jsonify({"ok": False, "estado": "calentando"}), 503
+    return jsonify({"ok": True})
+
+
 if __name__ == "__main__":
+    calentar()
     app.run(host="0.0.0.0", port=int(os.environ.get("PORT", 5000)))
 
 
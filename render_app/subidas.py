@@ -0,0 +1,226 @@
+import os
+import re
+import shutil
+import tempfile
+import time
+
+from PIL import Image
+
+from imagenes import IMG_MAX_PIXELS, SLOT_ALTO_CM, SLOT_ANCHO_CM, _prepare_timed, demasiados_pixeles, dimensiones, get_pool
+
+# ------------------------
+# Configuración
+# ------------------------
+UPLOADS_DIR = os.environ.get("UPLOADS_DIR", os.path.join(tempfile.gettempdir(), "informe_uploads"))
+# Una sesión sin subidas nuevas en este tiempo se borra
+UPLOADS_TTL = int(os.environ.get("UPLOADS_TTL", 24 * 3600))
+# Tamaño máximo de cada foto subida
+UPLOADS_MAX_BYTES = int(os.environ.get("UPLOADS_MAX_BYTES", 40 * 1024 * 1024))
+
+SESION_RE = re.compile(r"^[A-Za-z0-9_-]{8,64}$")
+TOKEN_RE = re.compile(r"^[A-Za-z0-9_-][A-Za-z0-9_.-]{0,119}$")
+EXT_RE = re.compile(r"^[A-Za-z0-9]{1,5}$")
+
+
+class SubidaInvalida(ValueError):
+    pass
+
+
+def sesion_dir(sesion):
+    if not SESION_RE.match(sesion or ""):
+        raise SubidaInvalida("Identificador de sesión inválido")
+    return os.path.join(UPLOADS_DIR, sesion)
+
+
+def _dirs(sesion):
+    base = sesion_dir(sesion)
+    return os.path.join(base, "originales"), os.path.join(base, "procesadas")
+
+
+def _del_token(nombre, token):
+    # 'token_3.jpg' o la procesada 'token_3.<firma>.jpg' (sin confundir el token '1' con '1_before_2.jpg')
+    m = re.match(re.escape(token) + r"_(\d+)\.[A-Za-z0-9.]+$", nombre, re.IGNORECASE)
+    return int(m.group(1)) if m else None
+
+
+def _quitar(path):
+    try:
+        os.remove(path)
+    except OSError:
+        pass
+
+
+def _firma(st):
+    # identifica el original: un reintento lo reemplaza (otro inodo), nunca lo modifica
+    return "%xg%xg%x" % (st.st_ino, st.st_size, st.st_mtime_ns)
+
+
+def _procesada(procesadas, nombre, st):
+    return os.path.join(procesadas, "%s.%s.jpg" % (os.path.splitext(nombre)[0], _firma(st)))
+
+
+def _preparar(src, procesadas):
+    """
+    Tarea del pool: deja en procesadas la versión lista para el docx, con la
+    firma del original en el nombre (escritura atómica, así /generar nunca lee
+    una a medio escribir ni la de un original ya reemplazado).
+    """
+    antes = os.stat(src)
+    dst = _procesada(procesadas, os.path.basename(src), antes)
+    fd, tmp = tempfile.mkstemp(dir=procesadas, suffix=".part")
+    os.close(fd)
+    try:
+        r = _prepare_timed(src, tmp, SLOT_ANCHO_CM, SLOT_ALTO_CM)
+        os.replace(tmp, dst)
+    except BaseException:
+        _quitar(tmp)
+        raise
+    # si el original se reemplazó mientras tanto, lo leído puede ser de los dos
+    try:
+        vigente = _firma(os.stat(src)) == _firma(antes)
+    except OSError:
+        vigente = False
+    if not vigente:
+        _quitar(dst)
+    return dict(r, path=dst)
+
+
+def guardar(sesion, token, stream, n=None, ext="jpg", chunk_size=64 * 1024):
+    """
+    Guarda una foto como <token>_<n>.<ext> en la sesión y encola su preproceso
+    en segundo plano. Con n dado, un reintento reemplaza el mismo archivo.
+    Devuelve el nombre guardado.
+    """
+    if not TOKEN_RE.match(token or ""):
+        raise SubidaInvalida("Token inválido")
+    ext = (ext or "jpg").lower()
+    if not EXT_RE.match(ext):
+        ext = "jpg"
+    purge_expired()
+    originales, procesadas = _dirs(sesion)
+    os.makedirs(originales, exist_ok=True)
+    os.makedirs(procesadas, exist_ok=True)
+
+    existentes = {}
+    for nombre in os.listdir(originales):
+        idx = _del_token(nombre, token)
+        if idx is not None:
+            existentes.setdefault(idx, []).append(nombre)
+    if n is None:
+        n = max(existentes, default=0) + 1
+    for nombre in existentes.get(n, []):
+        _quitar(os.path.join(originales, nombre))
+    for nombre in os.listdir(procesadas):
+        if _del_token(nombre, token) == n:
+            _quitar(os.path.join(procesadas, nombre))
+    nombre = f"{token}_{n}.{ext}"
+
+    destino = os.path.join(originales, nombre)
+    fd, tmp = tempfile.mkstemp(dir=originales, suffix=".part")
+    total = 0
+    try:
+        with os.fdopen(fd, "wb") as fh:
+            while True:
+                chunk = stream.read(chunk_size)
+                if not chunk:
+                    break
+                total += len(chunk)
+                if total > UPLOADS_MAX_BYTES:
+                    raise SubidaInvalida(f"La foto supera {UPLOADS_MAX_BYTES // (1024 * 1024)} MB")
+                fh.write(chunk)
+        if total == 0:
+            raise SubidaInvalida("Archivo vacío")
+        try:
+            size = dimensiones(tmp)
+        except Image.DecompressionBombError:
+            raise SubidaInvalida(demasiados_pixeles(nombre))
+        if size and size[0] * size[1] > IMG_MAX_PIXELS:
+            raise SubidaInvalida(demasiados_pixeles(nombre, size[0] * size[1]))
+        os.replace(tmp, destino)
+    except BaseException:
+        _quitar(tmp)
+        raise
+    os.utime(sesion_dir(sesion))
+    get_pool().submit(_preparar, destino, procesadas)
+    return nombre
+
+
+def conservar(sesion):
+    """
+    Marca la sesión como parte de un borrador: purge_expired no la borra
+    (la borra el borrador al vencer o al eliminarse).
+    """
+    base = sesion_dir(sesion)
+    os.makedirs(base, exist_ok=True)
+    open(os.path.join(base, ".borrador"), "a").close()
+
+
+def borrar_token(sesion, token):
+    originales, procesadas = _dirs(sesion)
+    for carpeta in (originales, procesadas):
+        if os.path.isdir(carpeta):
+            for nombre in os.listdir(carpeta):
+                if _del_token(nombre, token) is not None:
+                    _quitar(os.path.join(carpeta, nombre))
+
+
+def borrar(sesion):
+    shutil.rmtree(sesion_dir(sesion), ignore_errors=True)
+
+
+def imagenes(sesion):
+    """
+    Fotos de la sesión como dicts de imagen ({'field','filename','path'}).
+    Las que ya tienen la versión procesada de ese mismo original (misma firma)
+    apuntan a ella y llevan 'preparada': True; el resto apunta al original.
+    """
+    originales, procesadas = _dirs(sesion)
+    if not os.path.isdir(originales):
+        return []
+    out = []
+    for e in sorted(os.scandir(originales), key=lambda e: e.name):
+        if e.name.endswith(".part") or not e.is_file():
+            continue
+        item = {"field": "images", "filename": e.name, "path": e.path}
+        try:
+            procesada = _procesada(procesadas, e.name, e.stat())
+            if os.path.isfile(procesada):
+                item.update(path=procesada, preparada=True)
+        except OSError:
+            pass
+        out.append(item)
+    return out
+
+
+def copiar_a(items, destino):
+    """
+    Copia (o enlaza) las fotos de imagenes() a destino, para un trabajo
+    asíncrono que borra su carpeta al terminar.
+    """
+    os.makedirs(destino, exist_ok=True)
+    out = []
+    for item in items:
+        path = os.path.join(destino, os.path.basename(item["path"]))
+        if item.get("preparada"):
+            path = os.path.join(destino, "preparada_" + os.path.basename(item["path"]))
+        try:
+            os.link(item["path"], path)
+        except OSError:
+            shutil.copyfile(item["path"], path)
+        out.append(dict(item, path=path))
+    return out
+
+
+def purge_expired():
+    """
+    Borra sesiones sin actividad en UPLOADS_TTL (salvo las de un borrador).
+    """
+    if not os.path.isdir(UPLOADS_DIR):
+        return
+    limite = time.time() - UPLOADS_TTL
+    for e in os.scandir(UPLOADS_DIR):
+        try:
+            if e.is_dir() and e.stat().st_mtime < limite and not os.path.exists(os.path.join(e.path, ".borrador")):
+                shutil.rmtree(e.path, ignore_errors=True)
+        except OSError:
+            continue
@@ -0,0 +1,224 @@
+import atexit
+import contextlib
+import json
+import logging
+import multiprocessing
+import os
+import shutil
+import sqlite3
+import tempfile
+import threading
+import time
+import uuid
+
+# ------------------------
+# Configuración
+# ------------------------
+JOBS_DB = os.environ.get("JOBS_DB", os.path.join(tempfile.gettempdir(), "informe_jobs.sqlite3"))
+JOBS_DIR = os.environ.get("JOBS_DIR", os.path.join(tempfile.gettempdir(), "informe_jobs"))
+# Procesos que atienden la cola en cada servidor
+JOBS_WORKERS = int(os.environ.get("JOBS_WORKERS", 2))
+# Tiempo que se conservan trabajos terminados (y sus archivos)
+JOBS_TTL = int(os.environ.get("JOBS_TTL", 24 * 3600))
+# Un trabajo 'procesando' sin actualizar en este tiempo se considera abandonado
+JOBS_STALE = int(os.environ.get("JOBS_STALE", 1800))
+
+PENDIENTE = "pendiente"
+PROCESANDO = "procesando"
+LISTO = "listo"
+ERROR = "error"
+
+logger = logging.getLogger(__name__)
+
+
+@contextlib.contextmanager
+def _connect():
+    conn = sqlite3.connect(JOBS_DB, timeout=30, isolation_level=None)
+    try:
+        conn.row_factory = sqlite3.Row
+        conn.execute("PRAGMA journal_mode=WAL")
+        yield conn
+    finally:
+        conn.close()
+
+
+def init_db():
+    os.makedirs(JOBS_DIR, exist_ok=True)
+    with _connect() as conn:
+        conn.execute(
+            """
+            CREATE TABLE IF NOT EXISTS jobs (
+                id TEXT PRIMARY KEY,
+                estado TEXT NOT NULL,
+                payload TEXT NOT NULL,
+                images TEXT NOT NULL,
+                images_dir TEXT,
+                resultado TEXT,
+                nombre TEXT,
+                error TEXT,
+                creado REAL NOT NULL,
+                actualizado REAL NOT NULL,
+                worker TEXT
+            )
+            """
+        )
+        conn.execute("CREATE INDEX IF NOT EXISTS jobs_estado ON jobs (estado, creado)")
+
+
+def job_dir(job_id):
+    return os.path.join(JOBS_DIR, job_id)
+
+
+def enqueue(payload, images, images_dir=None):
+    """
+    Encola un trabajo. images es la lista de dicts de save_uploaded_files_tmp
+    (sin futures); images_dir pasa a ser propiedad del trabajo y se borra al terminar.
+    Devuelve el id.
+    """
+    init_db()
+    purge_expired()
+    job_id = uuid.uuid4().hex
+    now = time.time()
+    images = [{k: v for k, v in item.items() if k in ("field", "filename", "path", "preparada")} for item in images or []]
+    with _connect() as conn:
+        conn.execute(
+            "INSERT INTO jobs (id, estado, payload, images, images_dir, creado, actualizado) VALUES (?, ?, ?, ?, ?, ?, ?)",
+            (job_id, PENDIENTE, json.dumps(payload), json.dumps(images), images_dir, now, now),
+        )
+    return job_id
+
+
+def get_job(job_id):
+    init_db()
+    with _connect() as conn:
+        row = conn.execute("SELECT * FROM jobs WHERE id = ?", (job_id,)).fetchone()
+    return dict(row) if row else None
+
+
+def queue_stats():
+    init_db()
+    with _connect() as conn:
+        rows = conn.execute("SELECT estado, COUNT(*) AS n FROM jobs GROUP BY estado").fetchall()
+    return {r["estado"]: r["n"] for r in rows}
+
+
+def claim(worker_id):
+    """
+    Toma el trabajo pendiente más antiguo (o uno abandonado) de forma atómica.
+    """
+    now = time.time()
+    with _connect() as conn:
+        conn.execute("BEGIN IMMEDIATE")
+        try:
+            row = conn.execute(
+                "SELECT * FROM jobs WHERE estado = ? OR (estado = ? AND actualizado < ?) ORDER BY creado LIMIT 1",
+                (PENDIENTE, PROCESANDO, now - JOBS_STALE),
+            ).fetchone()
+            if row is None:
+                conn.execute("COMMIT")
+                return None
+            conn.execute(
+                "UPDATE jobs SET estado = ?, worker = ?, actualizado = ? WHERE id = ?",
+                (PROCESANDO, worker_id, now, row["id"]),
+            )
+            conn.execute("COMMIT")
+        except Exception:
+            conn.execute("ROLLBACK")
+            raise
+    return dict(row)
+
+
+def _finish(job_id, estado, resultado=None, nombre=None, error=None):
+    with _connect() as conn:
+        conn.execute(
+            "UPDATE jobs SET estado = ?, resultado = ?, nombre = ?, error = ?, actualizado = ? WHERE id = ?",
+            (estado, resultado, nombre, error, time.time(), job_id),
+        )
+
+
+def purge_expired():
+    """
+    Borra trabajos terminados más viejos que JOBS_TTL junto con sus archivos.
+    """
+    limite = time.time() - JOBS_TTL
+    with _connect() as conn:
+        rows = conn.execute(
+            "SELECT id, images_dir FROM jobs WHERE estado IN (?, ?) AND actualizado < ?", (LISTO, ERROR, limite)
+        ).fetchall()
+        for r in rows:
+            shutil.rmtree(job_dir(r["id"]), ignore_errors=True)
+            if r["images_dir"]:
+                shutil.rmtree(r["images_dir"], ignore_errors=True)
+        conn.execute("DELETE FROM jobs WHERE estado IN (?, ?) AND actualizado < ?", (LISTO, ERROR, limite))
+
+
+def run_job(job, render):
+    """
+    Ejecuta render(payload, images, images_dir) -> docx (archivo abierto) y guarda el resultado.
+    """
+    job_id = job["id"]
+    try:
+        docx = render(json.loads(job["payload"]), json.loads(job["images"]), job["images_dir"])
+        try:
+            os.makedirs(job_dir(job_id), exist_ok=True)
+            nombre = f"Informe_Mantenimiento_{job_id}.docx"
+            destino = os.path.join(job_dir(job_id), nombre)
+            with open(destino, "wb") as fh:
+                shutil.copyfileobj(docx, fh)
+        finally:
+            docx.close()
+        _finish(job_id, LISTO, resultado=destino, nombre=nombre)
+    except Exception as e:
+        logger.exception("Trabajo %s falló", job_id)
+        _finish(job_id, ERROR, error=str(e))
+    finally:
+        if job["images_dir"]:
+            shutil.rmtree(job["images_dir"], ignore_errors=True)
+
+
+def worker_loop(render, stop_event, poll=0.5):
+    worker_id = f"{os.getpid()}"
+    init_db()
+    while not stop_event.is_set():
+        job = claim(worker_id)
+        if job is None:
+            stop_event.wait(poll)
+            continue
+        run_job(job, render)
+
+
+_workers = []
+_workers_lock = threading.Lock()
+_stop_event = None
+
+
+def ensure_workers(render, n=None):
+    """
+    Arranca (una sola vez por proceso servidor) n procesos que atienden la cola.
+    render debe ser una función de nivel de módulo.
+    """
+    global _stop_event
+    n = JOBS_WORKERS if n is None else n
+    with _workers_lock:
+        vivos = [p for p in _workers if p.is_alive()]
+        if len(vivos) >= n:
+            return
+        init_db()
+        if _stop_event is None:
+            _stop_event = multiprocessing.Event()
+            atexit.register(stop_workers)
+        for _ in range(n - len(vivos)):
+            # no daemon: el render usa su propio pool de procesos para imágenes
+            p = multiprocessing.Process(target=worker_loop, args=(render, _stop_event), name="informe-worker")
+            p.start()
+            vivos.append(p)
+        _workers[:] = vivos
+
+
+def stop_workers(timeout=5):
+    if _stop_event is not None:
+        _stop_event.set()
+    for p in _workers:
+        p.join(timeout)
+        if p.is_alive():
+            p.terminate()
@@ -0,0 +1,14 @@
+"""
+Punto de entrada de producción (gunicorn -c gunicorn.conf.py wsgi:app).
+Con preload_app el módulo se importa y se calienta una sola vez en el
+proceso maestro; los workers se crean después con fork y comparten esas
+páginas de memoria (copy-on-write).
+"""
+import gc
+
+from servidor import app, calentar
+
+calentar()
+# lo cargado hasta aquí no se vuelve a recorrer en el GC, así no se tocan
+# (ni copian) esas páginas en cada worker
+gc.freeze()